@@ -0,0 +1,195 @@
+import argparse
+import time
+import psycopg2
+from config import PENDING_MATCH_TIMEOUT, STALE_TRIP_TIMEOUT
+from db import db_cursor, get_conn, close_pool
+from queries import execute
+
+MATCH_COLUMNS = "id, client_id, captain_id, destination, status, created_at, updated_at, version"
+RATING_COLUMNS = "id, match_id, client_id, captain_id, rating, comment, notes, created_at"
+
+def init_archive(cur):
+    # الرحلات المنتهية القديمة وتقييماتها تُنقل لجداول أرشيف باردة فيبقى جدول matches وفهارسه صغيرة
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS matches_archive (
+        id INTEGER PRIMARY KEY, client_id BIGINT, captain_id BIGINT, destination TEXT,
+        status VARCHAR(20), created_at TIMESTAMP, updated_at TIMESTAMP,
+        version INTEGER NOT NULL DEFAULT 0, archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ratings_archive (
+        id INTEGER PRIMARY KEY, match_id INTEGER, client_id BIGINT, captain_id BIGINT,
+        rating INTEGER, comment TEXT, notes TEXT, created_at TIMESTAMP,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_matches_archive_client ON matches_archive (client_id, created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_matches_archive_captain ON matches_archive (captain_id, created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ratings_archive_captain ON ratings_archive (captain_id)")
+
+def archive_batch(older_than_days, batch_size):
+    # نقل دفعة واحدة في عبارة واحدة: حذف الرحلات وتقييماتها وإدراجها في الأرشيف معاً
+    with db_cursor(commit=True) as cur:
+        cur.execute(f"""
+            WITH old AS (
+                SELECT id FROM matches
+                WHERE status IN ('completed', 'rejected', 'cancelled')
+                  AND COALESCE(updated_at, created_at) < CURRENT_TIMESTAMP - make_interval(days => %s)
+                ORDER BY id LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ), moved_ratings AS (
+                DELETE FROM ratings WHERE match_id IN (SELECT id FROM old)
+                RETURNING {RATING_COLUMNS}
+            ), archived_ratings AS (
+                INSERT INTO ratings_archive ({RATING_COLUMNS}) SELECT {RATING_COLUMNS} FROM moved_ratings
+                ON CONFLICT (id) DO NOTHING
+            ), moved_matches AS (
+                DELETE FROM matches WHERE id IN (SELECT id FROM old)
+                RETURNING {MATCH_COLUMNS}
+            )
+            INSERT INTO matches_archive ({MATCH_COLUMNS}) SELECT {MATCH_COLUMNS} FROM moved_matches
+            ON CONFLICT (id) DO NOTHING
+        """, (older_than_days, batch_size))
+        return cur.rowcount
+
+def archive_old_matches(older_than_days, batch_size):
+    # دفعات صغيرة كل منها في معاملة مستقلة حتى لا تُقفل الجداول لفترة طويلة
+    total = 0
+    while True:
+        moved = archive_batch(older_than_days, batch_size)
+        total += moved
+        if moved < batch_size:
+            return total
+
+# مستخدمو القياس بمعرفات لا يستخدمها تيليجرام، نصفهم كباتن
+BENCH_USER_BASE = 9_200_000_000
+SEED_CHUNK = 1_000_000
+
+SEED_USERS_SQL = """
+INSERT INTO users (user_id, role, full_name, phone, city, neighborhood)
+SELECT %(base)s + g, CASE WHEN g < %(half)s THEN 'client' ELSE 'captain' END, 'مستخدم قياس', '0500000000', 'قياس', 'قياس'
+FROM generate_series(0, 2 * %(half)s - 1) g
+"""
+
+# رحلات منتهية أقدم من مهلة الأرشفة، وتقييم لكل رحلة مكتملة منها
+SEED_OLD_SQL = """
+WITH m AS (
+    INSERT INTO matches (client_id, captain_id, destination, status, created_at, updated_at)
+    SELECT %(base)s + g %% %(half)s, %(base)s + %(half)s + g %% %(half)s, 'أرشيف',
+           (ARRAY['completed', 'completed', 'completed', 'cancelled', 'rejected'])[1 + g %% 5],
+           t, t + interval '30 minutes'
+    FROM generate_series(%(start)s, %(stop)s - 1) g,
+         LATERAL (SELECT CURRENT_TIMESTAMP - make_interval(days => %(days)s + 1 + g %% 365)) AS d(t)
+    RETURNING id, client_id, captain_id, status, created_at
+)
+INSERT INTO ratings (match_id, client_id, captain_id, rating, created_at)
+SELECT id, client_id, captain_id, 1 + id %% 5, created_at FROM m WHERE status = 'completed'
+"""
+
+SEED_ACTIVE_SQL = """
+INSERT INTO matches (client_id, captain_id, destination, status)
+SELECT %(base)s + g %% %(half)s, %(base)s + %(half)s + g %% %(half)s, 'جارية',
+       CASE WHEN g %% 2 = 0 THEN 'in_progress' ELSE 'completed' END
+FROM generate_series(0, %(active)s - 1) g
+"""
+
+SIZE_SQL = """
+SELECT pg_size_pretty(pg_total_relation_size('matches')) AS matches, pg_size_pretty(pg_total_relation_size('ratings')) AS ratings,
+       pg_size_pretty(pg_total_relation_size('matches_archive')) AS archive
+"""
+
+def _bench_params(users):
+    return {"base": BENCH_USER_BASE, "half": max(users // 2, 1)}
+
+def _seed(rows, active, users, days):
+    # session_replication_role=replica يعطل المحفزات والمفاتيح الأجنبية أثناء البذر الضخم ويحتاج صلاحية superuser؛
+    # بدونها يعمل البذر مع محفزات user_stats وهو أبطأ فقط
+    params = _bench_params(users)
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            try:
+                cur.execute("SET session_replication_role = replica")
+                conn.commit()
+            except psycopg2.Error:
+                conn.rollback()
+                print("⚠️ لا توجد صلاحية لتعطيل المحفزات، البذر سيحدّث user_stats لكل صف")
+            cur.execute(SEED_USERS_SQL, params)
+            conn.commit()
+            started = time.perf_counter()
+            for start in range(0, rows, SEED_CHUNK):
+                cur.execute(SEED_OLD_SQL, {**params, "start": start, "stop": min(start + SEED_CHUNK, rows), "days": days})
+                conn.commit()
+                print(f"🌱 {min(start + SEED_CHUNK, rows)}/{rows} رحلة قديمة ({time.perf_counter() - started:.0f} ث)")
+            cur.execute(SEED_ACTIVE_SQL, {**params, "active": active})
+            conn.commit()
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            for table in ("matches", "ratings", "matches_archive", "ratings_archive"):
+                cur.execute(f"VACUUM ANALYZE {table}")
+    finally:
+        conn.close()
+
+def _hot_queries(iterations):
+    # استعلامات المسار الساخن على جدول matches: الرحلات المفتوحة للمؤقتات، وجلب رحلة، ورحلة الكابتن الجارية
+    with db_cursor() as cur:
+        cur.execute("SELECT id, captain_id FROM matches WHERE status = 'in_progress' AND captain_id >= %s ORDER BY id DESC LIMIT 1",
+                    (BENCH_USER_BASE,))
+        recent = cur.fetchone()
+        cases = [("open_matches", lambda: execute(cur, "open_matches", PENDING_MATCH_TIMEOUT, STALE_TRIP_TIMEOUT)),
+                 ("get_match", lambda: execute(cur, "get_match", recent['id'])),
+                 ("captain active", lambda: cur.execute("SELECT * FROM matches WHERE captain_id = %s AND status = 'in_progress'",
+                                                        (recent['captain_id'],)))]
+        results = {}
+        for name, run in cases:
+            started = time.perf_counter()
+            for _ in range(iterations):
+                run()
+                cur.fetchall()
+            results[name] = (time.perf_counter() - started) / iterations * 1000
+        cur.execute(SIZE_SQL)
+        return results, cur.fetchone()
+
+def _report(label, results, sizes):
+    timings = "، ".join(f"{name} {ms:.2f} ms" for name, ms in results.items())
+    print(f"📏 {label}: matches {sizes['matches']}، ratings {sizes['ratings']}، الأرشيف {sizes['archive']}\n    {timings}")
+
+def cleanup_bench(users):
+    bounds = (BENCH_USER_BASE, BENCH_USER_BASE + max(users // 2, 1) * 2)
+    with db_cursor(commit=True) as cur:
+        for table in ("ratings", "ratings_archive", "matches", "matches_archive"):
+            cur.execute(f"DELETE FROM {table} WHERE client_id >= %s AND client_id < %s", bounds)
+        cur.execute("DELETE FROM users WHERE user_id >= %s AND user_id < %s", bounds)
+
+def benchmark(rows, active, users, days, batch_size, iterations):
+    cleanup_bench(users)
+    _seed(rows, active, users, days)
+    before, sizes = _hot_queries(iterations)
+    _report("قبل الأرشفة", before, sizes)
+    started = time.perf_counter()
+    moved = archive_old_matches(days, batch_size)
+    elapsed = time.perf_counter() - started
+    print(f"📦 أرشفة {moved} رحلة في {elapsed:.1f} ث ({moved / elapsed:.0f} رحلة/ث، دفعات {batch_size})")
+    with db_cursor() as cur:
+        cur.execute("VACUUM ANALYZE matches")
+    after, sizes = _hot_queries(iterations)
+    _report("بعد الأرشفة", after, sizes)
+    print("    (المساحة تعود لـ PostgreSQL بعد VACUUM FULL أو pg_repack، وتُعاد للاستخدام داخل الجدول دونهما)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="قياس أرشفة الرحلات القديمة وأثرها على استعلامات جدول matches")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="عدد الرحلات القديمة المنتهية (يصلح حتى 50000000)")
+    parser.add_argument("--active", type=int, default=10_000, help="رحلات حديثة تبقى في الجدول")
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--days", type=int, default=90, help="عمر الرحلات التي تُؤرشف بالأيام")
+    parser.add_argument("--batch", type=int, default=5000)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--keep", action="store_true", help="عدم حذف بيانات القياس بعد الانتهاء")
+    args = parser.parse_args()
+    try:
+        benchmark(args.rows, args.active, args.users, args.days, args.batch, args.iterations)
+    finally:
+        if not args.keep:
+            cleanup_bench(args.users)
+        close_pool()
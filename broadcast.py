@@ -0,0 +1,76 @@
+import asyncio
+import time
+from aiogram.exceptions import TelegramRetryAfter
+from config import TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_MAX_RETRIES
+from metrics import metrics
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        # يحجز رمزاً فوراً ويعيد مدة الانتظار اللازمة، فيحصل المتسابقون على دورهم بالترتيب دون قفل
+        self._refill()
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def try_acquire(self):
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def idle(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+class TelegramSender:
+    # إرسال متوازٍ يحترم حدود تيليجرام العامة ولكل محادثة ويعيد المحاولة عند flood wait
+    def __init__(self, rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                 chat_burst=TELEGRAM_CHAT_BURST, max_retries=TELEGRAM_MAX_RETRIES):
+        self.global_bucket = TokenBucket(rate, rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chat_buckets = {}
+        self.flood_waits = 0
+
+    def _reserve(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= 10000:
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.idle()}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return max(self.global_bucket.reserve(), bucket.reserve())
+
+    async def send(self, chat_id, call):
+        for attempt in range(self.max_retries + 1):
+            delay = self._reserve(chat_id)
+            if delay:
+                await asyncio.sleep(delay)
+            try:
+                return await call()
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.flood_waits += 1
+                await asyncio.sleep(e.retry_after)
+
+    async def send_many(self, chat_id, calls, name="batch"):
+        # رسائل المحادثة الواحدة تُرسل بالتتابع لتصل بترتيبها؛ حد المحادثة يمنع التوازي داخلها على أي حال
+        started = time.monotonic()
+        results = []
+        for call in calls:
+            results.append(await self.send(chat_id, call))
+            if len(results) == 1:
+                metrics.observe("telegram_batch_first_seconds", time.monotonic() - started, batch=name)
+        metrics.observe("telegram_batch_last_seconds", time.monotonic() - started, batch=name)
+        return results
@@ -0,0 +1,177 @@
+import argparse
+import csv
+import io
+import json
+import sys
+import time
+import psycopg2.extras
+from cache import NeighborhoodCatalog
+from config import SUPPORTED_CITIES, NEIGHBORHOODS_FILE
+from db import get_conn
+
+COLUMNS = ("user_id", "username", "role", "subscription", "full_name", "phone", "car_model", "car_plate",
+           "agreement", "city", "neighborhood", "neighborhood2", "neighborhood3")
+
+# الأعمدة تُحمَّل كنصوص ثم تُفحص وتُحوَّل في SQL حتى لا يُفشل صف واحد خاطئ الدفعة كاملة
+STAGING_SCHEMA = """
+CREATE TEMP TABLE IF NOT EXISTS import_staging (
+    line INTEGER NOT NULL, user_id TEXT, username TEXT, role TEXT, subscription TEXT,
+    full_name TEXT, phone TEXT, car_model TEXT, car_plate TEXT, agreement TEXT,
+    city TEXT, neighborhood TEXT, neighborhood2 TEXT, neighborhood3 TEXT, error TEXT
+) ON COMMIT DELETE ROWS;
+CREATE TEMP TABLE IF NOT EXISTS import_areas (
+    city TEXT NOT NULL, neighborhood TEXT NOT NULL, PRIMARY KEY (city, neighborhood)
+);
+"""
+
+VALIDATE_SQL = """
+UPDATE import_staging s SET error = CASE
+    WHEN s.user_id IS NULL OR s.user_id !~ '^[0-9]{1,18}$' THEN 'invalid user_id'
+    WHEN s.role IS NULL OR s.role NOT IN ('client', 'captain') THEN 'invalid role'
+    WHEN s.full_name IS NULL THEN 'missing full_name'
+    WHEN s.city IS NULL OR s.city <> ALL(%s) THEN 'unsupported city'
+    WHEN NOT EXISTS (SELECT 1 FROM import_areas a WHERE a.city = s.city AND a.neighborhood = s.neighborhood) THEN 'unknown neighborhood'
+    WHEN s.role = 'captain' AND (s.car_model IS NULL OR s.car_plate IS NULL) THEN 'missing car details'
+    WHEN s.role = 'captain' AND EXISTS (
+        SELECT 1 FROM unnest(ARRAY[s.neighborhood2, s.neighborhood3]) AS n(neighborhood)
+        WHERE n.neighborhood IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM import_areas a WHERE a.city = s.city AND a.neighborhood = n.neighborhood)
+    ) THEN 'unknown neighborhood'
+END
+WHERE s.error IS NULL
+"""
+
+# نفس دلالات ON CONFLICT في save_user؛ عند تكرار المستخدم في الدفعة يفوز آخر سطر
+UPSERT_SQL = """
+INSERT INTO users (user_id, username, role, subscription, full_name, phone, car_model, car_plate, agreement, city, neighborhood, neighborhood2, neighborhood3, is_available)
+SELECT DISTINCT ON (user_id::BIGINT)
+       user_id::BIGINT, username, role, subscription, full_name, phone, car_model, car_plate,
+       COALESCE(lower(agreement) IN ('true', 't', '1', 'yes', 'y'), FALSE),
+       city, neighborhood, neighborhood2, neighborhood3, TRUE
+FROM import_staging WHERE error IS NULL
+ORDER BY user_id::BIGINT, line DESC
+ON CONFLICT (user_id) DO UPDATE SET
+    username=EXCLUDED.username, role=EXCLUDED.role, subscription=EXCLUDED.subscription,
+    full_name=EXCLUDED.full_name, phone=EXCLUDED.phone, car_model=EXCLUDED.car_model,
+    car_plate=EXCLUDED.car_plate, agreement=EXCLUDED.agreement, city=EXCLUDED.city,
+    neighborhood=EXCLUDED.neighborhood, neighborhood2=EXCLUDED.neighborhood2,
+    neighborhood3=EXCLUDED.neighborhood3, is_available=TRUE
+"""
+
+SERVICE_AREAS_SQL = """
+DELETE FROM captain_service_areas WHERE captain_id IN (SELECT user_id::BIGINT FROM import_staging WHERE error IS NULL);
+INSERT INTO captain_service_areas (city, neighborhood, captain_id, is_available)
+SELECT u.city, n.neighborhood, u.user_id, u.is_available
+FROM users u, unnest(ARRAY[u.neighborhood, u.neighborhood2, u.neighborhood3]) AS n(neighborhood)
+WHERE u.user_id IN (SELECT user_id::BIGINT FROM import_staging WHERE error IS NULL)
+  AND u.role = 'captain' AND n.neighborhood IS NOT NULL
+ON CONFLICT DO NOTHING;
+"""
+
+def read_rows(stream, fmt):
+    # (رقم السطر، الصف، سبب رفض مسبق): السطر التالف يُحمّل فارغاً بسببه فيصل لملف المرفوضات دون إيقاف الاستيراد
+    if fmt == "csv":
+        for line, row in enumerate(csv.DictReader(stream), start=2):
+            yield line, row, None
+    else:
+        for line, text in enumerate(stream, start=1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except json.JSONDecodeError:
+                yield line, {}, "invalid json"
+                continue
+            if isinstance(row, dict):
+                yield line, row, None
+            else:
+                yield line, {}, "not an object"
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def to_copy_buffer(batch):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for line, row, error in batch:
+        values = [row.get(column) for column in COLUMNS] + [error]
+        writer.writerow([line] + ["" if v is None else str(v).strip() for v in values])
+    buffer.seek(0)
+    return buffer
+
+def load_areas(cur, catalog):
+    cur.execute("TRUNCATE import_areas")
+    areas = [(city, n) for city in SUPPORTED_CITIES for n in catalog.get(city)]
+    psycopg2.extras.execute_values(cur, "INSERT INTO import_areas (city, neighborhood) VALUES %s", areas)
+
+def import_batch(cur, batch):
+    cur.copy_expert(f"COPY import_staging (line, {', '.join(COLUMNS)}, error) FROM STDIN WITH (FORMAT csv)", to_copy_buffer(batch))
+    cur.execute(VALIDATE_SQL, (list(SUPPORTED_CITIES),))
+    cur.execute("SELECT line, user_id, error FROM import_staging WHERE error IS NOT NULL ORDER BY line")
+    rejected = cur.fetchall()
+    cur.execute(UPSERT_SQL)
+    imported = cur.rowcount
+    cur.execute(SERVICE_AREAS_SQL)
+    return imported, rejected
+
+def run_import(stream, fmt, batch_size, rejects_writer=None):
+    catalog = NeighborhoodCatalog(NEIGHBORHOODS_FILE)
+    catalog.reload()
+    conn = get_conn()
+    total = imported = rejected = 0
+    started = time.perf_counter()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(STAGING_SCHEMA)
+            load_areas(cur, catalog)
+            conn.commit()
+            # كل دفعة في معاملة واحدة: COPY ثم الفحص ثم الإدراج
+            for batch in batches(read_rows(stream, fmt), batch_size):
+                batch_imported, batch_rejected = import_batch(cur, batch)
+                conn.commit()
+                total += len(batch)
+                imported += batch_imported
+                rejected += len(batch_rejected)
+                if rejects_writer is not None:
+                    rejects_writer.writerows((r['line'], r['user_id'], r['error']) for r in batch_rejected)
+                elapsed = time.perf_counter() - started
+                print(f"⏳ {total} صف ({total / elapsed:.0f} صف/ث)", file=sys.stderr)
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return total, imported, rejected, time.perf_counter() - started
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="استيراد جماعي للمستخدمين (كباتن الشركات الشريكة) من CSV أو JSONL")
+    parser.add_argument("path", help="مسار الملف، أو - للقراءة من stdin")
+    parser.add_argument("--format", choices=("csv", "jsonl"), help="يُستنتج من امتداد الملف إذا لم يُحدد")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--rejects", help="ملف CSV لحفظ الصفوف المرفوضة وسبب الرفض")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    fmt = args.format or ("jsonl" if args.path.endswith((".jsonl", ".ndjson")) else "csv")
+    stream = sys.stdin if args.path == "-" else open(args.path, "r", encoding="utf-8-sig", newline="")
+    rejects_file = open(args.rejects, "w", encoding="utf-8", newline="") if args.rejects else None
+    try:
+        rejects_writer = csv.writer(rejects_file) if rejects_file else None
+        if rejects_writer:
+            rejects_writer.writerow(("line", "user_id", "error"))
+        total, imported, rejected, elapsed = run_import(stream, fmt, args.batch_size, rejects_writer)
+        print(f"✅ تم استيراد {imported} مستخدم من {total} صف، ورُفض {rejected} صف خلال {elapsed:.1f} ثانية ({total / elapsed if elapsed else 0:.0f} صف/ث)")
+        # البوت العامل يلتقط الكباتن الجدد عند التحديث الدوري لفهرس الكباتن (CAPTAIN_INDEX_REFRESH_INTERVAL)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+        if rejects_file:
+            rejects_file.close()
@@ -0,0 +1,181 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+class UserCache:
+    # ذاكرة مؤقتة لملفات المستخدمين مع انتهاء صلاحية (TTL) وإزالة الأقدم استخداماً (LRU)
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, generation=None):
+        # تُتجاهل القيم المقروءة قبل آخر إبطال حتى لا تعود بيانات قديمة للذاكرة
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+class CaptainIndex:
+    # فهرس في الذاكرة: (المدينة، الحي) -> معرفات الكباتن المتاحين، وقاعدة البيانات هي المرجع
+    def __init__(self):
+        self.loaded = False
+        self._areas = {}
+        self._service_areas = {}
+        self._captains = {}
+        self._lock = threading.Lock()
+
+    def _unlink(self, captain_id):
+        if self._captains.pop(captain_id, None) is None:
+            return
+        for key in self._service_areas.get(captain_id, ()):
+            ids = self._areas.get(key)
+            if ids is not None:
+                ids.discard(captain_id)
+                if not ids:
+                    del self._areas[key]
+
+    def _link(self, row):
+        captain_id = row['user_id']
+        self._captains[captain_id] = row
+        for key in self._service_areas.get(captain_id, ()):
+            self._areas.setdefault(key, set()).add(captain_id)
+
+    def load(self, rows, service_areas):
+        with self._lock:
+            self._areas = {}
+            self._captains = {}
+            self._service_areas = {}
+            for area in service_areas:
+                self._service_areas.setdefault(area['captain_id'], set()).add((area['city'], area['neighborhood']))
+            for row in rows:
+                self._link(dict(row))
+            self.loaded = True
+
+    def refresh(self, row):
+        if row is None:
+            return
+        with self._lock:
+            self._unlink(row['user_id'])
+            if row['role'] == 'captain' and row['is_available']:
+                self._link(dict(row))
+
+    def set_areas(self, captain_id, areas):
+        with self._lock:
+            row = self._captains.get(captain_id)
+            self._unlink(captain_id)
+            if areas:
+                self._service_areas[captain_id] = set(areas)
+            else:
+                self._service_areas.pop(captain_id, None)
+            if row is not None:
+                self._link(row)
+
+    def remove(self, captain_id):
+        with self._lock:
+            self._unlink(captain_id)
+            self._service_areas.pop(captain_id, None)
+
+    def get(self, captain_id):
+        with self._lock:
+            return self._captains.get(captain_id)
+
+    def find(self, city, neighborhood):
+        with self._lock:
+            rows = [self._captains[i] for i in self._areas.get((city, neighborhood), ())]
+        rows.sort(key=lambda row: row['created_at'])
+        return rows
+
+    def __len__(self):
+        return len(self._captains)
+
+class NeighborhoodCatalog:
+    # قائمة الأحياء تُقرأ من الملف مرة واحدة ولا يُعاد تحميلها إلا إذا تغيّر وقت تعديل الملف
+    def __init__(self, path):
+        self.path = path
+        self.version = 0
+        self.missing = True
+        self._mtime = None
+        self._data = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime and self.version:
+            return False
+        data = {}
+        if mtime is not None:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = {city: tuple(names) for city, names in json.load(f).items()}
+        with self._lock:
+            self._data = data
+            self._positions = {city: {name: i for i, name in enumerate(names)} for city, names in data.items()}
+            self._mtime = mtime
+            self.missing = mtime is None
+            self.version += 1
+        return True
+
+    def cities(self):
+        return tuple(self._data)
+
+    def get(self, city):
+        return self._data.get(city, ())
+
+    def contains(self, city, neighborhood):
+        return neighborhood in self._positions.get(city, ())
+
+    def encode(self, city, neighborhoods):
+        # ترميز مختصر (رقم المدينة ومواقع الأحياء) ليبقى callback_data تحت حد 64 بايت
+        cities = self.cities()
+        if city not in cities:
+            return None
+        positions = self._positions[city]
+        excluded = ".".join(str(positions[n]) for n in neighborhoods if n in positions)
+        return f"{cities.index(city)}_{excluded}"
+
+    def decode(self, token):
+        city_index, _, excluded = token.partition("_")
+        cities = self.cities()
+        city = cities[int(city_index)]
+        names = self.get(city)
+        return city, [names[int(i)] for i in excluded.split(".") if i]
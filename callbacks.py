@@ -0,0 +1,44 @@
+import hashlib
+import hmac
+from config import CALLBACK_SECRET, BOT_TOKEN
+
+_KEY = (CALLBACK_SECRET or BOT_TOKEN or "").encode()
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+# رقم الرحلة يُحمل في callback_data بصيغة مختصرة (أساس 36) مع توقيع HMAC مقتطع،
+# فيبقى الزر تحت حد 64 بايت ولا يمكن تزوير رقم رحلة لا يخص المستخدم
+def _base36(number):
+    digits = ""
+    while True:
+        number, remainder = divmod(number, 36)
+        digits = _DIGITS[remainder] + digits
+        if not number:
+            return digits
+
+def _signature(action, value):
+    return hmac.new(_KEY, f"{action}:{value}".encode(), hashlib.sha256).hexdigest()[:12]
+
+def sign_match(action, match_id, version=None):
+    # رقم إصدار الرحلة يُلحق بالرقم عند الحاجة، فيرفض الانتقال إذا تغيرت الرحلة بعد إرسال الزر
+    value = _base36(match_id) if version is None else f"{_base36(match_id)}-{_base36(version)}"
+    return f"{value}.{_signature(action, value)}"
+
+def _verify(action, token):
+    value, _, signature = token.partition(".")
+    if not value or not hmac.compare_digest(signature, _signature(action, value)):
+        return None
+    try:
+        return [int(part, 36) for part in value.split("-")]
+    except ValueError:
+        return None
+
+def verify_match(action, token):
+    parts = _verify(action, token)
+    return parts[0] if parts else None
+
+def verify_match_version(action, token):
+    # يعيد (رقم الرحلة، الإصدار)؛ الأزرار المرسلة قبل إضافة الإصدار تعيد None مكانه فلا يُفحص
+    parts = _verify(action, token)
+    if not parts or len(parts) > 2:
+        return None
+    return parts[0], parts[1] if len(parts) == 2 else None
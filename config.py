@@ -13,3 +13,109 @@ PG_PASSWORD = os.getenv("PGPASSWORD")
 SUPPORTED_CITIES = ['الرياض', 'جدة']
 MAX_RATING = 5
 MIN_RATING = 1
+
+# ==================== إعدادات مجمع الاتصالات ====================
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+PG_POOL_HEALTH_CHECK_INTERVAL = float(os.getenv("PG_POOL_HEALTH_CHECK_INTERVAL", "30"))
+
+# ==================== إعدادات النسخ المقروءة ====================
+# عناوين اتصال libpq مفصولة بفواصل، مثلاً: host=replica1 port=5433 dbname=rete user=bot,postgresql://bot@replica2/rete
+REPLICA_DSNS = [dsn.strip() for dsn in os.getenv("REPLICA_DSNS", "").split(",") if dsn.strip()]
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("REPLICA_LAG_CHECK_INTERVAL", "2"))
+READ_YOUR_WRITES_WINDOW = float(os.getenv("READ_YOUR_WRITES_WINDOW", "10"))
+
+# ==================== إعدادات التخزين المؤقت ====================
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+CAPTAIN_INDEX_REFRESH_INTERVAL = float(os.getenv("CAPTAIN_INDEX_REFRESH_INTERVAL", "300"))
+
+# ==================== إعدادات حالات المحادثة ====================
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "86400"))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.05"))
+FSM_CLEANUP_INTERVAL = float(os.getenv("FSM_CLEANUP_INTERVAL", "60"))
+
+# ==================== إعدادات استقبال التحديثات ====================
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8081"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "1"))
+WEBHOOK_CHAT_CONCURRENCY = int(os.getenv("WEBHOOK_CHAT_CONCURRENCY", "8"))
+
+# ==================== إعدادات الإرسال وحدود تيليجرام ====================
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "5"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+# cards: بطاقة لكل كابتن (السلوك الأصلي)، paginated: رسالة واحدة بصفحات يُتنقل بينها بالأزرار
+CAPTAIN_RESULTS_MODE = os.getenv("CAPTAIN_RESULTS_MODE", "cards")
+CAPTAIN_PAGE_SIZE = int(os.getenv("CAPTAIN_PAGE_SIZE", "5"))
+
+# ==================== إعدادات الإسناد التلقائي ====================
+# manual: قائمة الكباتن يختار منها العميل (السلوك الأصلي، وتُعرض حسب CAPTAIN_RESULTS_MODE)
+# auto: يرسل البوت الطلب لأنسب كابتن بنفسه؛ العروض المفتوحة تُحفظ في ذاكرة العملية فتضيع عند إعادة التشغيل
+DISPATCH_MODE = os.getenv("DISPATCH_MODE", "manual")
+DISPATCH_OFFER_TIMEOUT = float(os.getenv("DISPATCH_OFFER_TIMEOUT", "30"))
+DISPATCH_FANOUT = int(os.getenv("DISPATCH_FANOUT", "1"))
+DISPATCH_CANDIDATES = int(os.getenv("DISPATCH_CANDIDATES", "5"))
+DISPATCH_WEIGHT_RATING = float(os.getenv("DISPATCH_WEIGHT_RATING", "0.5"))
+DISPATCH_WEIGHT_IDLE = float(os.getenv("DISPATCH_WEIGHT_IDLE", "0.3"))
+DISPATCH_WEIGHT_AREA = float(os.getenv("DISPATCH_WEIGHT_AREA", "0.2"))
+
+# ==================== إعدادات الإحصائيات ====================
+STATS_RECONCILE_INTERVAL = float(os.getenv("STATS_RECONCILE_INTERVAL", "3600"))
+STATS_RECONCILE_ATTEMPTS = int(os.getenv("STATS_RECONCILE_ATTEMPTS", "5"))
+
+# ==================== إعدادات الأحياء ====================
+NEIGHBORHOODS_FILE = os.getenv("NEIGHBORHOODS_FILE", "neighborhoods.json")
+NEIGHBORHOODS_RELOAD_INTERVAL = float(os.getenv("NEIGHBORHOODS_RELOAD_INTERVAL", "10"))
+NEIGHBORHOOD_PAGE_SIZE = int(os.getenv("NEIGHBORHOOD_PAGE_SIZE", "40"))
+NEIGHBORHOOD_KEYBOARD_CACHE_SIZE = int(os.getenv("NEIGHBORHOOD_KEYBOARD_CACHE_SIZE", "256"))
+
+# ==================== إعدادات المراقبة ====================
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# ==================== إعدادات أرشفة الرحلات ====================
+MATCH_ARCHIVE_AFTER_DAYS = int(os.getenv("MATCH_ARCHIVE_AFTER_DAYS", "30"))
+MATCH_ARCHIVE_INTERVAL = float(os.getenv("MATCH_ARCHIVE_INTERVAL", "3600"))
+MATCH_ARCHIVE_BATCH_SIZE = int(os.getenv("MATCH_ARCHIVE_BATCH_SIZE", "5000"))
+
+# ==================== إعدادات أزرار الرحلات ====================
+CALLBACK_SECRET = os.getenv("CALLBACK_SECRET")
+
+# ==================== إعدادات حماية الضغط المتكرر ====================
+USER_RATE_LIMIT = float(os.getenv("USER_RATE_LIMIT", "3"))
+USER_RATE_BURST = int(os.getenv("USER_RATE_BURST", "10"))
+DUPLICATE_UPDATE_WINDOW = float(os.getenv("DUPLICATE_UPDATE_WINDOW", "1"))
+
+# ==================== إعدادات المطابقة بالموقع ====================
+MATCHING_MODE = os.getenv("MATCHING_MODE", "neighborhood")
+GEO_CELL_SIZE_KM = float(os.getenv("GEO_CELL_SIZE_KM", "1"))
+GEO_SEARCH_RADIUS_KM = float(os.getenv("GEO_SEARCH_RADIUS_KM", "5"))
+GEO_MAX_CAPTAINS = int(os.getenv("GEO_MAX_CAPTAINS", "10"))
+CAPTAIN_LOCATION_TTL = float(os.getenv("CAPTAIN_LOCATION_TTL", "900"))
+
+# ==================== إعدادات ناقل الأحداث ====================
+EVENT_BUS = os.getenv("EVENT_BUS", "postgres")
+EVENT_BUS_CHANNEL = os.getenv("EVENT_BUS_CHANNEL", "darbak_events")
+EVENT_BUS_RECONNECT_INTERVAL = float(os.getenv("EVENT_BUS_RECONNECT_INTERVAL", "5"))
+
+# ==================== إعدادات تجميع الكتابات ====================
+WRITE_BATCH_INTERVAL = float(os.getenv("WRITE_BATCH_INTERVAL", "0.003"))
+WRITE_BATCH_MAX = int(os.getenv("WRITE_BATCH_MAX", "256"))
+
+# ==================== إعدادات انتهاء الرحلات ====================
+PENDING_MATCH_TIMEOUT = float(os.getenv("PENDING_MATCH_TIMEOUT", "600"))
+STALE_TRIP_TIMEOUT = float(os.getenv("STALE_TRIP_TIMEOUT", "14400"))
+TIMING_WHEEL_TICK = float(os.getenv("TIMING_WHEEL_TICK", "1"))
+TIMING_WHEEL_SLOTS = int(os.getenv("TIMING_WHEEL_SLOTS", "64"))
+TIMING_WHEEL_LEVELS = int(os.getenv("TIMING_WHEEL_LEVELS", "4"))
@@ -0,0 +1,302 @@
+import argparse
+import asyncio
+import functools
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+from metrics import metrics, record_query
+from config import (PG_DB, PG_USER, PG_PASSWORD, PG_HOST, PG_PORT,
+                    PG_POOL_MIN, PG_POOL_MAX, PG_POOL_HEALTH_CHECK_INTERVAL,
+                    REPLICA_DSNS, REPLICA_MAX_LAG, READ_YOUR_WRITES_WINDOW)
+
+# التأخر بالثواني؛ صفر إذا لم تكن النسخة في وضع الاستعادة أو أعادت تطبيق كل ما استلمته
+REPLICA_LAG_SQL = """
+SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END AS lag
+"""
+
+class Replica:
+    # نسخة قراءة واحدة؛ lag=None تعني أنها غير متاحة أو لم تُفحص بعد فتذهب قراءاتها للأساسية
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.pool = None
+        self.lag = None
+
+    def connect(self):
+        if self.pool is None:
+            self.pool = psycopg2.pool.ThreadedConnectionPool(
+                PG_POOL_MIN, PG_POOL_MAX, dsn=self.dsn,
+                cursor_factory=psycopg2.extras.RealDictCursor
+            )
+        return self.pool
+
+    @property
+    def usable(self):
+        return self.lag is not None and self.lag <= REPLICA_MAX_LAG
+
+pool = None
+replicas = [Replica(dsn) for dsn in REPLICA_DSNS]
+_last_used = {}
+_recent_writes = {}
+_next_replica = 0
+# حالة التوجيه تُقرأ من خيوط run_db وتُعدّل من الحلقة ومن فحص النسخ الدوري
+_routing_lock = threading.Lock()
+_routes = threading.local()
+_executor = None
+_semaphore = None
+
+def get_conn():
+    return psycopg2.connect(
+        dbname=PG_DB, user=PG_USER, password=PG_PASSWORD,
+        host=PG_HOST, port=PG_PORT,
+        cursor_factory=psycopg2.extras.RealDictCursor
+    )
+
+def init_pool(minconn=PG_POOL_MIN, maxconn=PG_POOL_MAX + 1):
+    global pool
+    if pool is None:
+        # اتصال إضافي لخيط الكتابة المجمعة، فلا يصطدم بخيوط run_db الـ PG_POOL_MAX حين تكون كلها مشغولة
+        pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn, maxconn,
+            dbname=PG_DB, user=PG_USER, password=PG_PASSWORD,
+            host=PG_HOST, port=PG_PORT,
+            cursor_factory=psycopg2.extras.RealDictCursor
+        )
+    return pool
+
+def close_pool():
+    global pool, _executor, _semaphore
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+        _semaphore = None
+    if pool is not None:
+        pool.closeall()
+        pool = None
+        _last_used.clear()
+    for replica in replicas:
+        if replica.pool is not None:
+            replica.pool.closeall()
+            replica.pool = None
+        replica.lag = None
+
+def _release(target, conn, close=False):
+    close = close or bool(conn.closed)
+    if close:
+        _last_used.pop(id(conn), None)
+    else:
+        _last_used[id(conn)] = time.monotonic()
+    target.putconn(conn, close=close)
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    last_used = _last_used.get(id(conn))
+    if last_used is not None and time.monotonic() - last_used < PG_POOL_HEALTH_CHECK_INTERVAL:
+        return True
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        return True
+    except psycopg2.Error:
+        return False
+
+def _checkout(target):
+    for _ in range(target.maxconn + 1):
+        conn = target.getconn()
+        if _is_healthy(conn):
+            return conn
+        _release(target, conn, close=True)
+    raise psycopg2.OperationalError("no healthy database connection available")
+
+def note_write(*user_ids):
+    # قراءات هؤلاء المستخدمين تذهب للأساسية لفترة قصيرة حتى تلحق النسخ المقروءة بما كتبوه
+    now = time.monotonic()
+    with _routing_lock:
+        for user_id in user_ids:
+            if user_id is not None:
+                _recent_writes[user_id] = now
+
+def _count_route(route):
+    # metrics ليست آمنة للخيوط، فتُجمع مسارات القراءة هنا ويحتسبها run_db في حلقة الأحداث
+    routes = getattr(_routes, "current", None)
+    if routes is not None:
+        routes.append(route)
+
+def _pick_replica(user_id):
+    global _next_replica
+    with _routing_lock:
+        if user_id is not None:
+            written = _recent_writes.get(user_id)
+            if written is not None and time.monotonic() - written < READ_YOUR_WRITES_WINDOW:
+                _count_route("primary_recent_write")
+                return None
+        usable = [replica for replica in replicas if replica.usable]
+        if not usable:
+            _count_route("primary_lag")
+            return None
+        _next_replica += 1
+        return usable[_next_replica % len(usable)]
+
+def _route(replica, user_id):
+    source = _pick_replica(user_id) if replica and replicas else None
+    if source is not None:
+        try:
+            target = source.connect()
+            conn = _checkout(target)
+            _count_route("replica")
+            return target, conn
+        except psycopg2.Error as e:
+            # نستبعد النسخة حتى يؤكد الفحص التالي أنها عادت، ونكمل القراءة من الأساسية
+            source.lag = None
+            print(f"⚠️ تعذر الاتصال بالنسخة المقروءة، القراءة من الأساسية: {e}")
+    target = pool if pool is not None else init_pool()
+    return target, _checkout(target)
+
+@contextmanager
+def db_cursor(commit=False, replica=False, user_id=None):
+    # القراءات تعمل بوضع autocommit لتفادي جولة BEGIN/ROLLBACK إضافية
+    # replica=True يسمح بتوجيه القراءة لنسخة مقروءة، إلا إذا كتب المستخدم user_id مؤخراً
+    target, conn = _route(replica and not commit, user_id)
+    conn.autocommit = not commit
+    broken = False
+    try:
+        with conn.cursor() as cur:
+            yield cur
+        if commit:
+            conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    except BaseException:
+        if commit and not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        _release(target, conn, close=broken)
+
+def check_replicas():
+    # يُستدعى دورياً: يقيس تأخر كل نسخة ويحذف سجلات الكتابة التي تجاوزت نافذة القراءة من الأساسية
+    now = time.monotonic()
+    with _routing_lock:
+        for user_id, written in list(_recent_writes.items()):
+            if now - written >= READ_YOUR_WRITES_WINDOW:
+                del _recent_writes[user_id]
+    for replica in replicas:
+        try:
+            target = replica.connect()
+            conn = _checkout(target)
+        except psycopg2.Error as e:
+            if replica.lag is not None:
+                print(f"⚠️ النسخة المقروءة غير متاحة: {e}")
+            replica.lag = None
+            continue
+        broken = False
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(REPLICA_LAG_SQL)
+                lag = cur.fetchone()['lag']
+            replica.lag = float(lag) if lag is not None else None
+        except psycopg2.Error as e:
+            broken = True
+            replica.lag = None
+            print(f"⚠️ تعذر قياس تأخر النسخة المقروءة: {e}")
+        finally:
+            _release(target, conn, close=broken)
+    return [replica.lag for replica in replicas]
+
+def _collect_routes(routes, call):
+    _routes.current = routes
+    try:
+        return call()
+    finally:
+        _routes.current = None
+
+async def run_db(func, *args, **kwargs):
+    # تنفيذ دوال psycopg2 المتزامنة خارج حلقة الأحداث مع حد أقصى لعدد الاستعلامات المتزامنة
+    global _executor, _semaphore
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=PG_POOL_MAX, thread_name_prefix="db")
+        _semaphore = asyncio.Semaphore(PG_POOL_MAX)
+    queued = time.perf_counter()
+    async with _semaphore:
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        failed = True
+        routes = []
+        try:
+            result = await loop.run_in_executor(_executor, _collect_routes, routes, functools.partial(func, *args, **kwargs))
+            failed = False
+            return result
+        finally:
+            name = getattr(func, "__qualname__", type(func).__name__)
+            record_query(name, started - queued, time.perf_counter() - started, failed)
+            for route in routes:
+                metrics.inc("replica_reads", route=route)
+
+def benchmark_pool(calls, concurrency):
+    # نفس الاستعلام البسيط باتصال جديد لكل استدعاء (كما كان قبل المجمع) ثم عبر المجمع، بنفس عدد الخيوط
+    def fresh():
+        conn = get_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+        finally:
+            conn.close()
+
+    def pooled():
+        with db_cursor() as cur:
+            cur.execute("SELECT 1")
+            cur.fetchone()
+
+    def timed(func):
+        started = time.perf_counter()
+        func()
+        return time.perf_counter() - started
+
+    init_pool()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # تسخين المجمع حتى لا يُحسب فتح اتصالاته الأولى عليه
+        list(executor.map(lambda _: pooled(), range(concurrency)))
+        for label, func in (("اتصال لكل استدعاء", fresh), ("مجمع الاتصالات", pooled)):
+            started = time.perf_counter()
+            latencies = sorted(executor.map(lambda _: timed(func), range(calls)))
+            elapsed = time.perf_counter() - started
+            p99 = latencies[max(0, math.ceil(0.99 * len(latencies)) - 1)]
+            print(f"⏱️ {label}: {calls / elapsed:.0f} استدعاء/ث، متوسط {sum(latencies) / calls * 1000:.2f} ms، p99 {p99 * 1000:.2f} ms")
+
+def check_routing():
+    # فحص التوجيه مع نسختين محليتين: REPLICA_DSNS="port=5433 dbname=..." python db.py replicas
+    for replica, lag in zip(replicas, check_replicas()):
+        print(f"🔁 {replica.dsn}: {'غير متاحة' if lag is None else f'تأخر {lag:.2f} ث'}{'' if replica.usable else ' (مستبعدة)'}")
+    note_write(0)
+    for label, kwargs in (("كتابة", {"commit": True}), ("قراءة", {"replica": True}),
+                          ("قراءة بعد كتابة المستخدم", {"replica": True, "user_id": 0})):
+        with db_cursor(**kwargs) as cur:
+            cur.execute("SELECT inet_server_port() AS port, pg_is_in_recovery() AS standby")
+            row = cur.fetchone()
+        print(f"➡️ {label}: المنفذ {row['port']}{' (نسخة مقروءة)' if row['standby'] else ''}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="أدوات فحص وقياس اتصالات قاعدة البيانات")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("replicas", help="فحص تأخر النسخ المقروءة وتوجيه القراءات")
+    pool_parser = commands.add_parser("pool", help="قياس كلفة فتح اتصال لكل استدعاء مقابل المجمع")
+    pool_parser.add_argument("--calls", type=int, default=5000)
+    pool_parser.add_argument("--concurrency", type=int, default=PG_POOL_MAX, help="لا يتجاوز PG_POOL_MAX حتى لا ينتظر المجمع")
+    args = parser.parse_args()
+    try:
+        if args.command == "pool":
+            benchmark_pool(args.calls, min(args.concurrency, PG_POOL_MAX))
+        else:
+            check_routing()
+    finally:
+        close_pool()
@@ -0,0 +1,137 @@
+import asyncio
+import itertools
+import time
+from dataclasses import dataclass, field
+from config import (DISPATCH_OFFER_TIMEOUT, DISPATCH_FANOUT, DISPATCH_CANDIDATES,
+                    DISPATCH_WEIGHT_RATING, DISPATCH_WEIGHT_IDLE, DISPATCH_WEIGHT_AREA)
+
+@dataclass
+class RideRequest:
+    client: dict
+    destination: str
+    result: asyncio.Future
+    pickup: tuple = None
+    claiming: bool = False
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+@dataclass
+class Offer:
+    id: int
+    request: RideRequest
+    captain: dict
+    message: object = None
+    answered: bool = False
+
+class DispatchEngine:
+    # يرتب الكباتن حسب التقييم ومدة الانتظار وتطابق الحي ثم يعرض الرحلة على أفضلهم؛ أول قبول يفوز
+    def __init__(self, send_offer, revoke_offer, claim, offer_timeout=DISPATCH_OFFER_TIMEOUT,
+                 fanout=DISPATCH_FANOUT, candidates=DISPATCH_CANDIDATES):
+        self.send_offer = send_offer
+        self.revoke_offer = revoke_offer
+        self.claim = claim
+        self.offer_timeout = offer_timeout
+        self.fanout = fanout
+        self.candidates = candidates
+        self.offers = {}
+        self.offered_captains = set()
+        self.last_trip_end = {}
+        self.started = time.time()
+        self._ids = itertools.count(1)
+
+    def mark_idle(self, captain_id):
+        self.last_trip_end[captain_id] = time.time()
+
+    def score(self, captain, neighborhood, rating, now, distance=None):
+        # في المطابقة بالموقع يحل القرب محل تطابق الحي: 1 عند نقطة الالتقاط و0.5 على بعد كيلومتر
+        if distance is not None:
+            area = 1 / (1 + distance)
+        else:
+            area = 1.0 if captain['neighborhood'] == neighborhood else 0.5
+        idle = min((now - self.last_trip_end.get(captain['user_id'], self.started)) / 3600, 1.0)
+        return (DISPATCH_WEIGHT_RATING * (rating or 3.0) / 5
+                + DISPATCH_WEIGHT_IDLE * idle
+                + DISPATCH_WEIGHT_AREA * area)
+
+    def rank(self, captains, neighborhood, ratings, distances=None):
+        now = time.time()
+        distances = distances or {}
+        ranked = sorted(captains, key=lambda c: self.score(c, neighborhood, ratings.get(c['user_id']), now, distances.get(c['user_id'])), reverse=True)
+        return [c for c in ranked if c['user_id'] not in self.offered_captains][:self.candidates]
+
+    async def dispatch(self, client, destination, neighborhood, captains, ratings, distances=None, pickup=None):
+        request = RideRequest(client, destination, asyncio.get_running_loop().create_future(), pickup)
+        ranked = self.rank(captains, neighborhood, ratings, distances)
+        for i in range(0, len(ranked), self.fanout):
+            batch = [self._open(request, c) for c in ranked[i:i + self.fanout] if c['user_id'] not in self.offered_captains]
+            if not batch:
+                continue
+            await asyncio.gather(*(self._send(offer) for offer in batch))
+            match = await self._wait(request, batch)
+            await self._close(batch, match)
+            if match is not None:
+                return match
+        return None
+
+    def _open(self, request, captain):
+        offer = Offer(next(self._ids), request, captain)
+        self.offers[offer.id] = offer
+        self.offered_captains.add(captain['user_id'])
+        return offer
+
+    async def _send(self, offer):
+        try:
+            offer.message = await self.send_offer(offer)
+        except Exception as e:
+            offer.answered = True
+            print(f"⚠️ تعذر إرسال العرض للكابتن {offer.captain['user_id']}: {e}")
+
+    async def _wait(self, request, batch):
+        deadline = time.monotonic() + self.offer_timeout
+        while not request.result.done():
+            remaining = deadline - time.monotonic()
+            # إذا كان هناك قبول قيد الحجز في قاعدة البيانات ننتظر نتيجته حتى لو انتهت المهلة
+            if not request.claiming and (remaining <= 0 or all(offer.answered for offer in batch)):
+                return None
+            request.changed.clear()
+            try:
+                await asyncio.wait_for(request.changed.wait(), None if request.claiming else remaining)
+            except asyncio.TimeoutError:
+                pass
+        return request.result.result()
+
+    async def _close(self, batch, match):
+        for offer in batch:
+            self.offers.pop(offer.id, None)
+            self.offered_captains.discard(offer.captain['user_id'])
+        losers = [o for o in batch if o.message is not None and (match is None or o.captain['user_id'] != match['captain_id'])]
+        await asyncio.gather(*(self.revoke_offer(o, match is not None) for o in losers), return_exceptions=True)
+
+    async def accept(self, offer_id, captain_id):
+        # الزر يصل من أي محادثة يُعاد توجيهه إليها، فالقبول يُحسب فقط لمن أُرسل إليه العرض
+        offer = self.offers.get(offer_id)
+        if offer is None or offer.answered or offer.captain['user_id'] != captain_id:
+            return None
+        request = offer.request
+        if request.claiming or request.result.done():
+            return None
+        # الحجز في الذاكرة يتم قبل أي انتظار، لذا لا يمكن لقبولين أن يتقدما معاً
+        request.claiming = True
+        offer.answered = True
+        try:
+            match = await self.claim(request.client['user_id'], offer.captain['user_id'], request.destination)
+        finally:
+            request.claiming = False
+            request.changed.set()
+        if match is not None:
+            request.result.set_result(match)
+            offer.message = None
+        return match
+
+    def reject(self, offer_id, captain_id):
+        offer = self.offers.get(offer_id)
+        if offer is None or offer.captain['user_id'] != captain_id:
+            return False
+        offer.answered = True
+        offer.message = None
+        offer.request.changed.set()
+        return True
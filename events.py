@@ -0,0 +1,155 @@
+import argparse
+import asyncio
+import json
+import time
+import uuid
+import psycopg2
+from config import EVENT_BUS_CHANNEL, EVENT_BUS_RECONNECT_INTERVAL
+from db import get_conn
+from writer import after_commit
+
+class LocalEventBus:
+    # ناقل أحداث داخل العملية نفسها: يكفي لنسخة واحدة من البوت وللتجارب دون قاعدة بيانات
+    def __init__(self, channel=EVENT_BUS_CHANNEL):
+        self.channel = channel
+        self.origin = uuid.uuid4().hex[:12]
+        self.published = 0
+        self.received = 0
+        self._handlers = {}
+        self._loop = None
+
+    def subscribe(self, kind, handler):
+        self._handlers.setdefault(kind, []).append(handler)
+
+    def _event(self, kind, payload):
+        return {"type": kind, "origin": self.origin, "ts": time.time(), **payload}
+
+    def publish(self, cur, kind, **payload):
+        # يُستدعى من دوال البيانات داخل معاملتها، فيُؤجل الحدث حتى تحفظ الدفعة ويُهمل إن تراجعت كتابته كما في pg_notify
+        self.published += 1
+        if self._loop is None:
+            return
+        event = self._event(kind, payload)
+        if not after_commit(self.dispatch, event):
+            # خارج خط الكتابة المجمعة لا نعرف موعد الحفظ، فيُرسل الحدث فوراً
+            self._loop.call_soon_threadsafe(self.dispatch, event)
+
+    def dispatch(self, event):
+        self.received += 1
+        for handler in self._handlers.get(event.get("type"), ()):
+            try:
+                handler(event)
+            except Exception as e:
+                print(f"⚠️ خطأ في معالج الحدث {event.get('type')}: {e}")
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        await asyncio.Event().wait()
+
+class PostgresEventBus(LocalEventBus):
+    # الأحداث تُرسل بـ pg_notify داخل معاملة التغيير نفسها فلا تصل إلا بعد الحفظ، وتستقبلها كل النسخ عبر LISTEN
+    def __init__(self, channel=EVENT_BUS_CHANNEL, on_reconnect=None):
+        super().__init__(channel)
+        self.on_reconnect = on_reconnect
+        self.connected = False
+        self._conn = None
+        self._fd = None
+        self._lost = None
+
+    def publish(self, cur, kind, **payload):
+        cur.execute("SELECT pg_notify(%s, %s)", (self.channel, json.dumps(self._event(kind, payload), ensure_ascii=False)))
+        self.published += 1
+
+    def _connect(self):
+        conn = get_conn()
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f'LISTEN "{self.channel}"')
+        return conn
+
+    def _poll(self):
+        if self._lost.is_set():
+            return
+        try:
+            self._conn.poll()
+        except psycopg2.Error as e:
+            print(f"⚠️ انقطع الاستماع لأحداث قاعدة البيانات: {e}")
+            self._lost.set()
+            return
+        while self._conn.notifies:
+            notify = self._conn.notifies.pop(0)
+            try:
+                event = json.loads(notify.payload)
+            except ValueError:
+                continue
+            self.dispatch(event)
+
+    def _close(self):
+        if self._conn is not None:
+            self._loop.remove_reader(self._fd)
+            self._conn.close()
+            self._conn = None
+        self.connected = False
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        reconnecting = False
+        try:
+            while True:
+                try:
+                    self._conn = await asyncio.to_thread(self._connect)
+                except psycopg2.Error as e:
+                    print(f"⚠️ تعذر الاتصال للاستماع للأحداث: {e}")
+                    await asyncio.sleep(EVENT_BUS_RECONNECT_INTERVAL)
+                    continue
+                self._lost = asyncio.Event()
+                self._fd = self._conn.fileno()
+                self._loop.add_reader(self._fd, self._poll)
+                self.connected = True
+                if reconnecting and self.on_reconnect is not None:
+                    # ما فات أثناء الانقطاع لا يُعاد إرساله، فيعيد المشترك بناء حالته من قاعدة البيانات
+                    self.on_reconnect()
+                await self._lost.wait()
+                self._close()
+                reconnecting = True
+                await asyncio.sleep(EVENT_BUS_RECONNECT_INTERVAL)
+        finally:
+            self._close()
+
+async def measure_lag(args):
+    # عملية تستمع وأخرى ترسل: python events.py listen ثم python events.py ping
+    bus = PostgresEventBus()
+    lags = []
+
+    def on_ping(event):
+        lag = (time.time() - event["ts"]) * 1000
+        lags.append(lag)
+        print(f"📨 ping #{event['seq']} من {event['origin']}: {lag:.2f} ms")
+
+    bus.subscribe("ping", on_ping)
+    if args.command == "listen":
+        try:
+            await bus.run()
+        finally:
+            if lags:
+                lags.sort()
+                print(f"📊 {len(lags)} حدث: p50 {lags[len(lags) // 2]:.2f} ms، p99 {lags[int(len(lags) * 0.99)]:.2f} ms، الأقصى {lags[-1]:.2f} ms")
+        return
+    conn = await asyncio.to_thread(bus._connect)
+    try:
+        for seq in range(args.count):
+            with conn.cursor() as cur:
+                bus.publish(cur, "ping", seq=seq)
+            await asyncio.sleep(args.interval)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="قياس زمن وصول أحداث LISTEN/NOTIFY بين عمليتين")
+    parser.add_argument("command", choices=("listen", "ping"))
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--interval", type=float, default=0.05)
+    try:
+        asyncio.run(measure_lag(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,99 @@
+import argparse
+import random
+import re
+import time
+from db import get_conn
+from queries import STATEMENTS
+
+# جداول مؤقتة بنفس الأسماء تحجب الجداول الحقيقية داخل هذه الجلسة فقط، فلا يُقرأ أو يُعدّل أي صف حقيقي
+SETUP_SQL = """
+CREATE TEMP TABLE users (LIKE users INCLUDING DEFAULTS);
+CREATE TEMP TABLE captain_service_areas (LIKE captain_service_areas INCLUDING DEFAULTS);
+"""
+
+SEED_SQL = """
+INSERT INTO users (user_id, role, full_name, phone, city, neighborhood, neighborhood2, neighborhood3, is_available, created_at)
+SELECT g, 'captain', 'كابتن ' || g, '05' || lpad(g::text, 8, '0'), 'مدينة ' || g %% %(cities)s,
+       'حي ' || g / %(cities)s %% %(areas)s, 'حي ' || (g / %(cities)s * 7 + 1) %% %(areas)s,
+       'حي ' || (g / %(cities)s * 13 + 2) %% %(areas)s,
+       random() >= %(busy)s, now() - g * interval '1 second'
+FROM generate_series(1, %(captains)s) g;
+INSERT INTO users (user_id, role, full_name, phone, city, neighborhood, created_at)
+SELECT g, 'client', 'عميل ' || g, '05' || lpad(g::text, 8, '0'), 'مدينة ' || g %% %(cities)s, 'حي ' || g / %(cities)s %% %(areas)s, now()
+FROM generate_series(%(captains)s + 1, %(captains)s + %(clients)s) g;
+INSERT INTO captain_service_areas (city, neighborhood, captain_id, is_available)
+SELECT DISTINCT u.city, n, u.user_id, u.is_available
+FROM users u, unnest(ARRAY[u.neighborhood, u.neighborhood2, u.neighborhood3]) n
+WHERE u.role = 'captain';
+"""
+
+# الفهارس القديمة لمسح OR على أعمدة الأحياء الثلاثة كما كانت في init.sql، ثم فهارس جدول المناطق
+INDEX_SQL = """
+ALTER TABLE users ADD PRIMARY KEY (user_id);
+CREATE INDEX ON users (role, is_available, city);
+CREATE INDEX ON users (neighborhood, neighborhood2, neighborhood3);
+ALTER TABLE captain_service_areas ADD PRIMARY KEY (city, neighborhood, captain_id);
+CREATE INDEX ON captain_service_areas (city, neighborhood, captain_id) WHERE is_available;
+"""
+
+OLD_SQL = """
+SELECT * FROM users WHERE role='captain' AND is_available=TRUE AND city=%(p1)s
+AND (%(p2)s = neighborhood OR %(p2)s = neighborhood2 OR %(p2)s = neighborhood3)
+ORDER BY created_at ASC
+"""
+
+CASES = [
+    ("مسح OR القديم", OLD_SQL),
+    ("find_available_captains", re.sub(r"\$(\d+)", r"%(p\1)s", STATEMENTS["find_available_captains"][1])),
+    ("معرفات المنطقة فقط", "SELECT captain_id FROM captain_service_areas WHERE city = %(p1)s AND neighborhood = %(p2)s AND is_available"),
+]
+
+def run(args):
+    rng = random.Random(args.seed)
+    conn = get_conn()
+    # VACUUM لا يعمل داخل معاملة، وهو ما يملأ خريطة الرؤية ليصبح المسح Index Only Scan
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(SETUP_SQL)
+            started = time.perf_counter()
+            cur.execute(SEED_SQL, {"captains": args.captains, "clients": args.clients, "cities": args.cities,
+                                   "areas": args.areas, "busy": args.busy})
+            cur.execute(INDEX_SQL)
+            cur.execute("VACUUM ANALYZE users")
+            cur.execute("VACUUM ANALYZE captain_service_areas")
+            cur.execute("SELECT COUNT(*) FROM captain_service_areas")
+            rows = cur.fetchone()["count"]
+            print(f"🌱 {args.captains} كابتن و{args.clients} عميل و{rows} صف مناطق في {time.perf_counter() - started:.1f} ث")
+            params = {"p1": "مدينة 1", "p2": "حي 1"}
+            for label, sql in CASES:
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, params)
+                print(f"\n📋 {label}:")
+                for row in cur.fetchall():
+                    print("    " + row["QUERY PLAN"])
+            picks = [{"p1": f"مدينة {rng.randrange(args.cities)}", "p2": f"حي {rng.randrange(args.areas)}"}
+                     for _ in range(args.iterations)]
+            print(f"\n{'query':<26}{'mean ms':>10}{'p99 ms':>10}{'rows':>8}")
+            for label, sql in CASES:
+                latencies, found = [], 0
+                for pick in picks:
+                    started = time.perf_counter()
+                    cur.execute(sql, pick)
+                    found += len(cur.fetchall())
+                    latencies.append(time.perf_counter() - started)
+                latencies.sort()
+                p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+                print(f"{label:<26}{sum(latencies) / len(latencies) * 1000:>10.2f}{p99 * 1000:>10.2f}{found / len(picks):>8.0f}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="خطط وأزمنة البحث عن الكباتن: مسح OR القديم مقابل جدول captain_service_areas")
+    parser.add_argument("--captains", type=int, default=100_000)
+    parser.add_argument("--clients", type=int, default=100_000)
+    parser.add_argument("--cities", type=int, default=5)
+    parser.add_argument("--areas", type=int, default=60, help="عدد الأحياء في كل مدينة")
+    parser.add_argument("--busy", type=float, default=0.3, help="نسبة الكباتن غير المتاحين")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    run(parser.parse_args())
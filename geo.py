@@ -0,0 +1,155 @@
+import argparse
+import heapq
+import math
+import random
+import threading
+import time
+
+KM_PER_DEGREE = 111.32
+
+def distance_km(lat1, lon1, lat2, lon2):
+    # تقريب المسقط المستطيل؛ دقيق بما يكفي للمسافات داخل المدينة وأسرع من هافرساين
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.hypot(x, y) * 6371.0
+
+class GeoIndex:
+    # شبكة خلايا ثابتة في الذاكرة لمواقع الكباتن: تحديث الموقع O(1) والبحث يتوسع حلقة حلقة حول خلية الطلب
+    def __init__(self, cell_km):
+        self.cell_km = cell_km
+        self.cell = cell_km / KM_PER_DEGREE
+        self._cells = {}
+        self._points = {}
+        self._lock = threading.Lock()
+
+    def _cell_of(self, lat, lon):
+        return int(lat // self.cell), int(lon // self.cell)
+
+    def update(self, captain_id, lat, lon, expires):
+        cell = self._cell_of(lat, lon)
+        with self._lock:
+            old = self._points.get(captain_id)
+            if old is not None and old[2] != cell:
+                self._discard(captain_id, old[2])
+            if old is None or old[2] != cell:
+                self._cells.setdefault(cell, set()).add(captain_id)
+            self._points[captain_id] = (lat, lon, cell, expires)
+
+    def _discard(self, captain_id, cell):
+        ids = self._cells.get(cell)
+        if ids is not None:
+            ids.discard(captain_id)
+            if not ids:
+                del self._cells[cell]
+
+    def remove(self, captain_id):
+        with self._lock:
+            old = self._points.pop(captain_id, None)
+            if old is not None:
+                self._discard(captain_id, old[2])
+
+    def prune(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [i for i, point in self._points.items() if point[3] < now]
+            for captain_id in expired:
+                self._discard(captain_id, self._points.pop(captain_id)[2])
+        return len(expired)
+
+    def location(self, captain_id):
+        point = self._points.get(captain_id)
+        if point is None or point[3] < time.monotonic():
+            return None
+        return point[0], point[1]
+
+    def nearest(self, lat, lon, k, radius_km, accept=None):
+        now = time.monotonic()
+        ci, cj = self._cell_of(lat, lon)
+        # عرض الخلية بالكيلومتر يضيق مع خط العرض؛ نأخذ الأضيق ضمن نطاق البحث حتى لا نفوت أحداً
+        min_width = self.cell_km * math.cos(math.radians(min(abs(lat) + radius_km / KM_PER_DEGREE, 89)))
+        max_ring = math.ceil(radius_km / min_width) + 1
+        best = []
+        with self._lock:
+            for ring in range(max_ring + 1):
+                # كل نقطة في الحلقة r تبعد (r - 1) خلايا على الأقل عن نقطة الطلب
+                if len(best) >= k and (ring - 1) * min_width > -best[0][0]:
+                    break
+                for cell in self._ring(ci, cj, ring):
+                    for captain_id in self._cells.get(cell, ()):
+                        plat, plon, _, expires = self._points[captain_id]
+                        if expires < now:
+                            continue
+                        distance = distance_km(lat, lon, plat, plon)
+                        if distance > radius_km or (len(best) >= k and distance >= -best[0][0]):
+                            continue
+                        if accept is not None and not accept(captain_id):
+                            continue
+                        if len(best) >= k:
+                            heapq.heapreplace(best, (-distance, captain_id))
+                        else:
+                            heapq.heappush(best, (-distance, captain_id))
+        return [(captain_id, -d) for d, captain_id in sorted(best, reverse=True)]
+
+    @staticmethod
+    def _ring(ci, cj, ring):
+        if ring == 0:
+            yield ci, cj
+            return
+        for j in range(cj - ring, cj + ring + 1):
+            yield ci - ring, j
+            yield ci + ring, j
+        for i in range(ci - ring + 1, ci + ring):
+            yield i, cj - ring
+            yield i, cj + ring
+
+    def __len__(self):
+        return len(self._points)
+
+def benchmark(captains, rounds, queries, k, radius_km, cell_km, check, seed):
+    # كباتن يتحركون داخل مربع بحجم مدينة؛ كل جولة تحدّث كل المواقع ثم تنفذ طلبات بحث من نقاط عشوائية،
+    # وعينة من الطلبات تُقارن بالبحث الشامل للتأكد أن الشبكة لا تفوت أقرب كابتن
+    rng = random.Random(seed)
+    center_lat, center_lon, span = 24.7136, 46.6753, 0.25
+    index = GeoIndex(cell_km)
+    expires = time.monotonic() + 3600
+    points = {i: (center_lat + rng.uniform(-span, span), center_lon + rng.uniform(-span, span)) for i in range(captains)}
+    update_time, latencies, errors, checked = 0.0, [], 0, 0
+    for _ in range(rounds):
+        # نحو 30 كم/س خلال نبضة موقع مدتها 10 ثوان: خطوة حتى 100 متر تقريباً
+        for i, (lat, lon) in points.items():
+            points[i] = (lat + rng.uniform(-0.0009, 0.0009), lon + rng.uniform(-0.0009, 0.0009))
+        started = time.perf_counter()
+        for i, (lat, lon) in points.items():
+            index.update(i, lat, lon, expires)
+        update_time += time.perf_counter() - started
+        for q in range(queries):
+            lat, lon = center_lat + rng.uniform(-span, span), center_lon + rng.uniform(-span, span)
+            started = time.perf_counter()
+            found = index.nearest(lat, lon, k, radius_km)
+            latencies.append(time.perf_counter() - started)
+            if q < check:
+                checked += 1
+                expected = sorted(d for d in (distance_km(lat, lon, plat, plon) for plat, plon in points.values()) if d <= radius_km)[:k]
+                if len(found) != len(expected) or any(abs(d - e) > 1e-9 for (_, d), e in zip(found, expected)):
+                    errors += 1
+    latencies.sort()
+    p50, p99 = (latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1e6 for p in (0.5, 0.99))
+    updates = captains * rounds
+    print(f"📍 {captains} كابتن، خلية {cell_km} كم: {updates / update_time:,.0f} تحديث/ث ({update_time / updates * 1e9:.0f} ns/تحديث)")
+    print(f"🔎 أقرب {k} ضمن {radius_km} كم: {len(latencies) / sum(latencies):,.0f} بحث/ث، p50 {p50:.0f} us، p99 {p99:.0f} us")
+    print(f"{'✅' if not errors else '❌'} مقارنة بالبحث الشامل: {checked} طلب، نتائج مختلفة {errors}")
+    return not errors
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="قياس فهرس المواقع مع كباتن متحركين والتحقق منه بالبحث الشامل")
+    parser.add_argument("--captains", type=int, default=50_000)
+    parser.add_argument("--rounds", type=int, default=5, help="عدد جولات تحديث كل المواقع")
+    parser.add_argument("--queries", type=int, default=2000, help="طلبات بحث في كل جولة")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--radius", type=float, default=5.0)
+    parser.add_argument("--cell", type=float, default=1.0, help="حجم الخلية بالكيلومتر")
+    parser.add_argument("--check", type=int, default=20, help="طلبات كل جولة تُقارن بالبحث الشامل")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    ok = benchmark(args.captains, args.rounds, args.queries, args.k, args.radius, args.cell, args.check, args.seed)
+    raise SystemExit(0 if ok else 1)
@@ -1,4 +1,11 @@
 -- حذف الجداول الموجودة
+DROP TABLE IF EXISTS user_stats CASCADE;
+DROP TABLE IF EXISTS match_events CASCADE;
+DROP TABLE IF EXISTS ratings_archive CASCADE;
+DROP TABLE IF EXISTS matches_archive CASCADE;
+DROP TABLE IF EXISTS scheduled_messages CASCADE;
+DROP TABLE IF EXISTS fsm_storage CASCADE;
+DROP TABLE IF EXISTS captain_service_areas CASCADE;
 DROP TABLE IF EXISTS ratings CASCADE;
 DROP TABLE IF EXISTS matches CASCADE;
 DROP TABLE IF EXISTS users CASCADE;
@@ -7,6 +14,9 @@ DROP TABLE IF EXISTS users CASCADE;
 DROP FUNCTION IF EXISTS update_updated_at_column() CASCADE;
 DROP FUNCTION IF EXISTS save_rating(INTEGER, BIGINT, BIGINT, INTEGER, TEXT, TEXT, BOOLEAN) CASCADE;
 DROP FUNCTION IF EXISTS find_available_captains_in_area(TEXT, TEXT) CASCADE;
+DROP FUNCTION IF EXISTS sync_service_area_availability() CASCADE;
+DROP FUNCTION IF EXISTS apply_match_stats() CASCADE;
+DROP FUNCTION IF EXISTS apply_rating_stats() CASCADE;
 
 -- إنشاء جدول المستخدمين
 CREATE TABLE users (
@@ -27,6 +37,15 @@ CREATE TABLE users (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- إنشاء جدول مناطق عمل الكباتن (بدون حد أقصى لعدد الأحياء)
+CREATE TABLE captain_service_areas (
+    city TEXT NOT NULL,
+    neighborhood TEXT NOT NULL,
+    captain_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    is_available BOOLEAN NOT NULL DEFAULT TRUE,
+    PRIMARY KEY (city, neighborhood, captain_id)
+);
+
 -- إنشاء جدول المطابقات (بدون حقل عدد الركاب)
 CREATE TABLE matches (
     id SERIAL PRIMARY KEY,
@@ -38,7 +57,7 @@ CREATE TABLE matches (
     ),
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    CONSTRAINT unique_pending_match UNIQUE (client_id, captain_id)
+    version INTEGER NOT NULL DEFAULT 0
 );
 
 -- إنشاء جدول التقييمات مع الحقول الاختيارية
@@ -54,14 +73,102 @@ CREATE TABLE ratings (
     CONSTRAINT unique_rating UNIQUE (match_id, client_id)
 );
 
+-- سجل إلحاقي لكل تغيير في حالة الرحلة؛ بلا مفاتيح أجنبية حتى يبقى بعد أرشفة الرحلات
+CREATE TABLE match_events (
+    id BIGSERIAL PRIMARY KEY,
+    match_id INTEGER NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    previous_status VARCHAR(20),
+    client_id BIGINT,
+    captain_id BIGINT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- إنشاء جداول الأرشيف: الرحلات المنتهية القديمة وتقييماتها تُنقل إليها دورياً
+CREATE TABLE matches_archive (
+    id INTEGER PRIMARY KEY,
+    client_id BIGINT,
+    captain_id BIGINT,
+    destination TEXT,
+    status VARCHAR(20),
+    created_at TIMESTAMP,
+    updated_at TIMESTAMP,
+    version INTEGER NOT NULL DEFAULT 0,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE ratings_archive (
+    id INTEGER PRIMARY KEY,
+    match_id INTEGER,
+    client_id BIGINT,
+    captain_id BIGINT,
+    rating INTEGER,
+    comment TEXT,
+    notes TEXT,
+    created_at TIMESTAMP,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- إنشاء جدول ملخص الإحصائيات (يُحدَّث تلقائياً بالمحفزات)
+CREATE TABLE user_stats (
+    user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+    client_requests INTEGER NOT NULL DEFAULT 0,
+    client_completed INTEGER NOT NULL DEFAULT 0,
+    client_pending INTEGER NOT NULL DEFAULT 0,
+    client_cancelled INTEGER NOT NULL DEFAULT 0,
+    captain_requests INTEGER NOT NULL DEFAULT 0,
+    captain_completed INTEGER NOT NULL DEFAULT 0,
+    captain_active INTEGER NOT NULL DEFAULT 0,
+    rating_sum BIGINT NOT NULL DEFAULT 0,
+    rating_count INTEGER NOT NULL DEFAULT 0
+);
+
+-- إنشاء جدول حالات المحادثة (FSM) المشترك بين نسخ البوت
+CREATE TABLE fsm_storage (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data JSONB NOT NULL DEFAULT '{}',
+    expires_at TIMESTAMP NOT NULL
+);
+
+-- إنشاء جدول رسائل المتابعة المؤجلة حتى لا تضيع عند إعادة التشغيل
+CREATE TABLE scheduled_messages (
+    id SERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    calls JSONB NOT NULL,
+    due_at TIMESTAMP NOT NULL
+);
+
 -- إنشاء الفهارس لتحسين الأداء
 CREATE INDEX idx_available_captains ON users (role, is_available, city);
-CREATE INDEX idx_neighborhood_search ON users (neighborhood, neighborhood2, neighborhood3);
+CREATE INDEX idx_service_areas_available ON captain_service_areas (city, neighborhood, captain_id) WHERE is_available;
+CREATE INDEX idx_service_areas_captain ON captain_service_areas (captain_id);
 CREATE INDEX idx_active_matches ON matches (status, created_at);
 CREATE INDEX idx_client_matches ON matches (client_id, status);
 CREATE INDEX idx_captain_matches ON matches (captain_id, status);
+CREATE UNIQUE INDEX unique_pending_match ON matches (client_id, captain_id) WHERE status = 'pending';
 CREATE INDEX idx_ratings_captain ON ratings (captain_id, rating);
 CREATE INDEX idx_ratings_match ON ratings (match_id);
+CREATE INDEX idx_match_events_match ON match_events (match_id, id);
+CREATE INDEX idx_matches_archive_client ON matches_archive (client_id, created_at);
+CREATE INDEX idx_matches_archive_captain ON matches_archive (captain_id, created_at);
+CREATE INDEX idx_ratings_archive_captain ON ratings_archive (captain_id);
+CREATE INDEX idx_fsm_storage_expires ON fsm_storage (expires_at);
+CREATE INDEX idx_scheduled_messages_chat ON scheduled_messages (chat_id);
+
+-- مزامنة حالة التوفر في مناطق العمل مع جدول المستخدمين
+CREATE OR REPLACE FUNCTION sync_service_area_availability()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE captain_service_areas SET is_available = NEW.is_available
+    WHERE captain_id = NEW.user_id AND is_available IS DISTINCT FROM NEW.is_available;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER sync_service_area_availability
+    AFTER UPDATE OF is_available ON users
+    FOR EACH ROW EXECUTE FUNCTION sync_service_area_availability();
 
 -- إنشاء دالة تحديث updated_at
 CREATE OR REPLACE FUNCTION update_updated_at_column()
@@ -77,6 +184,70 @@ CREATE TRIGGER update_matches_updated_at
     BEFORE UPDATE ON matches
     FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
 
+-- تحديث ملخص الإحصائيات تدريجياً عند كل رحلة أو تقييم
+CREATE OR REPLACE FUNCTION apply_match_stats()
+RETURNS TRIGGER AS $$
+DECLARE
+    total_delta INTEGER := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE 0 END;
+    old_status TEXT := CASE WHEN TG_OP = 'UPDATE' THEN OLD.status END;
+BEGIN
+    IF NEW.client_id IS NOT NULL THEN
+        INSERT INTO user_stats AS s (user_id, client_requests, client_completed, client_pending, client_cancelled)
+        VALUES (NEW.client_id, total_delta,
+                (NEW.status = 'completed')::INT - COALESCE((old_status = 'completed')::INT, 0),
+                (NEW.status = 'pending')::INT - COALESCE((old_status = 'pending')::INT, 0),
+                (NEW.status = 'cancelled')::INT - COALESCE((old_status = 'cancelled')::INT, 0))
+        ON CONFLICT (user_id) DO UPDATE SET
+            client_requests = s.client_requests + EXCLUDED.client_requests,
+            client_completed = s.client_completed + EXCLUDED.client_completed,
+            client_pending = s.client_pending + EXCLUDED.client_pending,
+            client_cancelled = s.client_cancelled + EXCLUDED.client_cancelled;
+    END IF;
+    IF NEW.captain_id IS NOT NULL THEN
+        INSERT INTO user_stats AS s (user_id, captain_requests, captain_completed, captain_active)
+        VALUES (NEW.captain_id, total_delta,
+                (NEW.status = 'completed')::INT - COALESCE((old_status = 'completed')::INT, 0),
+                (NEW.status = 'in_progress')::INT - COALESCE((old_status = 'in_progress')::INT, 0))
+        ON CONFLICT (user_id) DO UPDATE SET
+            captain_requests = s.captain_requests + EXCLUDED.captain_requests,
+            captain_completed = s.captain_completed + EXCLUDED.captain_completed,
+            captain_active = s.captain_active + EXCLUDED.captain_active;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER match_stats_insert
+    AFTER INSERT ON matches
+    FOR EACH ROW EXECUTE FUNCTION apply_match_stats();
+
+CREATE TRIGGER match_stats_update
+    AFTER UPDATE OF status ON matches
+    FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status)
+    EXECUTE FUNCTION apply_match_stats();
+
+CREATE OR REPLACE FUNCTION apply_rating_stats()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.captain_id IS NOT NULL THEN
+        UPDATE user_stats SET rating_sum = rating_sum - COALESCE(OLD.rating, 0), rating_count = rating_count - (OLD.rating IS NOT NULL)::INT
+        WHERE user_id = OLD.captain_id;
+    END IF;
+    IF NEW.captain_id IS NOT NULL THEN
+        INSERT INTO user_stats AS s (user_id, rating_sum, rating_count)
+        VALUES (NEW.captain_id, COALESCE(NEW.rating, 0), (NEW.rating IS NOT NULL)::INT)
+        ON CONFLICT (user_id) DO UPDATE SET
+            rating_sum = s.rating_sum + EXCLUDED.rating_sum,
+            rating_count = s.rating_count + EXCLUDED.rating_count;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER rating_stats
+    AFTER INSERT OR UPDATE OF rating, captain_id ON ratings
+    FOR EACH ROW EXECUTE FUNCTION apply_rating_stats();
+
 -- دالة حفظ التقييم مع إمكانية تخطي الملاحظات
 CREATE OR REPLACE FUNCTION save_rating(
     p_match_id INTEGER,
@@ -124,6 +295,11 @@ UPDATE users SET
     neighborhood3 = 'الملك عبدالله'
 WHERE user_id = 987654321;
 
+INSERT INTO captain_service_areas (city, neighborhood, captain_id) VALUES
+('الرياض', 'الملك فهد', 987654321),
+('الرياض', 'العليا', 987654321),
+('الرياض', 'الملك عبدالله', 987654321);
+
 -- إنشاء view لإحصائيات الكباتن
 CREATE VIEW captain_stats AS
 SELECT 
@@ -132,16 +308,14 @@ SELECT
     u.car_model,
     u.car_plate,
     u.is_available,
-    COUNT(m.id) as total_rides,
-    COUNT(CASE WHEN m.status = 'completed' THEN 1 END) as completed_rides,
-    COUNT(CASE WHEN m.status = 'in_progress' THEN 1 END) as active_rides,
-    COALESCE(AVG(r.rating), 0) as average_rating,
-    COUNT(r.id) as total_ratings
+    COALESCE(s.captain_requests, 0) as total_rides,
+    COALESCE(s.captain_completed, 0) as completed_rides,
+    COALESCE(s.captain_active, 0) as active_rides,
+    COALESCE(s.rating_sum::NUMERIC / NULLIF(s.rating_count, 0), 0) as average_rating,
+    COALESCE(s.rating_count, 0) as total_ratings
 FROM users u
-LEFT JOIN matches m ON u.user_id = m.captain_id
-LEFT JOIN ratings r ON m.id = r.match_id
-WHERE u.role = 'captain'
-GROUP BY u.user_id, u.full_name, u.car_model, u.car_plate, u.is_available;
+LEFT JOIN user_stats s ON s.user_id = u.user_id
+WHERE u.role = 'captain';
 
 -- إنشاء view لإحصائيات العملاء
 CREATE VIEW client_stats AS
@@ -150,14 +324,13 @@ SELECT
     u.full_name,
     u.city,
     u.neighborhood,
-    COUNT(m.id) as total_requests,
-    COUNT(CASE WHEN m.status = 'completed' THEN 1 END) as completed_trips,
-    COUNT(CASE WHEN m.status = 'pending' THEN 1 END) as pending_requests,
-    COUNT(CASE WHEN m.status = 'cancelled' THEN 1 END) as cancelled_requests
+    COALESCE(s.client_requests, 0) as total_requests,
+    COALESCE(s.client_completed, 0) as completed_trips,
+    COALESCE(s.client_pending, 0) as pending_requests,
+    COALESCE(s.client_cancelled, 0) as cancelled_requests
 FROM users u
-LEFT JOIN matches m ON u.user_id = m.client_id
-WHERE u.role = 'client'
-GROUP BY u.user_id, u.full_name, u.city, u.neighborhood;
+LEFT JOIN user_stats s ON s.user_id = u.user_id
+WHERE u.role = 'client';
 
 -- إنشاء دالة للبحث عن الكباتن المتاحين
 CREATE OR REPLACE FUNCTION find_available_captains_in_area(
@@ -187,15 +360,14 @@ BEGIN
         u.neighborhood2,
         u.neighborhood3,
         COALESCE(AVG(r.rating), 0) as average_rating
-    FROM users u
+    FROM captain_service_areas a
+    JOIN users u ON u.user_id = a.captain_id
     LEFT JOIN matches m ON u.user_id = m.captain_id
     LEFT JOIN ratings r ON m.id = r.match_id
-    WHERE u.role = 'captain' 
-        AND u.is_available = TRUE 
-        AND u.city = search_city
-        AND (search_neighborhood = u.neighborhood 
-             OR search_neighborhood = u.neighborhood2 
-             OR search_neighborhood = u.neighborhood3)
+    WHERE a.city = search_city
+        AND a.neighborhood = search_neighborhood
+        AND a.is_available
+        AND u.role = 'captain'
     GROUP BY u.user_id, u.full_name, u.car_model, u.car_plate, u.phone, u.neighborhood, u.neighborhood2, u.neighborhood3
     ORDER BY u.created_at ASC;
 END;
@@ -204,11 +376,16 @@ $$ LANGUAGE plpgsql;
 -- إضافة تعليقات على الجداول
 COMMENT ON TABLE users IS 'جدول المستخدمين - العملاء والكباتن';
 COMMENT ON TABLE matches IS 'جدول المطابقات والطلبات';
+COMMENT ON TABLE captain_service_areas IS 'مناطق عمل الكباتن - صف لكل (مدينة، حي، كابتن)';
 COMMENT ON TABLE ratings IS 'جدول التقييمات مع التعليقات والملاحظات الاختيارية';
+COMMENT ON TABLE matches_archive IS 'أرشيف الرحلات المنتهية الأقدم من MATCH_ARCHIVE_AFTER_DAYS';
+COMMENT ON TABLE ratings_archive IS 'أرشيف تقييمات الرحلات المؤرشفة';
+COMMENT ON TABLE match_events IS 'سجل إلحاقي لانتقالات حالة الرحلات، يُكتب في معاملة الانتقال نفسها';
 
 COMMENT ON COLUMN ratings.comment IS 'تعليق العميل على الخدمة (اختياري)';
 COMMENT ON COLUMN ratings.notes IS 'ملاحظات خاصة من العميل (اختيارية)';
 COMMENT ON COLUMN matches.destination IS 'الوجهة المطلوبة للرحلة';
+COMMENT ON COLUMN matches.version IS 'رقم الإصدار للقفل المتفائل عند تغيير حالة الرحلة';
 COMMENT ON COLUMN users.is_available IS 'حالة توفر الكابتن';
 
 -- منح الصلاحيات (قم بتعديل اسم المستخدم حسب الحاجة)
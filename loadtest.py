@@ -0,0 +1,677 @@
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import math
+import os
+import random
+import time
+
+# البوت يتصل بخادم Bot API وهمي محلي، ولا توجد حدود إرسال حقيقية لمحاكاتها
+os.environ.setdefault("BOT_TOKEN", "123456:loadtest")
+os.environ.setdefault("METRICS_ENABLED", "false")
+os.environ.setdefault("TELEGRAM_GLOBAL_RATE", "100000")
+# المستخدمون الوهميون يكتبون أسرع من أي إنسان، فلا نريد أن يسقط حد المعدل خطوات التسجيل
+os.environ.setdefault("USER_RATE_LIMIT", "1000")
+os.environ.setdefault("USER_RATE_BURST", "1000")
+
+from aiohttp import ClientSession, web
+from aiogram import Dispatcher, methods
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Update
+import main
+from callbacks import sign_match
+from config import SUPPORTED_CITIES, DISPATCH_MODE, WEBHOOK_PATH, WEBHOOK_SECRET
+from db import db_cursor, init_pool, close_pool
+from events import LocalEventBus
+from metrics import current_update, record_query
+from scheduler import MessageScheduler, FollowUpMiddleware
+from storage import PostgresStorage
+from webhook import UpdateWorkers, create_webhook_app
+from writer import write_db
+
+# معرفات المستخدمين الوهميين تبدأ من هنا وتُحذف قبل الاختبار وبعده
+USER_ID_BASE = 9_000_000_000
+# مفاتيح قياس حالات المحادثة تحمل معرف بوت لا يوجد، فتُحذف دون لمس حالات البوت الحقيقي
+FSM_BENCH_BOT_ID = 0
+
+class NoCaptain(Exception):
+    pass
+
+class FakeBotAPI:
+    # خادم محلي يحاكي Bot API: يرد على كل الطرق ويحفظ ما يُرسل لكل محادثة ليتابعه المستخدم المحاكى
+    def __init__(self):
+        self.inbox = {}
+        self.calls = {}
+        self._signals = {}
+        self._message_ids = itertools.count(1)
+        self.updates = asyncio.Queue()
+
+    def _signal(self, chat_id):
+        return self._signals.setdefault(chat_id, asyncio.Event())
+
+    @staticmethod
+    def _ok(result):
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle(self, request):
+        method = request.match_info["method"].lower()
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getme":
+            return self._ok({"id": main.bot.id, "is_bot": True, "first_name": "loadtest", "username": "loadtest_bot"})
+        if method == "getupdates":
+            return self._ok(await self.next_updates(float(params.get("timeout") or 0)))
+        if method not in ("sendmessage", "editmessagetext", "editmessagereplymarkup"):
+            return self._ok(True)
+        chat_id = int(params["chat_id"])
+        message_id = int(params.get("message_id") or next(self._message_ids))
+        markup = json.loads(params["reply_markup"]) if params.get("reply_markup") else {}
+        text = params.get("text", "")
+        self.inbox.setdefault(chat_id, []).append({
+            "message_id": message_id, "text": text,
+            "buttons": [b["callback_data"] for row in markup.get("inline_keyboard", ()) for b in row if b.get("callback_data")],
+        })
+        self._signal(chat_id).set()
+        return self._ok({"message_id": message_id, "date": int(time.time()),
+                         "chat": {"id": chat_id, "type": "private"}, "text": text})
+
+    async def next_updates(self, timeout):
+        # long polling: ينتظر أول تحديث حتى المهلة ثم يعيد معه كل ما تراكم في الطابور
+        try:
+            updates = [await asyncio.wait_for(self.updates.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while not self.updates.empty() and len(updates) < 100:
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def wait_for(self, chat_id, match, since, timeout):
+        # يعيد أول رسالة بعد الموضع since تحقق الشرط، مع الموضع التالي لها
+        deadline = time.monotonic() + timeout
+        signal = self._signal(chat_id)
+        while True:
+            messages = self.inbox.get(chat_id, [])
+            for i in range(since, len(messages)):
+                if match(messages[i]):
+                    return messages[i], i + 1
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            signal.clear()
+            await asyncio.wait_for(signal.wait(), remaining)
+
+    async def start(self, host, port):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+class SimUser:
+    def __init__(self, harness, user_id):
+        self.harness = harness
+        self.id = user_id
+        self.cursor = 0
+        self.profile = {"id": user_id, "is_bot": False, "first_name": f"LT{user_id}", "username": f"lt{user_id}"}
+
+    def _message(self, message_id, text=""):
+        return {"message_id": message_id, "date": int(time.time()), "text": text,
+                "chat": {"id": self.id, "type": "private"}, "from": self.profile}
+
+    async def send(self, text):
+        await self.harness.feed({"message": self._message(next(self.harness.message_ids), text)})
+
+    async def press(self, data, message_id=None):
+        if message_id is None:
+            messages = self.harness.api.inbox.get(self.id)
+            message_id = messages[-1]["message_id"] if messages else 1
+        await self.harness.feed({"callback_query": {
+            "id": str(next(self.harness.message_ids)), "from": self.profile, "chat_instance": str(self.id),
+            "data": data, "message": self._message(message_id),
+        }})
+
+    async def expect(self, match, timeout=None):
+        message, self.cursor = await self.harness.api.wait_for(self.id, match, self.cursor, timeout or self.harness.timeout)
+        return message
+
+    async def expect_button(self, prefixes, timeout=None):
+        message = await self.expect(lambda m: any(b.startswith(prefixes) for b in m["buttons"]), timeout)
+        return message, next(b for b in message["buttons"] if b.startswith(prefixes))
+
+class UpdateTracker:
+    # في وضعي webhook وpolling يُعالج التحديث في مهمة أخرى، فيُنتظر انتهاؤه عبر هذا الوسيط
+    # ويُربط بنطاق التدفق الذي أرسله ليُحتسب عليه زمن المعالج واستعلاماته كما في الإدخال المباشر
+    def __init__(self):
+        self.pending = {}
+
+    def expect(self, update_id):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[update_id] = (future, current_update.get())
+        return future
+
+    async def __call__(self, handler, event, data):
+        future, scope = self.pending.pop(event.update_id, (None, None))
+        token = current_update.set(scope)
+        try:
+            result = await handler(event, data)
+        except Exception as e:
+            if future is not None and not future.done():
+                future.set_exception(e)
+            raise
+        finally:
+            current_update.reset(token)
+        if future is not None and not future.done():
+            future.set_result(result)
+        return result
+
+class FlowStats:
+    def __init__(self):
+        self.latencies = []
+        self.queries = []
+        self.errors = 0
+        self.unmatched = 0
+        self.first = None
+        self.last = None
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.timeout = args.timeout
+        self.api = FakeBotAPI()
+        self.stats = {}
+        self.error_types = {}
+        self.message_ids = itertools.count(1)
+        self.update_ids = itertools.count(1)
+        self.stop = asyncio.Event()
+        self.writes = self.commits = 0
+        self.race_failures = []
+        self.tracker = UpdateTracker()
+        self.workers = None
+        self.http = None
+        self.sent = 0
+        self.backpressure = 0
+        self.random = random.Random(args.seed)
+        self.city = SUPPORTED_CITIES[0]
+        self.areas = list(main.neighborhood_catalog.get(self.city)[:args.areas])
+
+    async def feed(self, payload):
+        payload["update_id"] = next(self.update_ids)
+        self.sent += 1
+        if self.args.ingest == "feed":
+            await main.dp.feed_update(main.bot, Update.model_validate(payload, context={"bot": main.bot}))
+            return
+        done = self.tracker.expect(payload["update_id"])
+        if self.args.ingest == "webhook":
+            await self.post_update(payload)
+        else:
+            self.api.updates.put_nowait(payload)
+        try:
+            await asyncio.wait_for(done, self.timeout)
+        finally:
+            self.tracker.pending.pop(payload["update_id"], None)
+
+    async def post_update(self, payload):
+        # يتصرف كتيليجرام: عند 503 ينتظر Retry-After ثم يعيد إرسال التحديث نفسه
+        url = f"http://{self.args.host}:{self.args.port + 1}{WEBHOOK_PATH}"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET} if WEBHOOK_SECRET else None
+        while True:
+            async with self.http.post(url, json=payload, headers=headers) as response:
+                if response.status != 503:
+                    response.raise_for_status()
+                    return
+                self.backpressure += 1
+                await asyncio.sleep(float(response.headers.get("Retry-After", "1")))
+
+    async def start_ingest(self):
+        if self.args.ingest == "polling":
+            main.dp.update.outer_middleware(self.tracker)
+            # start_polling يطلق أحداث البدء والإيقاف بنفسه
+            return asyncio.create_task(main.dp.start_polling(main.bot, handle_signals=False, close_bot_session=False))
+        await main.dp.emit_startup(bot=main.bot, dispatcher=main.dp)
+        if self.args.ingest != "webhook":
+            return None
+        main.dp.update.outer_middleware(self.tracker)
+        self.workers = UpdateWorkers(main.dp, main.bot)
+        self.workers.start()
+        runner = web.AppRunner(create_webhook_app(self.workers))
+        await runner.setup()
+        await web.TCPSite(runner, self.args.host, self.args.port + 1).start()
+        self.http = ClientSession()
+        return runner
+
+    async def stop_ingest(self, ingest):
+        if self.args.ingest == "polling":
+            await main.dp.stop_polling()
+            await ingest
+            return
+        if ingest is not None:
+            await self.http.close()
+            await ingest.cleanup()
+            await self.workers.stop()
+        await main.dp.emit_shutdown(bot=main.bot, dispatcher=main.dp)
+
+    async def flow(self, name, steps):
+        # كل تدفق يقيس زمنه وعدد استعلاماته عبر نطاق current_update الذي يحتسبه run_db
+        stats = self.stats.setdefault(name, FlowStats())
+        scope = {"queries": 0, "db_seconds": 0.0, "parent": None}
+        token = current_update.set(scope)
+        started = time.perf_counter()
+        stats.first = stats.first or started
+        try:
+            await steps()
+        except NoCaptain:
+            stats.unmatched += 1
+            return "unmatched"
+        except Exception as e:
+            stats.errors += 1
+            self.count_error(f"{name}: {type(e).__name__}")
+            return "error"
+        else:
+            stats.latencies.append(time.perf_counter() - started)
+            stats.queries.append(scope["queries"])
+        finally:
+            stats.last = time.perf_counter()
+            current_update.reset(token)
+        return "ok"
+
+    def count_error(self, error):
+        self.error_types[error] = self.error_types.get(error, 0) + 1
+
+    async def register(self, user, role, index):
+        await user.send("/start")
+        await user.press(f"role_{role}")
+        await user.press("sub_daily")
+        await user.send(f"{'كابتن' if role == 'captain' else 'عميل'} تجريبي {index}")
+        await user.send(f"05{user.id % 10 ** 8:08d}")
+        if role == "captain":
+            await user.send("كامري 2020")
+            await user.send(f"أ ب ج {index % 10000:04d}")
+        await user.press("agree")
+        await user.press(f"city_{self.city}")
+        neighborhoods = self.random.sample(self.areas, 3) if role == "captain" else [self.random.choice(self.areas)]
+        for neighborhood in neighborhoods:
+            await user.press(f"neigh_{neighborhood}")
+        if role == "captain":
+            await user.send("🟢 متاح للعمل")
+
+    async def request_ride(self, client):
+        await client.send("🚕 طلب توصيلة")
+        await client.send(f"وجهة تجريبية {client.id}")
+        if DISPATCH_MODE != "auto":
+            message = await client.expect(lambda m: m["text"].startswith("😔") or any(b.startswith("choose_") for b in m["buttons"]))
+            if message["text"].startswith("😔"):
+                raise NoCaptain
+            await client.press(next(b for b in message["buttons"] if b.startswith("choose_")), message["message_id"])
+        message = await client.expect(lambda m: m["text"].startswith(("🎉 الكابتن وافق", "😔")))
+        if message["text"].startswith("😔"):
+            raise NoCaptain
+
+    async def rate(self, client, message):
+        await client.press(next(b for b in message["buttons"] if b.startswith("rate_5_")), message["message_id"])
+        await client.press("skip_note", message["message_id"])
+
+    async def client_session(self, index, limiter):
+        client = SimUser(self, USER_ID_BASE + self.args.captains + index)
+        async with limiter:
+            if await self.flow("register_client", lambda: self.register(client, "client", index)) != "ok":
+                return
+            for _ in range(self.args.rides):
+                result = await self.flow("ride_request", lambda: self.request_ride(client))
+                if result == "error":
+                    return
+                if result == "unmatched":
+                    continue
+                try:
+                    message, _ = await client.expect_button("rate_")
+                except asyncio.TimeoutError:
+                    self.count_error("rating: no prompt")
+                    continue
+                await self.flow("rating", lambda: self.rate(client, message))
+
+    async def captain_loop(self, captain):
+        # الكابتن يقبل أي عرض يصله بعد زمن تفكير عشوائي، ثم ينهي الرحلة بعد مدة قصيرة
+        while not self.stop.is_set():
+            try:
+                offer, data = await captain.expect_button(("offer_accept_", "captain_accept_"), timeout=1)
+            except asyncio.TimeoutError:
+                continue
+            await asyncio.sleep(self.random.uniform(0, self.args.think))
+            await self.flow("captain_accept", lambda: captain.press(data, offer["message_id"]))
+            try:
+                trip = await self.await_trip(captain)
+            except asyncio.TimeoutError:
+                continue
+            if not trip["buttons"]:
+                continue
+            await asyncio.sleep(self.random.uniform(0, self.args.trip))
+            await self.flow("captain_complete", lambda: captain.press(trip["buttons"][0], trip["message_id"]))
+
+    async def race(self):
+        # عدة عملاء يتسابقون على كابتن واحد بثلاثة مسارات: أزرار القبول عبر البوت مع نقرتين على كل زر،
+        # والحجز المباشر claim_ride، وقبول من اتصالات منفصلة تتزاحم على أقفال الصفوف؛ في كل مسار تفوز رحلة واحدة فقط
+        count = self.args.race
+        captains = [SimUser(self, USER_ID_BASE + i) for i in range(3)]
+        clients = [SimUser(self, USER_ID_BASE + len(captains) + i) for i in range(count)]
+        await asyncio.gather(*(self.flow("register_captain", lambda c=c, i=i: self.register(c, "captain", i)) for i, c in enumerate(captains)))
+        await asyncio.gather(*(self.flow("register_client", lambda c=c, i=i: self.register(c, "client", i)) for i, c in enumerate(clients)))
+        buttons, claimed, direct = (captain.id for captain in captains)
+
+        pending = await asyncio.gather(*(main.create_match_request(client.id, buttons, "سباق") for client in clients))
+        presses = [f"captain_accept_{sign_match('captain_accept', match['id'], match['version'])}" for match in pending for _ in range(2)]
+        await asyncio.gather(*(self.flow("race_accept", lambda data=data: captains[0].press(data)) for data in presses))
+        announced = sum(1 for client in clients for m in self.api.inbox.get(client.id, ()) if m["text"].startswith("🎉 الكابتن وافق"))
+        self.check_race("buttons", buttons, announced)
+
+        claims = await asyncio.gather(*(main.claim_ride(client.id, claimed, "سباق") for client in clients))
+        self.check_race("claim_ride", claimed, sum(1 for match in claims if match))
+
+        pending = await asyncio.gather(*(main.create_match_request(client.id, direct, "سباق") for client in clients))
+        accepts = await asyncio.gather(*(main.run_db(accept_directly, match['id'], direct, match['version']) for match in pending for _ in range(2)))
+        self.check_race("connections", direct, sum(1 for match in accepts if match))
+
+    def check_race(self, name, captain_id, winners):
+        with db_cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM matches WHERE captain_id = %s AND status = 'in_progress'", (captain_id,))
+            trips = cur.fetchone()["count"]
+        ok = winners == 1 and trips == 1
+        print(f"{'✅' if ok else '❌'} سباق {name}: {self.args.race} عميل، فائزون {winners}، رحلات جارية للكابتن {trips}")
+        if not ok:
+            self.race_failures.append(name)
+
+    async def await_trip(self, captain):
+        # عرض من بحث سابق قد يصل بعد قبول الكابتن لرحلة أخرى؛ يرفضه فوراً كالكابتن المشغول بدل تجاوزه حتى تنتهي مهلته
+        while True:
+            message = await captain.expect(lambda m: m["text"].startswith(("⌛", "⚠️"))
+                                           or any(b.startswith(("complete_trip_", "offer_reject_")) for b in m["buttons"]))
+            reject = next((b for b in message["buttons"] if b.startswith("offer_reject_")), None)
+            if reject is None:
+                return message
+            await captain.press(reject, message["message_id"])
+
+    async def run(self):
+        runner = await self.api.start(self.args.host, self.args.port)
+        main.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://{self.args.host}:{self.args.port}"))
+        ingest = await self.start_ingest()
+        started = time.perf_counter()
+        try:
+            if self.args.race:
+                await self.race()
+            else:
+                await self.simulate()
+            await asyncio.gather(*main.running_tasks, return_exceptions=True)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.writes, self.commits = main.writer_stats()
+            await self.stop_ingest(ingest)
+            if hasattr(main.dp.storage, "close"):
+                await main.dp.storage.close()
+            await main.bot.session.close()
+            await runner.cleanup()
+        self.report(elapsed)
+
+    async def simulate(self):
+        limiter = asyncio.Semaphore(self.args.concurrency)
+        captains = [SimUser(self, USER_ID_BASE + i) for i in range(self.args.captains)]
+
+        async def register_captain(index, captain):
+            async with limiter:
+                await self.flow("register_captain", lambda: self.register(captain, "captain", index))
+
+        await asyncio.gather(*(register_captain(i, c) for i, c in enumerate(captains)))
+        loops = [asyncio.create_task(self.captain_loop(c)) for c in captains]
+        await asyncio.gather(*(self.client_session(i, limiter) for i in range(self.args.clients)))
+        self.stop.set()
+        await asyncio.gather(*loops)
+
+    def report(self, elapsed):
+        print(f"\n📊 نتائج اختبار الحمل: {self.args.captains} كابتن، {self.args.clients} عميل، {elapsed:.1f} ثانية")
+        if self.args.slow_query or self.args.blocking:
+            slow = f"{self.args.slow_query} +{self.args.slow_ms:g} ms" if self.args.slow_query else "بلا استعلام بطيء"
+            print(f"⚙️ {slow}، الاستعلامات {'تحجب حلقة الأحداث' if self.args.blocking else 'عبر run_db'}")
+        print(f"{'flow':<18}{'ok':>7}{'err':>6}{'none':>6}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'db q':>7}")
+        for name, stats in self.stats.items():
+            window = (stats.last - stats.first) if stats.first else 0
+            rps = len(stats.latencies) / window if window > 0 else 0.0
+            queries = sum(stats.queries) / len(stats.queries) if stats.queries else 0.0
+            p50, p95, p99 = (percentile(stats.latencies, p) * 1000 for p in (50, 95, 99))
+            print(f"{name:<18}{len(stats.latencies):>7}{stats.errors:>6}{stats.unmatched:>6}{rps:>9.1f}{p50:>9.1f}{p95:>9.1f}{p99:>9.1f}{queries:>7.1f}")
+        rejected = f"، رفض 503: {self.backpressure}" if self.args.ingest == "webhook" else ""
+        print(f"\nاستقبال التحديثات ({self.args.ingest}): {self.sent} تحديث ({self.sent / elapsed:.1f}/ث){rejected}")
+        total_calls = sum(self.api.calls.values())
+        print(f"طلبات Bot API: {total_calls} ({total_calls / elapsed:.1f}/ث)")
+        if self.commits:
+            print(f"الكتابات: {self.writes} ({self.writes / elapsed:.1f}/ث) في {self.commits} معاملة ({self.commits / elapsed:.1f}/ث)، بمعدل {self.writes / self.commits:.1f} كتابة لكل حفظ")
+        for error, count in sorted(self.error_types.items()):
+            print(f"⚠️ {error}: {count}")
+
+async def fsm_benchmark(keys, rounds):
+    # كل مفتاح يمر بخطوات كالتسجيل: تعيين الحالة والبيانات ثم قراءتهما، ثم قراءة باردة من مخزن جديد بعد الحفظ
+    storage_keys = [StorageKey(bot_id=FSM_BENCH_BOT_ID, chat_id=USER_ID_BASE + i, user_id=USER_ID_BASE + i) for i in range(keys)]
+    print(f"\n📊 حالات المحادثة: {keys} مفتاح × {rounds} خطوة")
+    print(f"{'storage':<10}{'op':<10}{'ops':>8}{'ops/s':>10}{'p50 us':>9}{'p99 us':>9}")
+    for label, storage in (("memory", MemoryStorage()), ("postgres", PostgresStorage())):
+        timings = {"set": [], "get": []}
+
+        async def step(key, number):
+            started = time.perf_counter()
+            await storage.set_state(key, f"Bench:step{number}")
+            await storage.set_data(key, {"step": number, "city": "bench"})
+            timings["set"].append(time.perf_counter() - started)
+            started = time.perf_counter()
+            await storage.get_state(key)
+            await storage.get_data(key)
+            timings["get"].append(time.perf_counter() - started)
+
+        async def session(key):
+            for number in range(rounds):
+                await step(key, number)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(session(key) for key in storage_keys))
+        elapsed = time.perf_counter() - started
+        if isinstance(storage, PostgresStorage):
+            started = time.perf_counter()
+            await storage.flush()
+            print(f"💾 حفظ ما تبقى في المخزن المؤجل: {(time.perf_counter() - started) * 1000:.1f} ms")
+            cold = PostgresStorage()
+
+            async def read(key):
+                started = time.perf_counter()
+                await cold.get_state(key)
+                await cold.get_data(key)
+                timings.setdefault("cold get", []).append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(read(key) for key in storage_keys))
+            cold_elapsed = time.perf_counter() - started
+        await storage.close()
+        for op, values in timings.items():
+            window = cold_elapsed if op == "cold get" else elapsed
+            p50, p99 = (percentile(values, p) * 1e6 for p in (50, 99))
+            print(f"{label:<10}{op:<10}{len(values):>8}{len(values) / window:>10.0f}{p50:>9.0f}{p99:>9.0f}")
+
+async def check_fsm_close():
+    # حالة عُيّنت ولم يحن موعد حفظها الدوري يجب أن تبقى بعد إيقاف البوت وإعادة تشغيله
+    storage = main.dp.storage
+    if not isinstance(storage, PostgresStorage):
+        return None
+    key = StorageKey(bot_id=FSM_BENCH_BOT_ID, chat_id=USER_ID_BASE, user_id=USER_ID_BASE)
+    storage.flush_interval = 3600
+    await storage.set_state(key, "Check:pending")
+    await storage.set_data(key, {"step": 1})
+    await main.on_shutdown()
+    reopened = PostgresStorage()
+    return (await reopened.get_state(key), await reopened.get_data(key)) == ("Check:pending", {"step": 1})
+
+def publish_then(cur, bus, fail):
+    cur.execute("SELECT 1")
+    bus.publish(cur, "check", fail=fail)
+    if fail:
+        raise ValueError("rollback")
+
+async def check_event_rollback():
+    # الكتابة التي تتراجع (وحدها أو داخل دفعة بنقطة حفظ) يجب ألا يصل حدثها للمشتركين
+    bus = LocalEventBus()
+    received = []
+    bus.subscribe("check", lambda event: received.append(event["fail"]))
+    task = asyncio.create_task(bus.run())
+    await asyncio.sleep(0)
+    try:
+        await asyncio.gather(write_db(publish_then, bus, True), write_db(publish_then, bus, False), return_exceptions=True)
+        await asyncio.gather(write_db(publish_then, bus, True), return_exceptions=True)
+        await asyncio.sleep(0.05)
+    finally:
+        task.cancel()
+    return received == [False]
+
+async def check_follow_up_cancel():
+    # رسالة متابعة مجدولة لمحادثة انتقل صاحبها لخطوة أخرى يجب ألا تُرسل، ومتابعة محادثة أخرى تُرسل كالمعتاد
+    sent = []
+
+    class Recorder:
+        async def send(self, chat_id, call):
+            sent.append(chat_id)
+
+    follow_ups = MessageScheduler(main.bot, Recorder())
+    dp = Dispatcher()
+    dp.message.outer_middleware(FollowUpMiddleware(follow_ups))
+
+    @dp.message()
+    async def next_step(message, state):
+        await state.set_state("Check:next")
+
+    moved, idle = USER_ID_BASE, USER_ID_BASE + 1
+    for chat_id in (moved, idle):
+        await follow_ups.schedule(chat_id, 0.2, methods.SendMessage(chat_id=chat_id, text="متابعة"))
+    await dp.feed_update(main.bot, Update.model_validate({"update_id": 1, "message": {
+        "message_id": 1, "date": 0, "text": "الخطوة التالية",
+        "chat": {"id": moved, "type": "private"}, "from": {"id": moved, "is_bot": False, "first_name": "فحص"}}}))
+    await asyncio.sleep(0.3)
+    await follow_ups.close()
+    return sent == [idle] and await dp.storage.get_state(StorageKey(main.bot.id, moved, moved)) == "Check:next"
+
+CHECKS = [
+    ("حفظ حالة المحادثة عند الإيقاف", check_fsm_close),
+    ("عدم نشر أحداث الكتابات المتراجعة", check_event_rollback),
+    ("إلغاء رسائل المتابعة عند الانتقال لخطوة أخرى", check_follow_up_cancel),
+]
+
+async def run_checks():
+    failures = 0
+    for name, check in CHECKS:
+        try:
+            ok = await check()
+        except Exception as e:
+            print(f"❌ {name}: {type(e).__name__}: {e}")
+            failures += 1
+            continue
+        if ok is None:
+            print(f"⏭️ {name}: غير مفعّل في الإعدادات الحالية")
+            continue
+        print(f"{'✅' if ok else '❌'} {name}")
+        failures += not ok
+    return failures
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)] if ordered else 0.0
+
+def slow_down(name, ms):
+    # يسبق دالة البيانات المختارة بـ pg_sleep على نفس الاتصال، ليظهر أثر استعلام بطيء على بقية المعالجات
+    func = getattr(main, name)
+
+    @functools.wraps(func)
+    def slowed(*args, **kwargs):
+        with db_cursor() as cur:
+            cur.execute("SELECT pg_sleep(%s)", (ms / 1000,))
+        return func(*args, **kwargs)
+
+    setattr(main, name, slowed)
+
+async def run_inline(func, *args, **kwargs):
+    # كما كان البوت قبل run_db: الاستعلام يعمل داخل حلقة الأحداث ويوقف كل المعالجات حتى ينتهي
+    started = time.perf_counter()
+    failed = True
+    try:
+        result = func(*args, **kwargs)
+        failed = False
+        return result
+    finally:
+        record_query(getattr(func, "__qualname__", type(func).__name__), 0, time.perf_counter() - started, failed)
+
+def apply_options(args):
+    if args.slow_query:
+        if not callable(getattr(main, args.slow_query, None)) or asyncio.iscoroutinefunction(getattr(main, args.slow_query)):
+            raise SystemExit(f"❌ {args.slow_query} ليست دالة بيانات متزامنة في main")
+        slow_down(args.slow_query, args.slow_ms)
+    if args.blocking:
+        main.run_db = run_inline
+
+def accept_directly(match_id, captain_id, version):
+    # قبول من اتصال مستقل خارج خيط الكتابة المجمعة، فتتنافس المعاملات فعلاً على أقفال الصفوف
+    with db_cursor(commit=True) as cur:
+        return main.write_match_transition(cur, match_id, "in_progress", captain_id, ["pending"], version)
+
+def cleanup():
+    with db_cursor(commit=True) as cur:
+        for table in ("ratings", "ratings_archive", "match_events", "matches", "matches_archive"):
+            cur.execute(f"DELETE FROM {table} WHERE client_id >= %s OR captain_id >= %s", (USER_ID_BASE, USER_ID_BASE))
+        cur.execute("DELETE FROM scheduled_messages WHERE chat_id >= %s", (USER_ID_BASE,))
+        cur.execute("DELETE FROM users WHERE user_id >= %s", (USER_ID_BASE,))
+        cur.execute("DELETE FROM fsm_storage WHERE key LIKE %s", (f"fsm:{FSM_BENCH_BOT_ID}:%",))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="اختبار حمل شامل لبوت دربك مع Bot API وهمي وقاعدة بيانات محلية")
+    parser.add_argument("--captains", type=int, default=200)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rides", type=int, default=1, help="عدد الرحلات لكل عميل")
+    parser.add_argument("--areas", type=int, default=5, help="عدد الأحياء التي يتوزع عليها المستخدمون")
+    parser.add_argument("--concurrency", type=int, default=200, help="عدد المستخدمين النشطين في نفس الوقت")
+    parser.add_argument("--think", type=float, default=0.5, help="أقصى زمن لقبول الكابتن للعرض (ثانية)")
+    parser.add_argument("--trip", type=float, default=0.5, help="أقصى مدة للرحلة قبل إنهائها (ثانية)")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--ingest", choices=("feed", "webhook", "polling"), default="feed",
+                        help="feed: إدخال مباشر للموزع، webhook: عبر خادم webhook على المنفذ التالي، polling: عبر getUpdates")
+    parser.add_argument("--slow-query", help="اسم دالة بيانات في main (مثل get_user_by_id) يسبقها pg_sleep")
+    parser.add_argument("--slow-ms", type=float, default=200, help="مدة pg_sleep لكل استدعاء بالملي ثانية")
+    parser.add_argument("--blocking", action="store_true",
+                        help="تنفيذ الاستعلامات داخل حلقة الأحداث بدل run_db للمقارنة مع نفس الحمل")
+    parser.add_argument("--race", type=int, default=0, help="بدلاً من المحاكاة: عدد العملاء المتسابقين على كابتن واحد")
+    parser.add_argument("--fsm-bench", type=int, default=0,
+                        help="بدلاً من المحاكاة: قياس PostgresStorage مقابل MemoryStorage بهذا العدد من المفاتيح")
+    parser.add_argument("--fsm-rounds", type=int, default=5, help="عدد خطوات كل مفتاح في قياس حالات المحادثة")
+    parser.add_argument("--check", action="store_true", help="بدلاً من المحاكاة: تشغيل فحوص السلوك على قاعدة البيانات المحلية")
+    parser.add_argument("--keep", action="store_true", help="عدم حذف بيانات الاختبار بعد الانتهاء")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    print("🧪 بدء اختبار الحمل (يُستخدم مع قاعدة بيانات محلية للتجارب فقط)...")
+    init_pool()
+    try:
+        main.init_db()
+        cleanup()
+        if args.fsm_bench:
+            asyncio.run(fsm_benchmark(args.fsm_bench, args.fsm_rounds))
+            raise SystemExit(0)
+        if args.check:
+            raise SystemExit(1 if asyncio.run(run_checks()) else 0)
+        main.load_captain_index()
+        apply_options(args)
+        test = LoadTest(args)
+        asyncio.run(test.run())
+        if test.race_failures:
+            raise SystemExit(1)
+    finally:
+        if not args.keep:
+            cleanup()
+        close_pool()
@@ -1,183 +1,357 @@
 import asyncio
-import json
+import functools
+import time
+from datetime import datetime
 import psycopg2
-import psycopg2.extras
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, types, methods, F
+from aiogram.exceptions import TelegramAPIError
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
-from config import BOT_TOKEN, PG_DB, PG_USER, PG_PASSWORD, PG_HOST, PG_PORT
-
-def get_conn():
-    return psycopg2.connect(
-        dbname=PG_DB, user=PG_USER, password=PG_PASSWORD,
-        host=PG_HOST, port=PG_PORT,
-        cursor_factory=psycopg2.extras.RealDictCursor
-    )
+from config import (BOT_TOKEN, USER_CACHE_SIZE, USER_CACHE_TTL, CAPTAIN_INDEX_REFRESH_INTERVAL, FSM_STORAGE, BOT_MODE,
+                    CAPTAIN_RESULTS_MODE, CAPTAIN_PAGE_SIZE, DISPATCH_MODE, DISPATCH_OFFER_TIMEOUT,
+                    STATS_RECONCILE_INTERVAL, NEIGHBORHOODS_FILE, NEIGHBORHOODS_RELOAD_INTERVAL,
+                    NEIGHBORHOOD_PAGE_SIZE, NEIGHBORHOOD_KEYBOARD_CACHE_SIZE, METRICS_ENABLED, METRICS_HOST, METRICS_PORT,
+                    MATCH_ARCHIVE_AFTER_DAYS, MATCH_ARCHIVE_INTERVAL, MATCH_ARCHIVE_BATCH_SIZE,
+                    MATCHING_MODE, GEO_CELL_SIZE_KM, GEO_SEARCH_RADIUS_KM, GEO_MAX_CAPTAINS, CAPTAIN_LOCATION_TTL,
+                    EVENT_BUS, PENDING_MATCH_TIMEOUT, STALE_TRIP_TIMEOUT, TIMING_WHEEL_TICK, TIMING_WHEEL_SLOTS,
+                    TIMING_WHEEL_LEVELS, REPLICA_LAG_CHECK_INTERVAL)
+from db import init_pool, close_pool, db_cursor, run_db, note_write, check_replicas, replicas
+from writer import write_db, close_writer, writer_stats
+from queries import execute, USER_FIELD_UPDATES
+from cache import UserCache, CaptainIndex, NeighborhoodCatalog
+from storage import PostgresStorage, init_storage
+from stats import init_stats, reconcile_user_stats, get_stats_row, get_average_ratings
+from archive import init_archive, archive_old_matches
+from callbacks import sign_match, verify_match, verify_match_version
+from webhook import run_webhook
+from broadcast import TelegramSender
+from dispatch import DispatchEngine
+from scheduler import MessageScheduler, FollowUpMiddleware, init_scheduler
+from metrics import metrics, MetricsMiddleware, start_metrics_server
+from throttling import ThrottlingMiddleware
+from geo import GeoIndex
+from events import LocalEventBus, PostgresEventBus
+from timing_wheel import TimingWheel
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+captain_index = CaptainIndex()
+geo_index = GeoIndex(GEO_CELL_SIZE_KM)
+neighborhood_catalog = NeighborhoodCatalog(NEIGHBORHOODS_FILE)
+neighborhood_catalog.reload()
 
 def init_db():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        user_id BIGINT PRIMARY KEY, username TEXT, role VARCHAR(10) NOT NULL,
-        subscription VARCHAR(20), full_name TEXT, phone TEXT,
-        car_model TEXT, car_plate TEXT, agreement BOOLEAN DEFAULT FALSE,
-        city TEXT, neighborhood TEXT, neighborhood2 TEXT, neighborhood3 TEXT,
-        is_available BOOLEAN DEFAULT TRUE, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS matches (
-        id SERIAL PRIMARY KEY, client_id BIGINT REFERENCES users(user_id),
-        captain_id BIGINT REFERENCES users(user_id), destination TEXT,
-        status VARCHAR(20) DEFAULT 'pending',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        CONSTRAINT unique_pending_match UNIQUE (client_id, captain_id)
-    )
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS ratings (
-        id SERIAL PRIMARY KEY, match_id INTEGER REFERENCES matches(id),
-        client_id BIGINT REFERENCES users(user_id),
-        captain_id BIGINT REFERENCES users(user_id),
-        rating INTEGER CHECK (rating >= 1 AND rating <= 5),
-        comment TEXT, notes TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        UNIQUE(match_id, client_id)
-    )
-    """)
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def save_user(user_id, username, data):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO users (user_id, username, role, subscription, full_name, phone, car_model, car_plate, agreement, city, neighborhood, neighborhood2, neighborhood3, is_available)
-        VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,TRUE)
-        ON CONFLICT (user_id) DO UPDATE SET
-            username=EXCLUDED.username, role=EXCLUDED.role, subscription=EXCLUDED.subscription,
-            full_name=EXCLUDED.full_name, phone=EXCLUDED.phone, car_model=EXCLUDED.car_model,
-            car_plate=EXCLUDED.car_plate, agreement=EXCLUDED.agreement, city=EXCLUDED.city,
-            neighborhood=EXCLUDED.neighborhood, neighborhood2=EXCLUDED.neighborhood2,
-            neighborhood3=EXCLUDED.neighborhood3, is_available=TRUE
-    """, (user_id, username, data.get("role"), data.get("subscription"), data.get("full_name"),
-          data.get("phone"), data.get("car_model"), data.get("car_plate"), data.get("agreement"),
-          data.get("city"), data.get("neighborhood"), data.get("neighborhood2"), data.get("neighborhood3")))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with db_cursor(commit=True) as cur:
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY, username TEXT, role VARCHAR(10) NOT NULL,
+            subscription VARCHAR(20), full_name TEXT, phone TEXT,
+            car_model TEXT, car_plate TEXT, agreement BOOLEAN DEFAULT FALSE,
+            city TEXT, neighborhood TEXT, neighborhood2 TEXT, neighborhood3 TEXT,
+            is_available BOOLEAN DEFAULT TRUE, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS matches (
+            id SERIAL PRIMARY KEY, client_id BIGINT REFERENCES users(user_id),
+            captain_id BIGINT REFERENCES users(user_id), destination TEXT,
+            status VARCHAR(20) DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        cur.execute("ALTER TABLE matches ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0")
+        # طلب معلق واحد فقط لكل (عميل، كابتن)، مع السماح بتكرار الرحلات بينهما لاحقاً
+        cur.execute("ALTER TABLE matches DROP CONSTRAINT IF EXISTS unique_pending_match")
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS unique_pending_match ON matches (client_id, captain_id) WHERE status = 'pending'")
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS ratings (
+            id SERIAL PRIMARY KEY, match_id INTEGER REFERENCES matches(id),
+            client_id BIGINT REFERENCES users(user_id),
+            captain_id BIGINT REFERENCES users(user_id),
+            rating INTEGER CHECK (rating >= 1 AND rating <= 5),
+            comment TEXT, notes TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(match_id, client_id)
+        )
+        """)
+        # سجل إلحاقي لانتقالات حالة الرحلة؛ بلا مفاتيح أجنبية حتى يبقى بعد أرشفة الرحلات
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS match_events (
+            id BIGSERIAL PRIMARY KEY, match_id INTEGER NOT NULL,
+            status VARCHAR(20) NOT NULL, previous_status VARCHAR(20),
+            client_id BIGINT, captain_id BIGINT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_match_events_match ON match_events (match_id, id)")
+        cur.execute("SELECT to_regclass('captain_service_areas') IS NULL AS missing")
+        migrate_service_areas = cur.fetchone()['missing']
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS captain_service_areas (
+            city TEXT NOT NULL, neighborhood TEXT NOT NULL,
+            captain_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            is_available BOOLEAN NOT NULL DEFAULT TRUE,
+            PRIMARY KEY (city, neighborhood, captain_id)
+        )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_service_areas_available ON captain_service_areas (city, neighborhood, captain_id) WHERE is_available")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_service_areas_captain ON captain_service_areas (captain_id)")
+        cur.execute("""
+        CREATE OR REPLACE FUNCTION sync_service_area_availability()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            UPDATE captain_service_areas SET is_available = NEW.is_available
+            WHERE captain_id = NEW.user_id AND is_available IS DISTINCT FROM NEW.is_available;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """)
+        cur.execute("DROP TRIGGER IF EXISTS sync_service_area_availability ON users")
+        cur.execute("""
+        CREATE TRIGGER sync_service_area_availability
+            AFTER UPDATE OF is_available ON users
+            FOR EACH ROW EXECUTE FUNCTION sync_service_area_availability()
+        """)
+        if migrate_service_areas:
+            seed_service_areas(cur)
+        init_storage(cur)
+        init_archive(cur)
+        init_stats(cur)
+        init_scheduler(cur)
+
+def seed_service_areas(cur, user_id=None):
+    # نقل مناطق العمل من الأعمدة الثلاثة في users إلى جدول captain_service_areas
+    execute(cur, "seed_service_areas", user_id)
+
+def replace_service_areas(cur, captain_id, city, neighborhoods, is_available=True):
+    execute(cur, "delete_service_areas", captain_id)
+    areas = [(city, n) for n in dict.fromkeys(neighborhoods) if n] if city else []
+    if areas:
+        execute(cur, "insert_service_areas", city, [n for _, n in areas], captain_id, is_available)
+    return areas
+
+def get_service_areas(cur, captain_id):
+    execute(cur, "get_service_areas", captain_id)
+    return [(row['city'], row['neighborhood']) for row in cur.fetchall()]
+
+def write_user(cur, user_id, username, data):
+    execute(cur, "upsert_user", user_id, username, data.get("role"), data.get("subscription"), data.get("full_name"),
+            data.get("phone"), data.get("car_model"), data.get("car_plate"), data.get("agreement"),
+            data.get("city"), data.get("neighborhood"), data.get("neighborhood2"), data.get("neighborhood3"))
+    row = cur.fetchone()
+    areas = None
+    if row['role'] == 'captain':
+        areas = replace_service_areas(cur, user_id, row['city'], [row['neighborhood'], row['neighborhood2'], row['neighborhood3']])
+    event_bus.publish(cur, "user", user_id=user_id, areas=areas is not None)
+    return row, areas
+
+async def save_user(user_id, username, data):
+    row, areas = await write_db(write_user, user_id, username, data)
+    user_changed(user_id, row, areas)
 
 def find_available_captains(city, neighborhood):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT * FROM users WHERE role='captain' AND is_available=TRUE AND city=%s 
-        AND (%s = neighborhood OR %s = neighborhood2 OR %s = neighborhood3)
-        ORDER BY created_at ASC
-    """, (city, neighborhood, neighborhood, neighborhood))
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return rows
+    with db_cursor(replica=True) as cur:
+        execute(cur, "find_available_captains", city, neighborhood)
+        return cur.fetchall()
+
+def load_captain_index():
+    with db_cursor() as cur:
+        execute(cur, "available_captains")
+        captains = cur.fetchall()
+        execute(cur, "all_service_areas")
+        captain_index.load(captains, cur.fetchall())
+
+def user_changed(user_id, row=None, areas=None):
+    note_write(user_id)
+    user_cache.invalidate(user_id)
+    if areas is not None:
+        captain_index.set_areas(user_id, areas)
+    if row is not None:
+        captain_index.refresh(row)
+    else:
+        captain_index.remove(user_id)
+    if row is None or row['role'] != 'captain':
+        geo_index.remove(user_id)
 
 def get_user_by_id(user_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE user_id=%s", (user_id,))
-    user = cur.fetchone()
-    cur.close()
-    conn.close()
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    generation = user_cache.generation
+    with db_cursor() as cur:
+        execute(cur, "get_user", user_id)
+        user = cur.fetchone()
+    if user is not None:
+        user_cache.set(user_id, user, generation)
     return user
 
-def create_match_request(client_id, captain_id, destination):
-    conn = get_conn()
-    cur = conn.cursor()
+def record_match_event(cur, match, previous_status=None):
+    execute(cur, "insert_match_event", match['id'], match['status'], previous_status, match['client_id'], match['captain_id'])
+    event_bus.publish(cur, "match", match_id=match['id'], status=match['status'], client_id=match['client_id'], captain_id=match['captain_id'])
+
+def write_match_request(cur, client_id, captain_id, destination):
+    execute(cur, "insert_match_request", client_id, captain_id, destination)
+    match = cur.fetchone()
+    record_match_event(cur, match)
+    return match
+
+async def create_match_request(client_id, captain_id, destination):
     try:
-        cur.execute("INSERT INTO matches (client_id, captain_id, destination, status) VALUES (%s, %s, %s, 'pending') RETURNING id", (client_id, captain_id, destination))
-        match_id = cur.fetchone()['id']
-        conn.commit()
-        return match_id
+        match = await write_db(write_match_request, client_id, captain_id, destination)
     except psycopg2.IntegrityError:
-        conn.rollback()
         return None
-    finally:
-        cur.close()
-        conn.close()
-
-def update_match_status(client_id, captain_id, status):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE matches SET status=%s, updated_at=CURRENT_TIMESTAMP WHERE client_id=%s AND captain_id=%s AND status != 'completed' RETURNING id", (status, client_id, captain_id))
-    result = cur.fetchone()
-    if status == "in_progress":
-        cur.execute("UPDATE users SET is_available=FALSE WHERE user_id=%s", (captain_id,))
-    elif status in ["rejected", "cancelled", "completed"]:
-        cur.execute("UPDATE users SET is_available=TRUE WHERE user_id=%s", (captain_id,))
-    conn.commit()
-    match_id = result['id'] if result else None
-    cur.close()
-    conn.close()
-    return match_id
-
-def get_match_details(client_id, captain_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM matches WHERE client_id=%s AND captain_id=%s ORDER BY created_at DESC LIMIT 1", (client_id, captain_id))
+    note_write(client_id, captain_id)
+    return match
+
+def write_ride_claim(cur, client_id, captain_id, destination):
+    # حجز الكابتن وإنشاء الرحلة في عبارة واحدة: لا تُنشأ الرحلة إلا إذا كان الكابتن ما زال متاحاً
+    execute(cur, "claim_ride", captain_id, client_id, destination)
+    match = cur.fetchone()
+    if match is not None:
+        event_bus.publish(cur, "availability", user_id=captain_id, is_available=False)
+        record_match_event(cur, match)
+    return match
+
+def captain_row(data):
+    # صفوف users القادمة من row_to_json تحمل created_at نصاً
+    row = dict(data)
+    row['created_at'] = datetime.fromisoformat(row['created_at'])
+    return row
+
+async def claim_ride(client_id, captain_id, destination):
+    try:
+        match = await write_db(write_ride_claim, client_id, captain_id, destination)
+    except psycopg2.IntegrityError:
+        return None
+    if match is None:
+        return None
+    # صف الكابتن المحدث يُمرر للفهرس حتى يُخفى مع بقاء مناطق عمله، فيعود لنتائج البحث فور انتهاء الرحلة
+    match = dict(match)
+    note_write(client_id)
+    user_changed(captain_id, captain_row(match.pop('busy_captain')))
+    return match
+
+MATCH_TRANSITIONS = {
+    "pending": {"in_progress", "rejected", "cancelled"},
+    "in_progress": {"completed", "cancelled"},
+}
+
+def write_match_transition(cur, match_id, status, captain_id, allowed_from, expected_version):
+    execute(cur, "transition_match", match_id, captain_id, status, allowed_from, expected_version)
     match = cur.fetchone()
-    cur.close()
-    conn.close()
+    if match is not None:
+        record_match_event(cur, match, match['previous_status'])
+        if match['freed_captain'] is not None:
+            event_bus.publish(cur, "availability", user_id=match['captain_id'], is_available=True)
+        elif match['busy_captain'] is not None:
+            event_bus.publish(cur, "availability", user_id=match['captain_id'], is_available=False)
+    return match
+
+async def transition_match(match_id, status, captain_id=None, expected_version=None, from_status=None):
+    # انتقال حالة الرحلة وتحديث توفر الكابتن في عبارة واحدة؛ يعيد صف الرحلة أو None إذا كان الانتقال غير مسموح
+    allowed_from = [s for s, targets in MATCH_TRANSITIONS.items() if status in targets and from_status in (None, s)]
+    if not allowed_from:
+        raise ValueError(f"unknown match status transition target: {status}")
+    match = await write_db(write_match_transition, match_id, status, captain_id, allowed_from, expected_version)
+    if match is None:
+        return None
+    note_write(match['client_id'], match['captain_id'])
+    match = dict(match)
+    freed, busy = match.pop('freed_captain'), match.pop('busy_captain')
+    if freed is not None:
+        user_changed(match['captain_id'], captain_row(freed))
+    elif busy is not None:
+        user_changed(match['captain_id'], captain_row(busy))
     return match
 
-def save_rating(match_id, client_id, captain_id, rating, comment, notes):
-    conn = get_conn()
-    cur = conn.cursor()
+def get_match(match_id):
+    with db_cursor() as cur:
+        execute(cur, "get_match", match_id)
+        return cur.fetchone()
+
+def get_open_matches():
+    with db_cursor() as cur:
+        execute(cur, "open_matches", PENDING_MATCH_TIMEOUT, STALE_TRIP_TIMEOUT)
+        return cur.fetchall()
+
+def write_rating(cur, match_id, client_id, captain_id, rating, comment, notes):
+    execute(cur, "upsert_rating", match_id, client_id, captain_id, rating, comment or "", notes or "")
+
+async def save_rating(match_id, client_id, captain_id, rating, comment, notes):
     try:
-        cur.execute("""
-            INSERT INTO ratings (match_id, client_id, captain_id, rating, comment, notes)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            ON CONFLICT (match_id, client_id) DO UPDATE SET
-                rating = EXCLUDED.rating, comment = EXCLUDED.comment, notes = EXCLUDED.notes, created_at = CURRENT_TIMESTAMP
-        """, (match_id, client_id, captain_id, rating, comment or "", notes or ""))
-        conn.commit()
+        await write_db(write_rating, match_id, client_id, captain_id, rating, comment, notes)
+        note_write(client_id, captain_id)
         return True
     except Exception as e:
-        conn.rollback()
         return False
-    finally:
-        cur.close()
-        conn.close()
+
+def get_users_by_ids(user_ids):
+    return [get_user_by_id(user_id) for user_id in user_ids]
 
 def is_user_registered(user_id):
     return get_user_by_id(user_id) is not None
 
-def update_user_field(user_id, field, value):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(f"UPDATE users SET {field}=%s WHERE user_id=%s", (value, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+def write_user_field(cur, user_id, field, value):
+    execute(cur, USER_FIELD_UPDATES[field], user_id, value)
+    row = cur.fetchone()
+    areas = None
+    if row and field == "city":
+        execute(cur, "update_service_areas_city", user_id, value)
+        areas = get_service_areas(cur, user_id)
+    elif row and field == "role" and value == "captain":
+        seed_service_areas(cur, user_id)
+        areas = get_service_areas(cur, user_id)
+    if row and field == "is_available":
+        event_bus.publish(cur, "availability", user_id=user_id, is_available=bool(value))
+    elif row:
+        event_bus.publish(cur, "user", user_id=user_id, areas=areas is not None)
+    return row, areas
+
+async def update_user_field(user_id, field, value):
+    if field not in USER_FIELD_UPDATES:
+        raise ValueError(f"unsupported user field: {field}")
+    row, areas = await write_db(write_user_field, user_id, field, value)
+    user_changed(user_id, row, areas)
+
+def write_captain_neighborhoods(cur, user_id, neighborhoods):
+    # أعمدة users تحتفظ بأول ثلاثة أحياء للعرض فقط، والبحث يعتمد على captain_service_areas
+    neighborhood, neighborhood2, neighborhood3 = (list(neighborhoods) + [None, None, None])[:3]
+    execute(cur, "update_captain_neighborhoods", user_id, neighborhood, neighborhood2, neighborhood3)
+    row = cur.fetchone()
+    areas = None
+    if row:
+        areas = replace_service_areas(cur, user_id, row['city'], neighborhoods, row['is_available'])
+        event_bus.publish(cur, "user", user_id=user_id, areas=True)
+    return row, areas
+
+async def update_captain_neighborhoods(user_id, neighborhoods):
+    row, areas = await write_db(write_captain_neighborhoods, user_id, neighborhoods)
+    user_changed(user_id, row, areas)
+
+def write_car(cur, user_id, car_model, car_plate):
+    execute(cur, "update_car", user_id, car_model, car_plate)
+    row = cur.fetchone()
+    if row:
+        event_bus.publish(cur, "user", user_id=user_id, areas=False)
+    return row
+
+async def update_car(user_id, car_model, car_plate):
+    row = await write_db(write_car, user_id, car_model, car_plate)
+    user_changed(user_id, row)
 
 def get_user_stats(user_id):
-    conn = get_conn()
-    cur = conn.cursor()
     user = get_user_by_id(user_id)
     if not user:
         return None
+    row = get_stats_row(user_id) or {}
     if user['role'] == 'client':
-        cur.execute("SELECT COUNT(*) as total_requests, COUNT(CASE WHEN status = 'completed' THEN 1 END) as completed_trips, COUNT(CASE WHEN status = 'pending' THEN 1 END) as pending_requests FROM matches WHERE client_id = %s", (user_id,))
-    else:
-        cur.execute("SELECT COUNT(*) as total_requests, COUNT(CASE WHEN status = 'completed' THEN 1 END) as completed_trips, COUNT(CASE WHEN status = 'in_progress' THEN 1 END) as active_trips, COALESCE(AVG(r.rating), 0) as avg_rating FROM matches m LEFT JOIN ratings r ON m.id = r.match_id WHERE m.captain_id = %s", (user_id,))
-    stats = cur.fetchone()
-    cur.close()
-    conn.close()
-    return stats
-
-rating_temp_data = {}
+        return {'total_requests': row.get('client_requests', 0), 'completed_trips': row.get('client_completed', 0),
+                'pending_requests': row.get('client_pending', 0)}
+    rating_count = row.get('rating_count', 0)
+    return {'total_requests': row.get('captain_requests', 0), 'completed_trips': row.get('captain_completed', 0),
+            'active_trips': row.get('captain_active', 0),
+            'avg_rating': row['rating_sum'] / rating_count if rating_count else 0}
 
 class RegisterStates(StatesGroup):
     role = State()
@@ -193,6 +367,7 @@ class RegisterStates(StatesGroup):
     neighborhood3 = State()
 
 class RequestStates(StatesGroup):
+    pickup_location = State()
     enter_destination = State()
 
 class EditStates(StatesGroup):
@@ -209,6 +384,7 @@ class RatingStates(StatesGroup):
     rating_comment = State()
     rating_notes = State()
 
+@functools.lru_cache(maxsize=None)
 def get_main_keyboard(role):
     keyboard = ReplyKeyboardBuilder()
     if role == "client":
@@ -222,9 +398,20 @@ def get_main_keyboard(role):
         keyboard.button(text="📊 إحصائياتي")
         keyboard.button(text="⚙️ تعديل البيانات")
         keyboard.button(text="📞 اتصل بنا")
-    keyboard.adjust(2, 2, 1)
+        if MATCHING_MODE == "location":
+            keyboard.button(text="📍 تحديث موقعي", request_location=True)
+    keyboard.adjust(2, 2, 1, 1)
     return keyboard.as_markup(resize_keyboard=True)
 
+@functools.lru_cache(maxsize=None)
+def pickup_keyboard():
+    keyboard = ReplyKeyboardBuilder()
+    keyboard.button(text="📍 مشاركة موقعي الحالي", request_location=True)
+    keyboard.button(text="🏘️ استخدام حيي المسجل")
+    keyboard.adjust(1)
+    return keyboard.as_markup(resize_keyboard=True, one_time_keyboard=True)
+
+@functools.lru_cache(maxsize=None)
 def start_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="🚕 عميل", callback_data="role_client")
@@ -232,6 +419,7 @@ def start_keyboard():
     builder.adjust(2)
     return builder.as_markup()
 
+@functools.lru_cache(maxsize=None)
 def subscription_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="📅 يومي", callback_data="sub_daily")
@@ -239,11 +427,13 @@ def subscription_keyboard():
     builder.adjust(2)
     return builder.as_markup()
 
+@functools.lru_cache(maxsize=None)
 def agreement_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ أوافق على الشروط والأحكام", callback_data="agree")
     return builder.as_markup()
 
+@functools.lru_cache(maxsize=None)
 def city_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="🏙️ الرياض", callback_data="city_الرياض")
@@ -251,37 +441,67 @@ def city_keyboard():
     builder.adjust(1)
     return builder.as_markup()
 
-def neighborhood_keyboard(city, selected_neighborhoods=None):
-    try:
-        with open("neighborhoods.json", "r", encoding="utf-8") as f:
-            neighborhoods_data = json.load(f)
-        builder = InlineKeyboardBuilder()
-        selected = selected_neighborhoods or []
-        for neighborhood in neighborhoods_data.get(city, []):
-            if neighborhood not in selected:
-                builder.button(text=neighborhood, callback_data=f"neigh_{neighborhood}")
-        builder.adjust(2)
-        return builder.as_markup()
-    except FileNotFoundError:
+def neighborhood_keyboard(city, selected_neighborhoods=None, page=0):
+    if neighborhood_catalog.missing:
         builder = InlineKeyboardBuilder()
         builder.button(text="❌ ملف الأحياء غير موجود", callback_data="error_no_file")
         return builder.as_markup()
+    excluded = frozenset(selected_neighborhoods or ())
+    return cached_neighborhood_keyboard(neighborhood_catalog.version, city, excluded, page)
+
+@functools.lru_cache(maxsize=NEIGHBORHOOD_KEYBOARD_CACHE_SIZE)
+def cached_neighborhood_keyboard(version, city, excluded, page):
+    # لوحة الأحياء تُبنى مرة واحدة لكل (مدينة، أحياء مستبعدة، صفحة) وتُقسم لصفحات للمدن الكبيرة
+    neighborhoods = [n for n in neighborhood_catalog.get(city) if n not in excluded]
+    pages = max(1, -(-len(neighborhoods) // NEIGHBORHOOD_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    builder = InlineKeyboardBuilder()
+    for neighborhood in neighborhoods[page * NEIGHBORHOOD_PAGE_SIZE:(page + 1) * NEIGHBORHOOD_PAGE_SIZE]:
+        builder.button(text=neighborhood, callback_data=f"neigh_{neighborhood}")
+    builder.adjust(2)
+    if pages > 1:
+        token = neighborhood_catalog.encode(city, excluded)
+        navigation = []
+        if page > 0:
+            navigation.append(types.InlineKeyboardButton(text="◀️ السابق", callback_data=f"npage_{page - 1}_{token}"))
+        if page < pages - 1:
+            navigation.append(types.InlineKeyboardButton(text="التالي ▶️", callback_data=f"npage_{page + 1}_{token}"))
+        builder.row(*navigation)
+    return builder.as_markup()
 
 def captain_selection_keyboard(captain_id):
     builder = InlineKeyboardBuilder()
     builder.button(text="🚖 اختيار هذا الكابتن", callback_data=f"choose_{captain_id}")
     return builder.as_markup()
 
-def captain_response_keyboard(client_id):
+def captain_page_keyboard(captains, page, pages):
+    builder = InlineKeyboardBuilder()
+    for captain in captains:
+        builder.button(text=f"🚖 {captain['full_name']}", callback_data=f"choose_{captain['user_id']}")
+    if page > 0:
+        builder.button(text="◀️ السابق", callback_data=f"cpage_{page - 1}")
+    if page < pages - 1:
+        builder.button(text="التالي ▶️", callback_data=f"cpage_{page + 1}")
+    builder.adjust(*([1] * len(captains)), 2)
+    return builder.as_markup()
+
+def captain_response_keyboard(match):
     builder = InlineKeyboardBuilder()
-    builder.button(text="✅ قبول الطلب", callback_data=f"captain_accept_{client_id}")
-    builder.button(text="❌ رفض الطلب", callback_data=f"captain_reject_{client_id}")
+    builder.button(text="✅ قبول الطلب", callback_data=f"captain_accept_{sign_match('captain_accept', match['id'], match['version'])}")
+    builder.button(text="❌ رفض الطلب", callback_data=f"captain_reject_{sign_match('captain_reject', match['id'], match['version'])}")
     builder.adjust(2)
     return builder.as_markup()
 
-def trip_control_keyboard(captain_id, client_id):
+def ride_offer_keyboard(offer_id):
     builder = InlineKeyboardBuilder()
-    builder.button(text="✅ تم الوصول - إنهاء الرحلة", callback_data=f"complete_trip_{captain_id}_{client_id}")
+    builder.button(text="✅ قبول الرحلة", callback_data=f"offer_accept_{sign_match('offer_accept', offer_id)}")
+    builder.button(text="❌ رفض", callback_data=f"offer_reject_{sign_match('offer_reject', offer_id)}")
+    builder.adjust(2)
+    return builder.as_markup()
+
+def trip_control_keyboard(match):
+    builder = InlineKeyboardBuilder()
+    builder.button(text="✅ تم الوصول - إنهاء الرحلة", callback_data=f"complete_trip_{sign_match('complete_trip', match['id'], match['version'])}")
     return builder.as_markup()
 
 def contact_keyboard(username, text="💬 تواصل"):
@@ -290,6 +510,7 @@ def contact_keyboard(username, text="💬 تواصل"):
         builder.button(text=text, url=f"https://t.me/{username}")
     return builder.as_markup()
 
+@functools.lru_cache(maxsize=None)
 def edit_profile_keyboard(role):
     builder = InlineKeyboardBuilder()
     builder.button(text="👤 تعديل الاسم", callback_data="edit_name")
@@ -303,13 +524,15 @@ def edit_profile_keyboard(role):
     builder.adjust(2)
     return builder.as_markup()
 
-def rating_keyboard():
+def rating_keyboard(match_id):
+    token = sign_match('rate', match_id)
     builder = InlineKeyboardBuilder()
     for i in range(1, 6):
-        builder.button(text=f"{'⭐' * i}", callback_data=f"rate_{i}")
+        builder.button(text=f"{'⭐' * i}", callback_data=f"rate_{i}_{token}")
     builder.adjust(1)
     return builder.as_markup()
 
+@functools.lru_cache(maxsize=None)
 def rating_notes_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="✍️ إضافة ملاحظة", callback_data="add_note")
@@ -317,6 +540,7 @@ def rating_notes_keyboard():
     builder.adjust(2)
     return builder.as_markup()
 
+@functools.lru_cache(maxsize=None)
 def role_change_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="🚕 تحويل إلى عميل", callback_data="change_to_client")
@@ -325,15 +549,270 @@ def role_change_keyboard():
     builder.adjust(1)
     return builder.as_markup()
 
+def captain_card_text(captain, distance=None):
+    text = f"👨‍✈️ الكابتن: {captain['full_name']}\n🚘 السيارة: {captain['car_model']}\n🔢 اللوحة: {captain['car_plate']}\n📍 مناطق العمل:\n• {captain['neighborhood']}\n• {captain['neighborhood2']}\n• {captain['neighborhood3']}"
+    if distance is not None:
+        text += f"\n📏 يبعد عنك {distance:.1f} كم"
+    return text
+
+def captain_page(captains, page, total, distances=None):
+    pages = -(-total // CAPTAIN_PAGE_SIZE)
+    distances = distances or [None] * len(captains)
+    text = f"🎉 وُجد {total} كابتن متاح في منطقتك!\n📄 الصفحة {page + 1} من {pages}\n\n" + "\n\n".join(captain_card_text(c, d) for c, d in zip(captains, distances))
+    return text, captain_page_keyboard(captains, page, pages)
+
+def pickup_text(pickup):
+    if not pickup:
+        return ""
+    return f"\n🗺️ نقطة الالتقاط: https://maps.google.com/?q={pickup[0]},{pickup[1]}"
+
+async def send_ride_offer(offer):
+    client = offer.request.client
+    text = f"🚖 عرض رحلة جديد!\n\n👤 العميل: {client['full_name']}\n📍 من: {client['city']} - {client['neighborhood']}{pickup_text(offer.request.pickup)}\n🎯 إلى: {offer.request.destination}\n\n⏳ لديك {int(DISPATCH_OFFER_TIMEOUT)} ثانية للرد"
+    return await bot.send_message(offer.captain['user_id'], text, reply_markup=ride_offer_keyboard(offer.id))
+
+async def revoke_ride_offer(offer, taken):
+    await offer.message.edit_text("⌛ تم إسناد هذه الرحلة لكابتن آخر" if taken else "⌛ انتهت مهلة الرد على العرض")
+
+async def claim_offered_ride(client_id, captain_id, destination):
+    return await claim_ride(client_id, captain_id, destination)
+
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+sender = TelegramSender()
+dispatch_engine = DispatchEngine(send_ride_offer, revoke_ride_offer, claim_offered_ride)
+scheduler = MessageScheduler(bot, sender)
+running_tasks = set()
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    running_tasks.add(task)
+    task.add_done_callback(running_tasks.discard)
+    return task
+
+def load_user_state(user_id, with_areas):
+    user = get_user_by_id(user_id)
+    if not with_areas:
+        return user, None
+    with db_cursor() as cur:
+        return user, get_service_areas(cur, user_id)
+
+async def reload_user(user_id, with_areas=False):
+    try:
+        row, areas = await run_db(load_user_state, user_id, with_areas)
+    except psycopg2.Error as e:
+        print(f"⚠️ تعذر تحديث بيانات المستخدم {user_id} بعد حدث خارجي: {e}")
+        return
+    user_changed(user_id, row, areas)
+
+# الأحداث القادمة من النسخ الأخرى فقط؛ تغييرات هذه النسخة طُبقت مباشرة عبر user_changed
+def on_user_event(event):
+    if event['origin'] == event_bus.origin:
+        return
+    user_cache.invalidate(event['user_id'])
+    spawn(reload_user(event['user_id'], event.get('areas')))
+
+def on_availability_event(event):
+    if event['origin'] == event_bus.origin:
+        return
+    user_cache.invalidate(event['user_id'])
+    if event['is_available']:
+        spawn(reload_user(event['user_id']))
+    else:
+        # عدم التوفر يُطبق فوراً على الفهرس دون انتظار قاعدة البيانات
+        captain_index.refresh({'user_id': event['user_id'], 'role': 'captain', 'is_available': False})
+
+# مهلة الطلب المعلق والرحلة الجارية؛ كل النسخ تجدولها من أحداث الرحلات والانتقال المشروط يضمن أن واحدة فقط تنفذه
+match_timeouts = TimingWheel(TIMING_WHEEL_TICK, TIMING_WHEEL_SLOTS, TIMING_WHEEL_LEVELS)
+MATCH_TIMEOUTS = {"pending": PENDING_MATCH_TIMEOUT, "in_progress": STALE_TRIP_TIMEOUT}
+
+def on_match_event(event):
+    # رحلات النسخ الأخرى تغير إحصائيات طرفيها أيضاً، فتُقرأ من الأساسية حتى تلحق النسخ المقروءة
+    note_write(event['client_id'], event['captain_id'])
+    timeout = MATCH_TIMEOUTS.get(event['status'])
+    if timeout is None:
+        match_timeouts.cancel(event['match_id'])
+    else:
+        match_timeouts.schedule(event['match_id'], timeout - (time.time() - event['ts']), event['status'])
+
+async def restore_match_timeouts():
+    # إعادة بناء العجلة من قاعدة البيانات عند التشغيل وبعد انقطاع ناقل الأحداث
+    try:
+        rows = await run_db(get_open_matches)
+    except psycopg2.Error as e:
+        print(f"⚠️ تعذر تحميل الرحلات المفتوحة لجدولة انتهائها: {e}")
+        return 0
+    match_timeouts.clear()
+    for row in rows:
+        match_timeouts.schedule(row['id'], float(row['delay']), row['status'])
+    return len(rows)
+
+async def notify(chat_id, text):
+    try:
+        await sender.send(chat_id, functools.partial(bot.send_message, chat_id, text))
+    except TelegramAPIError as e:
+        print(f"⚠️ تعذر إرسال إشعار للمستخدم {chat_id}: {e}")
+
+async def expire_match(match_id, status):
+    try:
+        match = await transition_match(match_id, "cancelled", from_status=status)
+    except psycopg2.Error as e:
+        print(f"⚠️ تعذر إنهاء الرحلة {match_id} بعد انتهاء مهلتها: {e}")
+        match_timeouts.schedule(match_id, TIMING_WHEEL_TICK * TIMING_WHEEL_SLOTS, status)
+        return
+    if match is None:
+        return
+    metrics.inc("matches_expired", status=status)
+    if status == "pending":
+        await asyncio.gather(
+            notify(match['client_id'], "⌛ لم يرد الكابتن على طلبك في الوقت المحدد وتم إلغاؤه\n\nيمكنك اختيار كابتن آخر أو المحاولة لاحقاً"),
+            notify(match['captain_id'], "⌛ انتهت مهلة الرد على طلب الرحلة وتم إلغاؤه"))
+    else:
+        dispatch_engine.mark_idle(match['captain_id'])
+        await asyncio.gather(
+            notify(match['client_id'], "⚠️ تم إغلاق رحلتك تلقائياً لأنها لم تُنهَ خلال المدة المحددة"),
+            notify(match['captain_id'], "⚠️ تم إغلاق الرحلة تلقائياً لأنها لم تُنهَ خلال المدة المحددة\nيمكنك الآن استقبال طلبات جديدة"))
+
+def on_match_timeout(match_id, status):
+    spawn(expire_match(match_id, status))
+
+def resync_local_state():
+    user_cache.clear()
+    spawn(reload_captain_index())
+    spawn(restore_match_timeouts())
+
+event_bus = PostgresEventBus(on_reconnect=resync_local_state) if EVENT_BUS == "postgres" else LocalEventBus()
+event_bus.subscribe("user", on_user_event)
+event_bus.subscribe("availability", on_availability_event)
+event_bus.subscribe("match", on_match_event)
+dp = Dispatcher(storage=PostgresStorage() if FSM_STORAGE == "postgres" else MemoryStorage())
+background_tasks = []
+metrics_runner = None
+
+# نسخة واحدة للرسائل والأزرار حتى يتشارك المستخدم نفس الدلو
+throttling = ThrottlingMiddleware()
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
+# بعد الحد من المعدل حتى لا تلغي الضغطات المُسقطة رسائل المتابعة
+follow_ups = FollowUpMiddleware(scheduler)
+dp.message.outer_middleware(follow_ups)
+dp.callback_query.outer_middleware(follow_ups)
+
+if METRICS_ENABLED:
+    dp.message.middleware(MetricsMiddleware())
+    dp.callback_query.middleware(MetricsMiddleware())
+    metrics.gauge("user_cache_hits", lambda: user_cache.hits)
+    metrics.gauge("user_cache_misses", lambda: user_cache.misses)
+    metrics.gauge("user_cache_size", lambda: user_cache.stats()["size"])
+    metrics.gauge("captain_index_size", lambda: len(captain_index))
+    metrics.gauge("telegram_flood_waits", lambda: sender.flood_waits)
+    metrics.gauge("dispatch_open_offers", lambda: len(dispatch_engine.offers))
+    metrics.gauge("background_tasks_running", lambda: len(running_tasks))
+    metrics.gauge("updates_rate_limited", lambda: throttling.limited)
+    metrics.gauge("updates_deduplicated", lambda: throttling.duplicates)
+    metrics.gauge("updates_coalesced", lambda: throttling.coalesced)
+    metrics.gauge("events_published", lambda: event_bus.published)
+    metrics.gauge("events_received", lambda: event_bus.received)
+    metrics.gauge("write_pipeline_writes", lambda: writer_stats()[0])
+    metrics.gauge("write_pipeline_commits", lambda: writer_stats()[1])
+    metrics.gauge("match_timeouts_scheduled", lambda: len(match_timeouts))
+    metrics.gauge("replicas_usable", lambda: sum(replica.usable for replica in replicas))
+
+async def reload_captain_index():
+    try:
+        await run_db(load_captain_index)
+    except psycopg2.Error as e:
+        print(f"⚠️ تعذر تحديث فهرس الكباتن: {e}")
+
+async def refresh_captain_index():
+    while True:
+        await asyncio.sleep(CAPTAIN_INDEX_REFRESH_INTERVAL)
+        await reload_captain_index()
+        geo_index.prune()
+
+async def watch_replica_lag():
+    while True:
+        await run_db(check_replicas)
+        await asyncio.sleep(REPLICA_LAG_CHECK_INTERVAL)
+
+async def reconcile_stats_periodically():
+    while True:
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+        try:
+            corrected = await run_db(reconcile_user_stats)
+            if corrected:
+                print(f"🔧 تم تصحيح إحصائيات {corrected} مستخدم")
+        except psycopg2.Error as e:
+            print(f"⚠️ تعذر مطابقة الإحصائيات: {e}")
+
+async def archive_matches_periodically():
+    while True:
+        await asyncio.sleep(MATCH_ARCHIVE_INTERVAL)
+        try:
+            moved = await run_db(archive_old_matches, MATCH_ARCHIVE_AFTER_DAYS, MATCH_ARCHIVE_BATCH_SIZE)
+            if moved:
+                print(f"🗄️ تمت أرشفة {moved} رحلة منتهية")
+        except psycopg2.Error as e:
+            print(f"⚠️ تعذر أرشفة الرحلات: {e}")
+
+async def watch_neighborhoods():
+    while True:
+        await asyncio.sleep(NEIGHBORHOODS_RELOAD_INTERVAL)
+        try:
+            if neighborhood_catalog.reload():
+                cached_neighborhood_keyboard.cache_clear()
+                print("🔄 تم تحديث قائمة الأحياء")
+        except (OSError, ValueError) as e:
+            print(f"⚠️ تعذر تحميل ملف الأحياء: {e}")
+
+async def replace_after(message, delay, text, reply_markup=None):
+    # حذف رسالة التأكيد وإرسال رسالة المتابعة يتمان لاحقاً من المجدول دون إبقاء المعالج منتظراً
+    await scheduler.schedule(message.chat.id, delay,
+                             methods.DeleteMessage(chat_id=message.chat.id, message_id=message.message_id),
+                             methods.SendMessage(chat_id=message.chat.id, text=text, reply_markup=reply_markup))
+
+@dp.startup()
+async def on_startup():
+    global metrics_runner
+    if METRICS_ENABLED:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+        print(f"📈 المقاييس متاحة على http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    try:
+        restored = await scheduler.restore()
+        if restored:
+            print(f"⏰ تمت إعادة جدولة {restored} رسالة متابعة")
+    except psycopg2.Error as e:
+        print(f"⚠️ تعذر استعادة الرسائل المجدولة: {e}")
+    restored = await restore_match_timeouts()
+    if restored:
+        print(f"⏳ تمت جدولة انتهاء {restored} رحلة مفتوحة")
+    background_tasks.append(asyncio.create_task(refresh_captain_index()))
+    background_tasks.append(asyncio.create_task(reconcile_stats_periodically()))
+    background_tasks.append(asyncio.create_task(watch_neighborhoods()))
+    background_tasks.append(asyncio.create_task(archive_matches_periodically()))
+    background_tasks.append(asyncio.create_task(event_bus.run()))
+    background_tasks.append(asyncio.create_task(match_timeouts.run(on_match_timeout)))
+    if replicas:
+        background_tasks.append(asyncio.create_task(watch_replica_lag()))
+
+@dp.shutdown()
+async def on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await scheduler.close()
+    # aiogram لا يغلق التخزين بنفسه، وإغلاقه يحفظ ما بقي في مخزن الكتابة المؤجلة قبل إيقاف الكتابة والاتصالات
+    await dp.storage.close()
+    await close_writer()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
 
 @dp.message(F.text == "/start")
 async def start_command(message: types.Message, state: FSMContext):
     await state.clear()
     user_id = message.from_user.id
-    if is_user_registered(user_id):
-        user = get_user_by_id(user_id)
+    user = await run_db(get_user_by_id, user_id)
+    if user:
         role_text = "العميل" if user['role'] == 'client' else "الكابتن"
         await message.answer(f"🎉 أهلاً وسهلاً {user['full_name']}!\n\nأنت مسجل كـ {role_text} في منطقة:\n📍 {user['city']}\n\nاستخدم الأزرار أدناه للتنقل:", reply_markup=get_main_keyboard(user['role']))
     else:
@@ -342,38 +821,53 @@ async def start_command(message: types.Message, state: FSMContext):
 
 @dp.message(F.text == "🚕 طلب توصيلة")
 async def request_ride_text(message: types.Message, state: FSMContext):
-    user = get_user_by_id(message.from_user.id)
+    user = await run_db(get_user_by_id, message.from_user.id)
     if not user:
         await message.answer("❌ يجب التسجيل أولاً. أرسل /start")
         return
+    if MATCHING_MODE == "location":
+        await message.answer("📍 شارك موقعك الحالي لنجد أقرب كابتن إليك، أو استخدم حيك المسجل:", reply_markup=pickup_keyboard())
+        await state.set_state(RequestStates.pickup_location)
+        return
     await message.answer(f"📍 موقعك الحالي: {user['city']} - {user['neighborhood']}\n\n🎯 اكتب اسم المنطقة أو المكان الذي تريد الذهاب إليه:")
     await state.set_state(RequestStates.enter_destination)
 
+@dp.message(RequestStates.pickup_location)
+async def handle_pickup_location(message: types.Message, state: FSMContext):
+    user = await run_db(get_user_by_id, message.from_user.id)
+    if message.location:
+        await state.update_data(pickup=[message.location.latitude, message.location.longitude])
+        origin = "📍 تم تحديد نقطة الالتقاط من موقعك"
+    else:
+        origin = f"📍 موقعك الحالي: {user['city']} - {user['neighborhood']}"
+    await message.answer(f"{origin}\n\n🎯 اكتب اسم المنطقة أو المكان الذي تريد الذهاب إليه:", reply_markup=get_main_keyboard(user['role']))
+    await state.set_state(RequestStates.enter_destination)
+
 @dp.message(F.text == "🟢 متاح للعمل")
 async def set_available_text(message: types.Message):
-    user = get_user_by_id(message.from_user.id)
+    user = await run_db(get_user_by_id, message.from_user.id)
     if not user:
         await message.answer("❌ يجب التسجيل أولاً. أرسل /start")
         return
-    update_user_field(message.from_user.id, "is_available", True)
+    await update_user_field(message.from_user.id, "is_available", True)
     await message.answer("🟢 تم تعيينك كمتاح للتوصيل!\n\nسيتم إشعارك عند وصول طلبات جديدة...")
 
 @dp.message(F.text == "🔴 غير متاح")
 async def set_unavailable_text(message: types.Message):
-    user = get_user_by_id(message.from_user.id)
+    user = await run_db(get_user_by_id, message.from_user.id)
     if not user:
         await message.answer("❌ يجب التسجيل أولاً. أرسل /start")
         return
-    update_user_field(message.from_user.id, "is_available", False)
+    await update_user_field(message.from_user.id, "is_available", False)
     await message.answer("🔴 تم تعيينك كغير متاح للتوصيل\n\nلن تصلك طلبات جديدة حتى تقوم بتفعيل الحالة مرة أخرى")
 
 @dp.message(F.text == "📊 إحصائياتي")
 async def show_stats_text(message: types.Message):
-    user = get_user_by_id(message.from_user.id)
+    user = await run_db(get_user_by_id, message.from_user.id)
     if not user:
         await message.answer("❌ يجب التسجيل أولاً. أرسل /start")
         return
-    stats = get_user_stats(message.from_user.id)
+    stats = await run_db(get_user_stats, message.from_user.id)
     if user['role'] == 'client':
         await message.answer(f"📊 إحصائياتك كعميل:\n\n🔢 إجمالي الطلبات: {stats['total_requests']}\n✅ الرحلات المكتملة: {stats['completed_trips']}\n⏳ الطلبات المعلقة: {stats['pending_requests']}")
     else:
@@ -382,7 +876,7 @@ async def show_stats_text(message: types.Message):
 
 @dp.message(F.text == "⚙️ تعديل البيانات")
 async def edit_profile_text(message: types.Message):
-    user = get_user_by_id(message.from_user.id)
+    user = await run_db(get_user_by_id, message.from_user.id)
     if not user:
         await message.answer("❌ يجب التسجيل أولاً. أرسل /start")
         return
@@ -398,6 +892,32 @@ async def edit_profile_text(message: types.Message):
 async def contact_us_text(message: types.Message):
     await message.answer("📞 للتواصل والاستفسارات:\n\n📱 الجوال: 0501234567\n📧 البريد: support@darbak.com\n⏰ ساعات العمل: 24/7\n\n💡 يمكنك أيضاً إرسال استفسارك هنا وسنرد عليك قريباً")
 
+def location_expiry(message):
+    # الموقع المباشر صالح حتى نهاية مدة المشاركة، والموقع الثابت لمدة CAPTAIN_LOCATION_TTL
+    live_period = message.location.live_period
+    if live_period:
+        return time.monotonic() + message.date.timestamp() + live_period - time.time()
+    return time.monotonic() + CAPTAIN_LOCATION_TTL
+
+@dp.message(F.location)
+async def handle_captain_location(message: types.Message):
+    user = await run_db(get_user_by_id, message.from_user.id)
+    if not user or user['role'] != 'captain':
+        await message.answer("📍 لا حاجة لمشاركة موقعك الآن\n\n💡 سيُطلب منك موقعك عند طلب توصيلة")
+        return
+    geo_index.update(user['user_id'], message.location.latitude, message.location.longitude, location_expiry(message))
+    if message.location.live_period:
+        await message.answer("📍 تم تفعيل تتبع موقعك المباشر\n\nستصلك الطلبات الأقرب إليك طوال مدة المشاركة")
+    else:
+        await message.answer("📍 تم تحديث موقعك\n\n💡 شارك موقعك المباشر ليبقى محدثاً أثناء تنقلك")
+
+@dp.edited_message(F.location)
+async def handle_captain_live_location(message: types.Message):
+    # تحديثات الموقع المباشر تصل كتعديلات متتالية على نفس الرسالة فتُحدّث الفهرس بصمت
+    user = await run_db(get_user_by_id, message.from_user.id)
+    if user and user['role'] == 'captain':
+        geo_index.update(user['user_id'], message.location.latitude, message.location.longitude, location_expiry(message))
+
 @dp.callback_query(F.data.startswith("role_"))
 async def handle_role_selection(callback: types.CallbackQuery, state: FSMContext):
     role = callback.data.split("_")[1]
@@ -460,16 +980,14 @@ async def handle_city_selection(callback: types.CallbackQuery, state: FSMContext
     data = await state.get_data()
     current_state = await state.get_state()
     if current_state == EditStates.change_city.state:
-        user = get_user_by_id(callback.from_user.id)
-        update_user_field(callback.from_user.id, "city", city)
+        user = await run_db(get_user_by_id, callback.from_user.id)
+        await update_user_field(callback.from_user.id, "city", city)
         await callback.message.edit_text(f"✅ تم تغيير المدينة إلى: {city}\n\nالآن يجب تحديث الأحياء...")
-        await asyncio.sleep(1)
-        if user['role'] == 'captain':
-            await callback.message.edit_text(f"🏘️ اختر الحي الأول الجديد في {city}:", reply_markup=neighborhood_keyboard(city))
-            await state.set_state(EditStates.change_neighborhood)
-        else:
-            await callback.message.edit_text(f"🏘️ اختر حيك الجديد في {city}:", reply_markup=neighborhood_keyboard(city))
-            await state.set_state(EditStates.change_neighborhood)
+        prompt = f"🏘️ اختر الحي الأول الجديد في {city}:" if user['role'] == 'captain' else f"🏘️ اختر حيك الجديد في {city}:"
+        await scheduler.schedule(callback.message.chat.id, 1, methods.EditMessageText(
+            chat_id=callback.message.chat.id, message_id=callback.message.message_id,
+            text=prompt, reply_markup=neighborhood_keyboard(city)))
+        await state.set_state(EditStates.change_neighborhood)
         await callback.answer()
         return
     if data.get("role") == "captain":
@@ -489,11 +1007,9 @@ async def handle_first_neighborhood_selection(callback: types.CallbackQuery, sta
         await state.set_state(RegisterStates.neighborhood2)
     else:
         username = callback.from_user.username
-        save_user(callback.from_user.id, username, data)
+        await save_user(callback.from_user.id, username, data)
         await callback.message.edit_text("✅ تم قبولك بنجاح! مرحباً بك في نظام دربك")
-        await asyncio.sleep(2)
-        await callback.message.delete()
-        await bot.send_message(callback.from_user.id, f"🎉 مرحباً {data['full_name']}\n\n📍 منطقتك: {data['city']} - {neighborhood}\n\nاستخدم الأزرار أدناه للتنقل:", reply_markup=get_main_keyboard("client"))
+        await replace_after(callback.message, 2, f"🎉 مرحباً {data['full_name']}\n\n📍 منطقتك: {data['city']} - {neighborhood}\n\nاستخدم الأزرار أدناه للتنقل:", get_main_keyboard("client"))
         await state.clear()
     await callback.answer()
 
@@ -504,7 +1020,7 @@ async def handle_second_neighborhood_selection(callback: types.CallbackQuery, st
     data = await state.get_data()
     if 'new_neighborhood' in data:
         await state.update_data(new_neighborhood2=neighborhood2)
-        user = get_user_by_id(callback.from_user.id)
+        user = await run_db(get_user_by_id, callback.from_user.id)
         selected = [data['new_neighborhood'], neighborhood2]
         await callback.message.edit_text(f"✅ الحي الثاني: {neighborhood2}\n\n🏘️ اختر الحي الثالث:", reply_markup=neighborhood_keyboard(user['city'], selected))
         await state.set_state(RegisterStates.neighborhood3)
@@ -521,47 +1037,106 @@ async def handle_third_neighborhood_selection(callback: types.CallbackQuery, sta
     await state.update_data(neighborhood3=neighborhood3)
     data = await state.get_data()
     if 'new_neighborhood' in data:
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("UPDATE users SET neighborhood=%s, neighborhood2=%s, neighborhood3=%s WHERE user_id=%s", (data['new_neighborhood'], data['new_neighborhood2'], neighborhood3, callback.from_user.id))
-        conn.commit()
-        cur.close()
-        conn.close()
-        user = get_user_by_id(callback.from_user.id)
+        await update_captain_neighborhoods(callback.from_user.id, [data['new_neighborhood'], data['new_neighborhood2'], neighborhood3])
+        user = await run_db(get_user_by_id, callback.from_user.id)
         await callback.message.edit_text(f"✅ تم تحديث مناطق العمل بنجاح!\n\n📍 مناطقك الجديدة:\n• {data['new_neighborhood']}\n• {data['new_neighborhood2']}\n• {neighborhood3}")
-        await asyncio.sleep(2)
-        await callback.message.delete()
-        await bot.send_message(callback.from_user.id, "✅ تم التحديث بنجاح", reply_markup=get_main_keyboard(user['role']))
+        await replace_after(callback.message, 2, "✅ تم التحديث بنجاح", get_main_keyboard(user['role']))
         await state.clear()
         await callback.answer()
         return
     username = callback.from_user.username
-    save_user(callback.from_user.id, username, data)
+    await save_user(callback.from_user.id, username, data)
     await callback.message.edit_text("✅ تم قبولك بنجاح! مرحباً بك في نظام دربك")
-    await asyncio.sleep(2)
-    await callback.message.delete()
-    await bot.send_message(callback.from_user.id, f"🎉 مرحباً الكابتن {data['full_name']}\n\n🚘 مركبتك: {data['car_model']} ({data['car_plate']})\n📍 مناطق عملك:\n• {data['neighborhood']}\n• {data['neighborhood2']}\n• {neighborhood3}\n\nاستخدم الأزرار أدناه للتنقل:", reply_markup=get_main_keyboard("captain"))
+    await replace_after(callback.message, 2, f"🎉 مرحباً الكابتن {data['full_name']}\n\n🚘 مركبتك: {data['car_model']} ({data['car_plate']})\n📍 مناطق عملك:\n• {data['neighborhood']}\n• {data['neighborhood2']}\n• {neighborhood3}\n\nاستخدم الأزرار أدناه للتنقل:", get_main_keyboard("captain"))
     await state.clear()
     await callback.answer()
 
+@dp.callback_query(F.data.startswith("npage_"))
+async def handle_neighborhood_page(callback: types.CallbackQuery):
+    page, _, token = callback.data.removeprefix("npage_").partition("_")
+    try:
+        city, excluded = neighborhood_catalog.decode(token)
+    except (ValueError, IndexError):
+        await callback.answer("⚠️ تم تحديث قائمة الأحياء، يرجى البدء من جديد", show_alert=True)
+        return
+    await callback.message.edit_reply_markup(reply_markup=neighborhood_keyboard(city, excluded, int(page)))
+    await callback.answer()
+
 @dp.message(RequestStates.enter_destination)
 async def handle_destination_input(message: types.Message, state: FSMContext):
     destination = message.text.strip()
-    user = get_user_by_id(message.from_user.id)
-    await state.update_data(destination=destination)
+    user = await run_db(get_user_by_id, message.from_user.id)
+    data = await state.update_data(destination=destination)
     await message.answer(f"🎯 الوجهة: {destination}\n\n🔍 جاري البحث عن الكباتن المتاحين في منطقتك...")
-    await search_for_captains(message, state, user['city'], user['neighborhood'], destination)
-
-async def search_for_captains(message, state, city, neighborhood, destination):
-    captains = find_available_captains(city, neighborhood)
+    await search_for_captains(message, state, user['city'], user['neighborhood'], destination, data.get('pickup'))
+
+def find_nearest_captains(pickup):
+    # الكباتن المتاحون في الفهرس فقط، مرتبين بالمسافة من نقطة الالتقاط
+    nearest = geo_index.nearest(pickup[0], pickup[1], GEO_MAX_CAPTAINS, GEO_SEARCH_RADIUS_KM,
+                                accept=lambda captain_id: captain_index.get(captain_id) is not None)
+    captains = [captain_index.get(captain_id) for captain_id, _ in nearest]
+    distances = {captain_id: distance for captain_id, distance in nearest}
+    return [c for c in captains if c is not None], distances
+
+async def search_for_captains(message, state, city, neighborhood, destination, pickup=None):
+    captains, distances = [], {}
+    if pickup and captain_index.loaded:
+        captains, distances = find_nearest_captains(pickup)
+    if not captains:
+        # لا يوجد كابتن قريب شارك موقعه، فنرجع للمطابقة بالحي
+        distances = {}
+        if captain_index.loaded:
+            captains = captain_index.find(city, neighborhood)
+        else:
+            captains = await run_db(find_available_captains, city, neighborhood)
     if not captains:
         await message.answer("😔 عذراً، لا يوجد كباتن متاحين في منطقتك حالياً.\n\n💡 نصائح:\n• جرب مرة أخرى بعد قليل\n• تأكد من اختيار الحي الصحيح\n• يمكنك تجربة طلب توصيلة مرة أخرى")
         await state.clear()
         return
-    await message.answer(f"🎉 وُجد {len(captains)} كابتن متاح في منطقتك!")
-    for captain in captains:
-        captain_info = f"👨‍✈️ الكابتن: {captain['full_name']}\n🚘 السيارة: {captain['car_model']}\n🔢 اللوحة: {captain['car_plate']}\n📍 مناطق العمل:\n• {captain['neighborhood']}\n• {captain['neighborhood2']}\n• {captain['neighborhood3']}"
-        await message.answer(captain_info, reply_markup=captain_selection_keyboard(captain["user_id"]))
+    if DISPATCH_MODE == "auto":
+        client = await run_db(get_user_by_id, message.from_user.id)
+        await state.clear()
+        await message.answer(f"🎉 وُجد {len(captains)} كابتن متاح في منطقتك!\n\n⏳ جاري إرسال طلبك لأنسب كابتن، سنبلغك فور القبول...")
+        spawn(auto_dispatch(client, destination, neighborhood, captains, distances, pickup))
+        return
+    if CAPTAIN_RESULTS_MODE == "paginated":
+        await state.update_data(captain_ids=[captain['user_id'] for captain in captains],
+                                captain_distances=[distances.get(captain['user_id']) for captain in captains])
+        first = captains[:CAPTAIN_PAGE_SIZE]
+        text, markup = captain_page(first, 0, len(captains), [distances.get(c['user_id']) for c in first])
+        await sender.send_many(message.chat.id, [functools.partial(message.answer, text, reply_markup=markup)], "captain_page")
+        return
+    calls = [functools.partial(message.answer, f"🎉 وُجد {len(captains)} كابتن متاح في منطقتك!")]
+    calls += [functools.partial(message.answer, captain_card_text(captain, distances.get(captain['user_id'])), reply_markup=captain_selection_keyboard(captain["user_id"])) for captain in captains]
+    await sender.send_many(message.chat.id, calls, "captain_cards")
+
+async def auto_dispatch(client, destination, neighborhood, captains, distances=None, pickup=None):
+    try:
+        ratings = await run_db(get_average_ratings, [captain['user_id'] for captain in captains])
+        match = await dispatch_engine.dispatch(client, destination, neighborhood, captains, ratings, distances, pickup)
+    except Exception as e:
+        # المهمة تعمل بعد أن أُبلغ العميل بالبحث، فلا يُترك منتظراً إذا فشلت
+        print(f"❌ خطأ في الإسناد التلقائي لطلب العميل {client['user_id']}: {e}")
+        metrics.inc("dispatch_errors_total", error=type(e).__name__)
+        await notify(client['user_id'], "⚠️ تعذر إرسال طلبك للكباتن بسبب خطأ مؤقت\n\nيرجى طلب توصيلة مرة أخرى")
+        return
+    if match is None:
+        await notify(client['user_id'], "😔 عذراً، لم يقبل أي كابتن طلبك حالياً\n\nيمكنك المحاولة مرة أخرى بعد قليل")
+
+@dp.callback_query(F.data.startswith("cpage_"))
+async def handle_captain_page(callback: types.CallbackQuery, state: FSMContext):
+    page = int(callback.data.split("_")[1])
+    data = await state.get_data()
+    captain_ids = data.get('captain_ids')
+    if not captain_ids:
+        await callback.answer("⌛ انتهت صلاحية نتائج البحث، اطلب توصيلة من جديد", show_alert=True)
+        return
+    page_ids = captain_ids[page * CAPTAIN_PAGE_SIZE:(page + 1) * CAPTAIN_PAGE_SIZE]
+    distances = dict(zip(captain_ids, data.get('captain_distances') or ()))
+    captains = [c for c in await run_db(get_users_by_ids, page_ids) if c]
+    text, markup = captain_page(captains, page, len(captain_ids), [distances.get(c['user_id']) for c in captains])
+    await callback.message.edit_text(text, reply_markup=markup)
+    await callback.answer()
 
 @dp.callback_query(F.data.startswith("choose_"))
 async def handle_captain_selection(callback: types.CallbackQuery, state: FSMContext):
@@ -569,66 +1144,106 @@ async def handle_captain_selection(callback: types.CallbackQuery, state: FSMCont
     client_id = callback.from_user.id
     data = await state.get_data()
     destination = data.get('destination', 'غير محدد')
-    match_id = create_match_request(client_id, captain_id, destination)
-    if not match_id:
+    match = await create_match_request(client_id, captain_id, destination)
+    if not match:
         await callback.answer("⚠️ لديك طلب مُعلق مع هذا الكابتن", show_alert=True)
         return
-    client = get_user_by_id(client_id)
-    captain = get_user_by_id(captain_id)
+    client, captain = await asyncio.gather(run_db(get_user_by_id, client_id), run_db(get_user_by_id, captain_id))
     if not client or not captain:
         await callback.answer("❌ خطأ في البيانات", show_alert=True)
         return
-    notification_text = f"🚖 طلب رحلة جديد!\n\n👤 العميل: {client['full_name']}\n📱 الجوال: {client['phone']}\n📍 من: {client['city']} - {client['neighborhood']}\n🎯 إلى: {destination}\n\nهل توافق على هذا الطلب؟"
-    await bot.send_message(captain_id, notification_text, reply_markup=captain_response_keyboard(client_id))
+    notification_text = f"🚖 طلب رحلة جديد!\n\n👤 العميل: {client['full_name']}\n📱 الجوال: {client['phone']}\n📍 من: {client['city']} - {client['neighborhood']}{pickup_text(data.get('pickup'))}\n🎯 إلى: {destination}\n\nهل توافق على هذا الطلب؟"
+    await bot.send_message(captain_id, notification_text, reply_markup=captain_response_keyboard(match))
     await callback.message.edit_text("⏳ تم إرسال طلبك للكابتن، يرجى انتظار الرد...")
     await state.clear()
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("captain_accept_"))
 async def handle_captain_acceptance(callback: types.CallbackQuery):
-    client_id = int(callback.data.split("_")[2])
+    match_id, version = verify_match_version("captain_accept", callback.data.removeprefix("captain_accept_")) or (None, None)
+    if match_id is None:
+        await callback.answer("⌛ هذا الزر لم يعد صالحاً", show_alert=True)
+        return
     captain_id = callback.from_user.id
-    match_id = update_match_status(client_id, captain_id, "in_progress")
-    match = get_match_details(client_id, captain_id)
-    captain = get_user_by_id(captain_id)
-    client = get_user_by_id(client_id)
-    await callback.message.edit_text(f"✅ تم قبول الطلب! 🎉\n\n👤 العميل: {client['full_name']}\n📱 جواله: {client['phone']}\n🎯 الوجهة: {match['destination']}\n\nتواصل مع العميل وابدأ الرحلة", reply_markup=contact_keyboard(client.get('username'), "💬 تواصل مع العميل"))
-    await bot.send_message(captain_id, "🚗 الرحلة جارية...\nاضغط الزر أدناه عند الوصول للوجهة:", reply_markup=trip_control_keyboard(captain_id, client_id))
+    match = await transition_match(match_id, "in_progress", captain_id, expected_version=version)
+    if match is None:
+        await callback.message.edit_text("⚠️ لا يمكن قبول هذا الطلب، ربما تمت معالجته مسبقاً أو لديك رحلة جارية")
+        await callback.answer()
+        return
+    captain, client = await asyncio.gather(run_db(get_user_by_id, captain_id), run_db(get_user_by_id, match['client_id']))
+    await announce_trip(callback.message, captain, client, match)
+    await callback.answer()
+
+async def announce_trip(message, captain, client, match):
+    captain_id, client_id, destination = captain['user_id'], client['user_id'], match['destination']
+    await message.edit_text(f"✅ تم قبول الطلب! 🎉\n\n👤 العميل: {client['full_name']}\n📱 جواله: {client['phone']}\n🎯 الوجهة: {destination}\n\nتواصل مع العميل وابدأ الرحلة", reply_markup=contact_keyboard(client.get('username'), "💬 تواصل مع العميل"))
+    await bot.send_message(captain_id, "🚗 الرحلة جارية...\nاضغط الزر أدناه عند الوصول للوجهة:", reply_markup=trip_control_keyboard(match))
     client_notification = f"🎉 الكابتن وافق على طلبك!\n\n👨‍✈️ الكابتن: {captain['full_name']}\n📱 جواله: {captain['phone']}\n🚘 السيارة: {captain['car_model']} ({captain['car_plate']})\n\n🚗 الكابتن في طريقه إليك\n📞 تواصل معه لتحديد نقطة اللقاء"
     await bot.send_message(client_id, client_notification, reply_markup=contact_keyboard(captain.get('username'), "💬 تواصل مع الكابتن"))
+
+@dp.callback_query(F.data.startswith("offer_accept_"))
+async def handle_offer_acceptance(callback: types.CallbackQuery):
+    offer_id = verify_match("offer_accept", callback.data.removeprefix("offer_accept_"))
+    match = await dispatch_engine.accept(offer_id, callback.from_user.id) if offer_id is not None else None
+    if match is None:
+        await callback.message.edit_text("⌛ هذا العرض لم يعد متاحاً")
+        await callback.answer()
+        return
+    captain, client = await asyncio.gather(run_db(get_user_by_id, match['captain_id']), run_db(get_user_by_id, match['client_id']))
+    await announce_trip(callback.message, captain, client, match)
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("offer_reject_"))
+async def handle_offer_rejection(callback: types.CallbackQuery):
+    offer_id = verify_match("offer_reject", callback.data.removeprefix("offer_reject_"))
+    if offer_id is None or not dispatch_engine.reject(offer_id, callback.from_user.id):
+        await callback.answer("⌛ هذا الزر لم يعد صالحاً", show_alert=True)
+        return
+    await callback.message.edit_text("❌ تم رفض العرض")
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("captain_reject_"))
 async def handle_captain_rejection(callback: types.CallbackQuery):
-    client_id = int(callback.data.split("_")[2])
-    captain_id = callback.from_user.id
-    update_match_status(client_id, captain_id, "rejected")
+    match_id, version = verify_match_version("captain_reject", callback.data.removeprefix("captain_reject_")) or (None, None)
+    if match_id is None:
+        await callback.answer("⌛ هذا الزر لم يعد صالحاً", show_alert=True)
+        return
+    match = await transition_match(match_id, "rejected", callback.from_user.id, expected_version=version)
+    if match is None:
+        await callback.message.edit_text("⚠️ تمت معالجة هذا الطلب مسبقاً")
+        await callback.answer()
+        return
     await callback.message.edit_text("❌ تم رفض الطلب")
-    await bot.send_message(client_id, f"😔 عذراً، الكابتن غير متاح حالياً\n\nيمكنك اختيار كابتن آخر أو المحاولة لاحقاً")
+    await bot.send_message(match['client_id'], f"😔 عذراً، الكابتن غير متاح حالياً\n\nيمكنك اختيار كابتن آخر أو المحاولة لاحقاً")
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("complete_trip_"))
 async def handle_trip_completion(callback: types.CallbackQuery):
-    parts = callback.data.split("_")
-    captain_id = int(parts[2])
-    client_id = int(parts[3])
-    match_id = update_match_status(client_id, captain_id, "completed")
+    match_id, version = verify_match_version("complete_trip", callback.data.removeprefix("complete_trip_")) or (None, None)
+    if match_id is None:
+        await callback.answer("⌛ هذا الزر لم يعد صالحاً", show_alert=True)
+        return
+    captain_id = callback.from_user.id
+    match = await transition_match(match_id, "completed", captain_id, expected_version=version)
+    if match is None:
+        await callback.message.edit_text("⚠️ تم إنهاء هذه الرحلة مسبقاً")
+        await callback.answer()
+        return
+    dispatch_engine.mark_idle(captain_id)
     await callback.message.edit_text("✅ تم إنهاء الرحلة بنجاح!\nشكراً لك، يمكنك الآن استقبال طلبات جديدة")
-    await bot.send_message(client_id, "🏁 الحمد لله على سلامتك!\n\nوصلت بخير إلى وجهتك\nنود رأيك في الكابتن، كيف تقيم الخدمة؟", reply_markup=rating_keyboard())
-    match = get_match_details(client_id, captain_id)
-    if match:
-        rating_temp_data[client_id] = {'match_id': match['id'], 'captain_id': captain_id, 'client_id': client_id}
+    await bot.send_message(match['client_id'], "🏁 الحمد لله على سلامتك!\n\nوصلت بخير إلى وجهتك\nنود رأيك في الكابتن، كيف تقيم الخدمة؟", reply_markup=rating_keyboard(match['id']))
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("rate_"))
 async def handle_rating_selection(callback: types.CallbackQuery, state: FSMContext):
-    rating = int(callback.data.split("_")[1])
-    client_id = callback.from_user.id
-    rating_data = rating_temp_data.get(client_id)
-    if not rating_data:
+    rating, _, token = callback.data.removeprefix("rate_").partition("_")
+    match_id = verify_match("rate", token)
+    match = await run_db(get_match, match_id) if match_id is not None else None
+    if not match or match['client_id'] != callback.from_user.id or match['status'] != 'completed':
         await callback.answer("❌ خطأ في بيانات التقييم", show_alert=True)
         return
-    await state.update_data(rating=rating, match_id=rating_data['match_id'], captain_id=rating_data['captain_id'])
+    rating = int(rating)
+    await state.update_data(rating=rating, match_id=match['id'], captain_id=match['captain_id'])
     await callback.message.edit_text(f"✅ تقييمك: {'⭐' * rating}\n\n📝 اكتب تعليقك على الخدمة (اختياري):\n💡 مثلاً: كابتن محترم، سيارة نظيفة، وقت مناسب...", reply_markup=rating_notes_keyboard())
     await state.set_state(RatingStates.rating_comment)
     await callback.answer()
@@ -671,8 +1286,8 @@ async def finalize_rating(message, state: FSMContext, comment="", notes="", clie
     data = await state.get_data()
     if not client_id:
         client_id = message.from_user.id
-    success = save_rating(data['match_id'], client_id, data['captain_id'], data['rating'], comment, notes)
-    client = get_user_by_id(client_id)
+    success = await save_rating(data['match_id'], client_id, data['captain_id'], data['rating'], comment, notes)
+    client = await run_db(get_user_by_id, client_id)
     if success:
         rating_summary = f"🙏 شكراً لك على تقييمك!\n\n⭐ التقييم: {'⭐' * data['rating']}\n💬 التعليق: {comment if comment else 'لا يوجد'}\n📋 الملاحظة: {notes if notes else 'لا يوجد'}\n\nرأيك يساعدنا في تحسين الخدمة\nنتطلع لخدمتك مرة أخرى في دربك ✨"
         await message.answer(rating_summary, reply_markup=get_main_keyboard(client['role']))
@@ -680,15 +1295,13 @@ async def finalize_rating(message, state: FSMContext, comment="", notes="", clie
         if comment.strip():
             rating_text += f"\n💬 التعليق: {comment}"
         await bot.send_message(data['captain_id'], rating_text)
-        if client_id in rating_temp_data:
-            del rating_temp_data[client_id]
     else:
         await message.answer("❌ حدث خطأ في حفظ التقييم، يرجى المحاولة مرة أخرى", reply_markup=get_main_keyboard(client['role']))
     await state.clear()
 
 @dp.callback_query(F.data == "edit_profile")
 async def edit_profile_handler(callback: types.CallbackQuery):
-    user = get_user_by_id(callback.from_user.id)
+    user = await run_db(get_user_by_id, callback.from_user.id)
     if not user:
         await callback.answer("❌ خطأ في البيانات", show_alert=True)
         return
@@ -709,8 +1322,8 @@ async def edit_name_handler(callback: types.CallbackQuery, state: FSMContext):
 
 @dp.message(EditStates.edit_name)
 async def handle_new_name(message: types.Message, state: FSMContext):
-    update_user_field(message.from_user.id, "full_name", message.text)
-    user = get_user_by_id(message.from_user.id)
+    await update_user_field(message.from_user.id, "full_name", message.text)
+    user = await run_db(get_user_by_id, message.from_user.id)
     await message.answer("✅ تم تحديث الاسم بنجاح!", reply_markup=get_main_keyboard(user['role']))
     await state.clear()
 
@@ -722,8 +1335,8 @@ async def edit_phone_handler(callback: types.CallbackQuery, state: FSMContext):
 
 @dp.message(EditStates.edit_phone)
 async def handle_new_phone(message: types.Message, state: FSMContext):
-    update_user_field(message.from_user.id, "phone", message.text)
-    user = get_user_by_id(message.from_user.id)
+    await update_user_field(message.from_user.id, "phone", message.text)
+    user = await run_db(get_user_by_id, message.from_user.id)
     await message.answer("✅ تم تحديث رقم الجوال بنجاح!", reply_markup=get_main_keyboard(user['role']))
     await state.clear()
 
@@ -742,19 +1355,14 @@ async def handle_new_car_model(message: types.Message, state: FSMContext):
 @dp.message(EditStates.edit_car_plate)
 async def handle_new_car_plate(message: types.Message, state: FSMContext):
     data = await state.get_data()
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET car_model=%s, car_plate=%s WHERE user_id=%s", (data['new_car_model'], message.text, message.from_user.id))
-    conn.commit()
-    cur.close()
-    conn.close()
-    user = get_user_by_id(message.from_user.id)
+    await update_car(message.from_user.id, data['new_car_model'], message.text)
+    user = await run_db(get_user_by_id, message.from_user.id)
     await message.answer("✅ تم تحديث بيانات السيارة بنجاح!", reply_markup=get_main_keyboard(user['role']))
     await state.clear()
 
 @dp.callback_query(F.data == "edit_neighborhoods")
 async def edit_neighborhoods_handler(callback: types.CallbackQuery, state: FSMContext):
-    user = get_user_by_id(callback.from_user.id)
+    user = await run_db(get_user_by_id, callback.from_user.id)
     if user['role'] != 'captain':
         await callback.answer("❌ هذه الميزة للكباتن فقط", show_alert=True)
         return
@@ -765,13 +1373,11 @@ async def edit_neighborhoods_handler(callback: types.CallbackQuery, state: FSMCo
 @dp.callback_query(F.data.startswith("neigh_"), EditStates.change_neighborhood)
 async def handle_edit_neighborhood(callback: types.CallbackQuery, state: FSMContext):
     neighborhood = callback.data.replace("neigh_", "")
-    user = get_user_by_id(callback.from_user.id)
+    user = await run_db(get_user_by_id, callback.from_user.id)
     if user['role'] == 'client':
-        update_user_field(callback.from_user.id, "neighborhood", neighborhood)
+        await update_user_field(callback.from_user.id, "neighborhood", neighborhood)
         await callback.message.edit_text("✅ تم تحديث بياناتك بنجاح!")
-        await asyncio.sleep(1)
-        await callback.message.delete()
-        await bot.send_message(callback.from_user.id, f"✅ تم تحديث منطقتك إلى: {user['city']} - {neighborhood}", reply_markup=get_main_keyboard(user['role']))
+        await replace_after(callback.message, 1, f"✅ تم تحديث منطقتك إلى: {user['city']} - {neighborhood}", get_main_keyboard(user['role']))
         await state.clear()
         await callback.answer()
         return
@@ -788,7 +1394,7 @@ async def edit_city_handler(callback: types.CallbackQuery, state: FSMContext):
 
 @dp.callback_query(F.data == "change_role")
 async def change_role_handler(callback: types.CallbackQuery):
-    user = get_user_by_id(callback.from_user.id)
+    user = await run_db(get_user_by_id, callback.from_user.id)
     current_role = "عميل" if user['role'] == 'client' else "كابتن"
     await callback.message.edit_text(f"🔄 تغيير الدور\n\nدورك الحالي: {current_role}\n\naختر الدور الجديد:", reply_markup=role_change_keyboard())
     await callback.answer()
@@ -797,19 +1403,16 @@ async def change_role_handler(callback: types.CallbackQuery):
 async def handle_role_change(callback: types.CallbackQuery):
     new_role = callback.data.split("_")[2]
     user_id = callback.from_user.id
-    update_user_field(user_id, "role", new_role)
+    await update_user_field(user_id, "role", new_role)
     role_text = "عميل" if new_role == "client" else "كابتن"
     await callback.message.edit_text(f"✅ تم تغيير دورك إلى: {role_text}\n\nيمكنك الآن الاستفادة من جميع خصائص الـ{role_text}")
-    await asyncio.sleep(2)
-    user = get_user_by_id(user_id)
-    await callback.message.delete()
-    await bot.send_message(user_id, f"🔄 تم تغيير دورك إلى {role_text}\n\nاستخدم الأزرار أدناه للتنقل:", reply_markup=get_main_keyboard(new_role))
+    await replace_after(callback.message, 2, f"🔄 تم تغيير دورك إلى {role_text}\n\nاستخدم الأزرار أدناه للتنقل:", get_main_keyboard(new_role))
     await callback.answer()
 
 @dp.callback_query(F.data == "back_to_main")
 async def back_to_main_menu(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
-    user = get_user_by_id(callback.from_user.id)
+    user = await run_db(get_user_by_id, callback.from_user.id)
     role_text = "العميل" if user['role'] == 'client' else "الكابتن"
     status_text = ""
     if user['role'] == 'captain':
@@ -821,7 +1424,7 @@ async def back_to_main_menu(callback: types.CallbackQuery, state: FSMContext):
 
 @dp.message()
 async def handle_unknown_message(message: types.Message):
-    user = get_user_by_id(message.from_user.id)
+    user = await run_db(get_user_by_id, message.from_user.id)
     if not user:
         await message.answer("👋 مرحباً! يبدو أنك جديد هنا\nأرسل /start للتسجيل في النظام")
     else:
@@ -830,8 +1433,15 @@ async def handle_unknown_message(message: types.Message):
 if __name__ == "__main__":
     print("🚀 بدء تشغيل بوت دربك...")
     try:
+        init_pool()
         init_db()
+        load_captain_index()
         print("✅ تم الاتصال بقاعدة البيانات")
-        asyncio.run(dp.start_polling(bot))
+        if BOT_MODE == "webhook":
+            asyncio.run(run_webhook(dp, bot))
+        else:
+            asyncio.run(dp.start_polling(bot))
     except Exception as e:
         print(f"❌ خطأ في التشغيل: {e}")
+    finally:
+        close_pool()
@@ -0,0 +1,181 @@
+import argparse
+import asyncio
+import bisect
+import contextvars
+import time
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types import Update
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+# عدّاد استعلامات التحديث الجاري؛ يُضبط في الوسيط ويزداد في run_db
+current_update = contextvars.ContextVar("current_update", default=None)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    # مقاييس بسيطة في الذاكرة تُعرض بصيغة Prometheus النصية؛ كل التحديثات تتم من حلقة الأحداث
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.help = {}
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, func, help_text=None):
+        self.gauges[name] = func
+        if help_text:
+            self.help[name] = help_text
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = [f'{k}="{str(v)}"' for k, v in (*labels, *extra)]
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self):
+        lines = []
+        for name, func in sorted(self.gauges.items()):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {func()}")
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def record_query(name, wait, elapsed, failed=False):
+    metrics.observe("db_query_seconds", elapsed, query=name)
+    metrics.observe("db_pool_wait_seconds", wait)
+    if failed:
+        metrics.inc("db_query_errors_total", query=name)
+    charge_update(current_update.get(), elapsed)
+
+def charge_update(update, elapsed):
+    # النطاقات متداخلة (تحديث داخل تدفق في اختبار الحمل مثلاً) فيُحتسب الاستعلام لكل المستويات
+    while update is not None:
+        update["queries"] += 1
+        update["db_seconds"] += elapsed
+        update = update["parent"]
+
+class MetricsMiddleware(BaseMiddleware):
+    # زمن كل معالج وعدد أخطائه وعدد جولات قاعدة البيانات لكل تحديث
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        update = {"queries": 0, "db_seconds": 0.0, "parent": current_update.get()}
+        token = current_update.set(update)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            metrics.inc("bot_handler_errors_total", handler=name, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=name)
+            metrics.observe("bot_handler_db_queries", update["queries"], COUNT_BUCKETS, handler=name)
+            metrics.observe("bot_handler_db_seconds", update["db_seconds"], handler=name)
+            current_update.reset(token)
+
+async def start_metrics_server(host, port):
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                            headers={"Cache-Control": "no-store"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+async def benchmark(updates, queries):
+    # معالج رسائل حقيقي عبر feed_update، وكل "استعلام" فيه لا يعمل شيئاً سوى ما يضيفه run_db من قياس
+    bot = Bot("123456:benchmark")
+    update = Update.model_validate({"update_id": 1, "message": {
+        "message_id": 1, "date": 0, "text": "قياس",
+        "chat": {"id": 1, "type": "private"}, "from": {"id": 1, "is_bot": False, "first_name": "قياس"}}})
+
+    def query():
+        return None
+
+    def timed_query():
+        started = time.perf_counter()
+        result = query()
+        record_query("benchmark", 0, time.perf_counter() - started)
+        return result
+
+    async def measure(instrumented, count):
+        dp = Dispatcher()
+        run = timed_query if instrumented else query
+        if instrumented:
+            dp.message.middleware(MetricsMiddleware())
+
+        @dp.message()
+        async def handler(message):
+            for _ in range(count):
+                run()
+
+        latencies = []
+        for _ in range(updates):
+            started = time.perf_counter()
+            await dp.feed_update(bot, update)
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        return sum(latencies) / len(latencies) * 1e6, latencies[int(len(latencies) * 0.99)] * 1e6
+
+    print(f"{'queries':>8}{'metrics':>9}{'mean us':>10}{'p99 us':>10}")
+    means = {}
+    for count in (0, queries):
+        for instrumented in (False, True):
+            mean, p99 = await measure(instrumented, count)
+            means[count, instrumented] = mean
+            print(f"{count:>8}{'on' if instrumented else 'off':>9}{mean:>10.1f}{p99:>10.1f}")
+    per_update = means[0, True] - means[0, False]
+    per_query = ((means[queries, True] - means[queries, False]) - per_update) / queries if queries else 0.0
+    print(f"\n📊 كلفة الوسيط لكل تحديث: {per_update:.2f} us، وكلفة record_query لكل استعلام: {per_query:.2f} us")
+    await bot.session.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="قياس كلفة MetricsMiddleware و record_query على زمن المعالج")
+    parser.add_argument("--updates", type=int, default=50_000)
+    parser.add_argument("--queries", type=int, default=3, help="استعلامات كل تحديث في القياس الثاني")
+    args = parser.parse_args()
+    asyncio.run(benchmark(args.updates, args.queries))
@@ -0,0 +1,190 @@
+import argparse
+import re
+import threading
+import time
+import weakref
+import psycopg2.errors
+
+# كل استعلامات main.py في مكان واحد: (أنواع المعاملات، نص SQL بمعاملات موضعية $n)
+STATEMENTS = {
+    "seed_service_areas": (("bigint",), """
+        INSERT INTO captain_service_areas (city, neighborhood, captain_id, is_available)
+        SELECT u.city, n.neighborhood, u.user_id, COALESCE(u.is_available, TRUE)
+        FROM users u, unnest(ARRAY[u.neighborhood, u.neighborhood2, u.neighborhood3]) AS n(neighborhood)
+        WHERE u.role = 'captain' AND u.city IS NOT NULL AND n.neighborhood IS NOT NULL
+          AND ($1 IS NULL OR u.user_id = $1)
+        ON CONFLICT DO NOTHING
+    """),
+    "delete_service_areas": (("bigint",), "DELETE FROM captain_service_areas WHERE captain_id = $1"),
+    "insert_service_areas": (("text", "text[]", "bigint", "boolean"), """
+        INSERT INTO captain_service_areas (city, neighborhood, captain_id, is_available)
+        SELECT $1, n.neighborhood, $3, $4 FROM unnest($2) AS n(neighborhood)
+    """),
+    "get_service_areas": (("bigint",), "SELECT city, neighborhood FROM captain_service_areas WHERE captain_id = $1"),
+    "all_service_areas": ((), "SELECT captain_id, city, neighborhood FROM captain_service_areas"),
+    "upsert_user": (("bigint", "text", "text", "text", "text", "text", "text", "text", "boolean", "text", "text", "text", "text"), """
+        INSERT INTO users (user_id, username, role, subscription, full_name, phone, car_model, car_plate, agreement, city, neighborhood, neighborhood2, neighborhood3, is_available)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, TRUE)
+        ON CONFLICT (user_id) DO UPDATE SET
+            username=EXCLUDED.username, role=EXCLUDED.role, subscription=EXCLUDED.subscription,
+            full_name=EXCLUDED.full_name, phone=EXCLUDED.phone, car_model=EXCLUDED.car_model,
+            car_plate=EXCLUDED.car_plate, agreement=EXCLUDED.agreement, city=EXCLUDED.city,
+            neighborhood=EXCLUDED.neighborhood, neighborhood2=EXCLUDED.neighborhood2,
+            neighborhood3=EXCLUDED.neighborhood3, is_available=TRUE
+        RETURNING *
+    """),
+    "get_user": (("bigint",), "SELECT * FROM users WHERE user_id = $1"),
+    "available_captains": ((), "SELECT * FROM users WHERE role = 'captain' AND is_available = TRUE"),
+    "find_available_captains": (("text", "text"), """
+        SELECT u.* FROM captain_service_areas a JOIN users u ON u.user_id = a.captain_id
+        WHERE a.city = $1 AND a.neighborhood = $2 AND a.is_available AND u.role = 'captain'
+        ORDER BY u.created_at ASC
+    """),
+    "update_user_full_name": (("bigint", "text"), "UPDATE users SET full_name = $2 WHERE user_id = $1 RETURNING *"),
+    "update_user_phone": (("bigint", "text"), "UPDATE users SET phone = $2 WHERE user_id = $1 RETURNING *"),
+    "update_user_city": (("bigint", "text"), "UPDATE users SET city = $2 WHERE user_id = $1 RETURNING *"),
+    "update_user_neighborhood": (("bigint", "text"), "UPDATE users SET neighborhood = $2 WHERE user_id = $1 RETURNING *"),
+    "update_user_role": (("bigint", "text"), "UPDATE users SET role = $2 WHERE user_id = $1 RETURNING *"),
+    "update_user_is_available": (("bigint", "boolean"), "UPDATE users SET is_available = $2 WHERE user_id = $1 RETURNING *"),
+    "update_service_areas_city": (("bigint", "text"), "UPDATE captain_service_areas SET city = $2 WHERE captain_id = $1"),
+    "update_captain_neighborhoods": (("bigint", "text", "text", "text"), """
+        UPDATE users SET neighborhood = $2, neighborhood2 = $3, neighborhood3 = $4 WHERE user_id = $1 RETURNING *
+    """),
+    "update_car": (("bigint", "text", "text"), "UPDATE users SET car_model = $2, car_plate = $3 WHERE user_id = $1 RETURNING *"),
+    "insert_match_request": (("bigint", "bigint", "text"), """
+        INSERT INTO matches (client_id, captain_id, destination, status) VALUES ($1, $2, $3, 'pending') RETURNING *
+    """),
+    "claim_ride": (("bigint", "bigint", "text"), """
+        WITH captain AS (
+            UPDATE users SET is_available=FALSE
+            WHERE user_id=$1 AND role='captain' AND is_available=TRUE RETURNING *
+        ), m AS (
+            INSERT INTO matches (client_id, captain_id, destination, status)
+            SELECT $2, user_id, $3, 'in_progress' FROM captain
+            RETURNING *
+        )
+        SELECT m.*, row_to_json(captain) AS busy_captain FROM m, captain
+    """),
+    "transition_match": (("integer", "bigint", "text", "text[]", "integer"), """
+        WITH old AS (
+            SELECT id, status, version, captain_id FROM matches
+            WHERE id=$1 AND ($2 IS NULL OR captain_id=$2)
+            FOR UPDATE
+        ), valid AS (
+            SELECT * FROM old
+            WHERE status = ANY($4) AND ($5 IS NULL OR version = $5)
+        ), busy AS (
+            UPDATE users SET is_available=FALSE
+            WHERE $3 = 'in_progress' AND is_available=TRUE AND user_id = (SELECT captain_id FROM valid)
+            RETURNING users.*
+        ), m AS (
+            UPDATE matches SET status=$3, version=matches.version + 1, updated_at=CURRENT_TIMESTAMP
+            FROM valid
+            WHERE matches.id = valid.id AND ($3 <> 'in_progress' OR EXISTS (SELECT 1 FROM busy))
+            RETURNING matches.*, valid.status AS previous_status
+        ), freed AS (
+            UPDATE users SET is_available=TRUE
+            FROM m WHERE users.user_id = m.captain_id AND m.previous_status = 'in_progress'
+            RETURNING users.*
+        )
+        SELECT m.*, (SELECT row_to_json(freed) FROM freed) AS freed_captain,
+            (SELECT row_to_json(busy) FROM busy) AS busy_captain
+        FROM m
+    """),
+    "get_match": (("integer",), "SELECT * FROM matches WHERE id = $1"),
+    "open_matches": (("double precision", "double precision"), """
+        SELECT id, status, GREATEST(EXTRACT(EPOCH FROM updated_at - CURRENT_TIMESTAMP)
+            + CASE WHEN status = 'pending' THEN $1 ELSE $2 END, 0) AS delay
+        FROM matches WHERE status IN ('pending', 'in_progress')
+    """),
+    "insert_match_event": (("integer", "text", "text", "bigint", "bigint"), """
+        INSERT INTO match_events (match_id, status, previous_status, client_id, captain_id) VALUES ($1, $2, $3, $4, $5)
+    """),
+    "upsert_rating": (("integer", "bigint", "bigint", "integer", "text", "text"), """
+        INSERT INTO ratings (match_id, client_id, captain_id, rating, comment, notes)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        ON CONFLICT (match_id, client_id) DO UPDATE SET
+            rating = EXCLUDED.rating, comment = EXCLUDED.comment, notes = EXCLUDED.notes, created_at = CURRENT_TIMESTAMP
+    """),
+}
+
+# الحقول المسموح تعديلها مفردة؛ لا يُدرج اسم عمود من خارج هذه القائمة في أي استعلام
+USER_FIELD_UPDATES = {
+    "full_name": "update_user_full_name",
+    "phone": "update_user_phone",
+    "city": "update_user_city",
+    "neighborhood": "update_user_neighborhood",
+    "role": "update_user_role",
+    "is_available": "update_user_is_available",
+}
+
+_prepare_sql = {name: f"PREPARE {name} ({', '.join(types)}) AS {sql}" if types else f"PREPARE {name} AS {sql}"
+                for name, (types, sql) in STATEMENTS.items()}
+_execute_sql = {name: f"EXECUTE {name} ({', '.join(['%s'] * len(types))})" if types else f"EXECUTE {name}"
+                for name, (types, sql) in STATEMENTS.items()}
+
+# العبارات المجهزة على كل اتصال؛ None تعني أن الاتصال يحتاج DEALLOCATE ALL قبل إعادة التجهيز
+_prepared = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+def execute(cur, name, *params):
+    # التجهيز يتم مرة واحدة لكل اتصال في المجمع عند أول استخدام، وبعدها يتخطى الخادم التحليل والتخطيط
+    conn = cur.connection
+    with _lock:
+        prepared = _prepared.get(conn)
+        reset = prepared is None and conn in _prepared
+        if prepared is None:
+            prepared = _prepared[conn] = set()
+    if reset:
+        cur.execute("DEALLOCATE ALL")
+    if name not in prepared:
+        cur.execute(_prepare_sql[name])
+        prepared.add(name)
+    try:
+        cur.execute(_execute_sql[name], params)
+    except psycopg2.errors.FeatureNotSupported:
+        # "cached plan must not change result type" بعد تعديل الجدول من عملية أخرى؛ نعيد التجهيز في المرة القادمة
+        with _lock:
+            _prepared[conn] = None
+        raise
+
+def benchmark(iterations):
+    # يقارن زمن الاستعلامات النصية (تحليل وتخطيط في كل مرة) بالعبارات المجهزة على نفس الاتصال
+    from db import get_conn
+    conn = get_conn()
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT user_id, city, neighborhood FROM users WHERE role = 'captain' LIMIT 1")
+            captain = cur.fetchone()
+            cur.execute("SELECT id FROM matches ORDER BY id DESC LIMIT 1")
+            match = cur.fetchone()
+            if captain is None or match is None:
+                print("⚠️ قاعدة البيانات تحتاج كابتن ورحلة واحدة على الأقل للقياس")
+                return
+            cases = [("get_user", (captain['user_id'],)), ("get_match", (match['id'],)),
+                     ("get_service_areas", (captain['user_id'],)),
+                     ("find_available_captains", (captain['city'], captain['neighborhood']))]
+            print(f"{'statement':<26}{'ad-hoc us':>11}{'prepared us':>13}{'saved us':>10}")
+            for name, params in cases:
+                adhoc_sql = re.sub(r"\$(\d+)", r"%(p\1)s", STATEMENTS[name][1])
+                adhoc_params = {f"p{i + 1}": value for i, value in enumerate(params)}
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    cur.execute(adhoc_sql, adhoc_params)
+                    cur.fetchall()
+                adhoc = (time.perf_counter() - started) / iterations * 1e6
+                execute(cur, name, *params)
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    execute(cur, name, *params)
+                    cur.fetchall()
+                prepared = (time.perf_counter() - started) / iterations * 1e6
+                print(f"{name:<26}{adhoc:>11.1f}{prepared:>13.1f}{adhoc - prepared:>10.1f}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="قياس الوقت الموفر بالعبارات المجهزة مقارنة بالاستعلامات النصية")
+    parser.add_argument("--iterations", type=int, default=2000)
+    benchmark(parser.parse_args().iterations)
@@ -0,0 +1,133 @@
+import asyncio
+import functools
+import json
+import psycopg2
+from aiogram import BaseMiddleware, methods
+from aiogram.client.default import Default
+from aiogram.exceptions import TelegramAPIError
+from db import db_cursor, run_db
+
+def init_scheduler(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS scheduled_messages (
+        id SERIAL PRIMARY KEY, chat_id BIGINT NOT NULL, calls JSONB NOT NULL,
+        due_at TIMESTAMP NOT NULL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_messages_chat ON scheduled_messages (chat_id)")
+
+def dump_call(call):
+    params = call.model_dump(mode="json", exclude_none=True, exclude={k for k, v in call if isinstance(v, Default)})
+    return {"method": type(call).__name__, "params": params}
+
+def load_call(entry):
+    return getattr(methods, entry["method"]).model_validate(entry["params"])
+
+class MessageScheduler:
+    # رسائل المتابعة المؤجلة تُحفظ في قاعدة البيانات وتُنفذ بمؤقت بدلاً من إيقاف المعالج بـ asyncio.sleep
+    def __init__(self, bot, sender):
+        self.bot = bot
+        self.sender = sender
+        self._timers = {}
+        self._chats = {}
+        self._running = set()
+        self._local_ids = -1
+
+    def _insert(self, chat_id, delay, calls):
+        with db_cursor(commit=True) as cur:
+            cur.execute("""
+                INSERT INTO scheduled_messages (chat_id, calls, due_at)
+                VALUES (%s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s)) RETURNING id
+            """, (chat_id, json.dumps([dump_call(c) for c in calls], ensure_ascii=False), delay))
+            return cur.fetchone()['id']
+
+    def _delete(self, job_ids):
+        with db_cursor(commit=True) as cur:
+            cur.execute("DELETE FROM scheduled_messages WHERE id = ANY(%s)", (list(job_ids),))
+
+    def _pending(self):
+        with db_cursor() as cur:
+            cur.execute("SELECT id, chat_id, calls, GREATEST(EXTRACT(EPOCH FROM due_at - CURRENT_TIMESTAMP), 0) AS delay FROM scheduled_messages ORDER BY due_at")
+            return cur.fetchall()
+
+    def _arm(self, job_id, chat_id, delay, calls):
+        loop = asyncio.get_running_loop()
+        self._timers[job_id] = loop.call_later(delay, self._fire, job_id, chat_id, calls)
+        self._chats.setdefault(chat_id, set()).add(job_id)
+
+    def _fire(self, job_id, chat_id, calls):
+        task = asyncio.create_task(self._run(job_id, chat_id, calls))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def schedule(self, chat_id, delay, *calls):
+        try:
+            job_id = await run_db(self._insert, chat_id, delay, calls)
+        except psycopg2.Error as e:
+            # إذا تعذر الحفظ نكتفي بالمؤقت في الذاكرة حتى لا تضيع رسالة المتابعة
+            print(f"⚠️ تعذر حفظ رسالة مجدولة: {e}")
+            job_id, self._local_ids = self._local_ids, self._local_ids - 1
+        self._arm(job_id, chat_id, delay, calls)
+        return job_id
+
+    async def _run(self, job_id, chat_id, calls):
+        self._forget(job_id, chat_id)
+        for call in calls:
+            try:
+                await self.sender.send(chat_id, functools.partial(self.bot, call))
+            except TelegramAPIError as e:
+                # مثلاً الرسالة حُذفت مسبقاً أو المستخدم حظر البوت؛ نكمل بقية الخطوات
+                print(f"⚠️ تعذر تنفيذ رسالة مجدولة للمستخدم {chat_id}: {e}")
+        if job_id > 0:
+            try:
+                await run_db(self._delete, [job_id])
+            except psycopg2.Error as e:
+                print(f"⚠️ تعذر حذف رسالة مجدولة منفذة: {e}")
+
+    def _forget(self, job_id, chat_id):
+        timer = self._timers.pop(job_id, None)
+        if timer is not None:
+            timer.cancel()
+        jobs = self._chats.get(chat_id)
+        if jobs is not None:
+            jobs.discard(job_id)
+            if not jobs:
+                del self._chats[chat_id]
+
+    async def cancel(self, chat_id):
+        job_ids = list(self._chats.get(chat_id, ()))
+        for job_id in job_ids:
+            self._forget(job_id, chat_id)
+        persisted = [job_id for job_id in job_ids if job_id > 0]
+        if persisted:
+            await run_db(self._delete, persisted)
+        return len(job_ids)
+
+    async def restore(self):
+        # إعادة جدولة ما بقي في الطابور بعد إعادة التشغيل
+        rows = await run_db(self._pending)
+        for row in rows:
+            self._arm(row['id'], row['chat_id'], float(row['delay']), [load_call(entry) for entry in row['calls']])
+        return len(rows)
+
+    async def close(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        self._chats.clear()
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+class FollowUpMiddleware(BaseMiddleware):
+    # أي تحديث جديد من المحادثة يعني أن المستخدم انتقل لخطوة أخرى، فتُلغى رسائل المتابعة المعلقة
+    # قبل المعالج حتى لا تظهر قائمة قديمة فوق ما يفعله الآن؛ ما يجدوله المعالج نفسه يبقى
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, handler, event, data):
+        chat = data.get("event_chat")
+        if chat is not None:
+            try:
+                await self.scheduler.cancel(chat.id)
+            except psycopg2.Error as e:
+                print(f"⚠️ تعذر حذف الرسائل المجدولة الملغاة للمستخدم {chat.id}: {e}")
+        return await handler(event, data)
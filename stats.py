@@ -0,0 +1,240 @@
+import argparse
+import time
+import psycopg2
+from config import STATS_RECONCILE_ATTEMPTS
+from db import db_cursor, close_pool
+
+# ملخص إحصائيات لكل مستخدم تحدّثه المحفزات عند كل انتقال لحالة الرحلة أو تقييم جديد،
+# فتصبح قراءة الإحصائيات بحثاً بالمفتاح الأساسي بدلاً من تجميع سجل الرحلات كاملاً
+STATS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+    client_requests INTEGER NOT NULL DEFAULT 0,
+    client_completed INTEGER NOT NULL DEFAULT 0,
+    client_pending INTEGER NOT NULL DEFAULT 0,
+    client_cancelled INTEGER NOT NULL DEFAULT 0,
+    captain_requests INTEGER NOT NULL DEFAULT 0,
+    captain_completed INTEGER NOT NULL DEFAULT 0,
+    captain_active INTEGER NOT NULL DEFAULT 0,
+    rating_sum BIGINT NOT NULL DEFAULT 0,
+    rating_count INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE OR REPLACE FUNCTION apply_match_stats()
+RETURNS TRIGGER AS $$
+DECLARE
+    total_delta INTEGER := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE 0 END;
+    old_status TEXT := CASE WHEN TG_OP = 'UPDATE' THEN OLD.status END;
+BEGIN
+    IF NEW.client_id IS NOT NULL THEN
+        INSERT INTO user_stats AS s (user_id, client_requests, client_completed, client_pending, client_cancelled)
+        VALUES (NEW.client_id, total_delta,
+                (NEW.status = 'completed')::INT - COALESCE((old_status = 'completed')::INT, 0),
+                (NEW.status = 'pending')::INT - COALESCE((old_status = 'pending')::INT, 0),
+                (NEW.status = 'cancelled')::INT - COALESCE((old_status = 'cancelled')::INT, 0))
+        ON CONFLICT (user_id) DO UPDATE SET
+            client_requests = s.client_requests + EXCLUDED.client_requests,
+            client_completed = s.client_completed + EXCLUDED.client_completed,
+            client_pending = s.client_pending + EXCLUDED.client_pending,
+            client_cancelled = s.client_cancelled + EXCLUDED.client_cancelled;
+    END IF;
+    IF NEW.captain_id IS NOT NULL THEN
+        INSERT INTO user_stats AS s (user_id, captain_requests, captain_completed, captain_active)
+        VALUES (NEW.captain_id, total_delta,
+                (NEW.status = 'completed')::INT - COALESCE((old_status = 'completed')::INT, 0),
+                (NEW.status = 'in_progress')::INT - COALESCE((old_status = 'in_progress')::INT, 0))
+        ON CONFLICT (user_id) DO UPDATE SET
+            captain_requests = s.captain_requests + EXCLUDED.captain_requests,
+            captain_completed = s.captain_completed + EXCLUDED.captain_completed,
+            captain_active = s.captain_active + EXCLUDED.captain_active;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS match_stats_insert ON matches;
+CREATE TRIGGER match_stats_insert
+    AFTER INSERT ON matches
+    FOR EACH ROW EXECUTE FUNCTION apply_match_stats();
+
+DROP TRIGGER IF EXISTS match_stats_update ON matches;
+CREATE TRIGGER match_stats_update
+    AFTER UPDATE OF status ON matches
+    FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status)
+    EXECUTE FUNCTION apply_match_stats();
+
+CREATE OR REPLACE FUNCTION apply_rating_stats()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.captain_id IS NOT NULL THEN
+        UPDATE user_stats SET rating_sum = rating_sum - COALESCE(OLD.rating, 0), rating_count = rating_count - (OLD.rating IS NOT NULL)::INT
+        WHERE user_id = OLD.captain_id;
+    END IF;
+    IF NEW.captain_id IS NOT NULL THEN
+        INSERT INTO user_stats AS s (user_id, rating_sum, rating_count)
+        VALUES (NEW.captain_id, COALESCE(NEW.rating, 0), (NEW.rating IS NOT NULL)::INT)
+        ON CONFLICT (user_id) DO UPDATE SET
+            rating_sum = s.rating_sum + EXCLUDED.rating_sum,
+            rating_count = s.rating_count + EXCLUDED.rating_count;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS rating_stats ON ratings;
+CREATE TRIGGER rating_stats
+    AFTER INSERT OR UPDATE OF rating, captain_id ON ratings
+    FOR EACH ROW EXECUTE FUNCTION apply_rating_stats();
+"""
+
+# الأرشيف جزء من السجل، فالمطابقة تحسب الجدولين معاً
+RECONCILE_SQL = """
+INSERT INTO user_stats AS s (user_id, client_requests, client_completed, client_pending, client_cancelled,
+                             captain_requests, captain_completed, captain_active, rating_sum, rating_count)
+SELECT u.user_id,
+       COALESCE(c.total, 0), COALESCE(c.completed, 0), COALESCE(c.pending, 0), COALESCE(c.cancelled, 0),
+       COALESCE(k.total, 0), COALESCE(k.completed, 0), COALESCE(k.active, 0),
+       COALESCE(r.rating_sum, 0), COALESCE(r.rating_count, 0)
+FROM users u
+LEFT JOIN (
+    SELECT client_id, COUNT(*) AS total,
+           COUNT(*) FILTER (WHERE status = 'completed') AS completed,
+           COUNT(*) FILTER (WHERE status = 'pending') AS pending,
+           COUNT(*) FILTER (WHERE status = 'cancelled') AS cancelled
+    FROM (SELECT client_id, status FROM matches UNION ALL SELECT client_id, status FROM matches_archive) m
+    GROUP BY client_id
+) c ON c.client_id = u.user_id
+LEFT JOIN (
+    SELECT captain_id, COUNT(*) AS total,
+           COUNT(*) FILTER (WHERE status = 'completed') AS completed,
+           COUNT(*) FILTER (WHERE status = 'in_progress') AS active
+    FROM (SELECT captain_id, status FROM matches UNION ALL SELECT captain_id, status FROM matches_archive) m
+    GROUP BY captain_id
+) k ON k.captain_id = u.user_id
+LEFT JOIN (
+    SELECT captain_id, SUM(rating) AS rating_sum, COUNT(rating) AS rating_count
+    FROM (SELECT captain_id, rating FROM ratings UNION ALL SELECT captain_id, rating FROM ratings_archive) r
+    GROUP BY captain_id
+) r ON r.captain_id = u.user_id
+ON CONFLICT (user_id) DO UPDATE SET
+    client_requests = EXCLUDED.client_requests, client_completed = EXCLUDED.client_completed,
+    client_pending = EXCLUDED.client_pending, client_cancelled = EXCLUDED.client_cancelled,
+    captain_requests = EXCLUDED.captain_requests, captain_completed = EXCLUDED.captain_completed,
+    captain_active = EXCLUDED.captain_active, rating_sum = EXCLUDED.rating_sum, rating_count = EXCLUDED.rating_count
+WHERE (s.client_requests, s.client_completed, s.client_pending, s.client_cancelled,
+       s.captain_requests, s.captain_completed, s.captain_active, s.rating_sum, s.rating_count)
+   IS DISTINCT FROM
+      (EXCLUDED.client_requests, EXCLUDED.client_completed, EXCLUDED.client_pending, EXCLUDED.client_cancelled,
+       EXCLUDED.captain_requests, EXCLUDED.captain_completed, EXCLUDED.captain_active, EXCLUDED.rating_sum, EXCLUDED.rating_count)
+"""
+
+def init_stats(cur):
+    cur.execute("SELECT to_regclass('user_stats') IS NULL AS missing")
+    missing = cur.fetchone()['missing']
+    cur.execute(STATS_SCHEMA)
+    if missing:
+        cur.execute(RECONCILE_SQL)
+
+def reconcile_user_stats(attempts=STATS_RECONCILE_ATTEMPTS):
+    # يعيد حساب الملخص من الجداول الأصلية ويصحح أي انحراف؛ يعيد عدد الصفوف التي تم تصحيحها
+    # بعزل REPEATABLE READ: إذا زادت المحفزات صفاً في user_stats بعد لقطة المطابقة تفشل المطابقة وتُعاد،
+    # بدلاً من أن تكتب فوقه مجموعاً لا يشمل الرحلة أو التقييم الجديد
+    for attempt in range(1, attempts + 1):
+        try:
+            with db_cursor(commit=True) as cur:
+                cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                cur.execute(RECONCILE_SQL)
+                return cur.rowcount
+        except psycopg2.errors.SerializationFailure:
+            if attempt == attempts:
+                raise
+            time.sleep(0.1 * attempt)
+
+def get_stats_row(user_id):
+    with db_cursor(replica=True, user_id=user_id) as cur:
+        cur.execute("SELECT * FROM user_stats WHERE user_id=%s", (user_id,))
+        return cur.fetchone()
+
+def get_average_ratings(captain_ids):
+    with db_cursor(replica=True) as cur:
+        cur.execute("SELECT user_id, rating_sum::FLOAT / rating_count AS avg_rating FROM user_stats WHERE user_id = ANY(%s) AND rating_count > 0", (list(captain_ids),))
+        return {row['user_id']: row['avg_rating'] for row in cur.fetchall()}
+
+# مستخدمو القياس: عميل وكابتن لكل حجم، بمعرفات لا يستخدمها تيليجرام
+BENCH_USER_BASE = 9_100_000_000
+
+BENCH_SEED_SQL = """
+INSERT INTO users (user_id, role, full_name, phone, city, neighborhood) VALUES
+    (%(client)s, 'client', 'عميل قياس', '0500000000', 'قياس', 'قياس'),
+    (%(captain)s, 'captain', 'كابتن قياس', '0500000001', 'قياس', 'قياس');
+WITH m AS (
+    INSERT INTO matches (client_id, captain_id, destination, status)
+    SELECT %(client)s, %(captain)s, 'قياس', (ARRAY['completed', 'completed', 'completed', 'completed', 'completed',
+                                               'completed', 'completed', 'cancelled', 'cancelled', 'rejected'])[1 + g %% 10]
+    FROM generate_series(1, %(matches)s) g
+    RETURNING id, status
+)
+INSERT INTO ratings (match_id, client_id, captain_id, rating)
+SELECT id, %(client)s, %(captain)s, 1 + id %% 5 FROM m WHERE status = 'completed'
+"""
+
+# استعلاما صفحة الإحصائيات قبل user_stats: تجميع سجل رحلات المستخدم كاملاً في كل طلب
+OLD_CLIENT_SQL = """
+SELECT COUNT(*) AS total_requests, COUNT(CASE WHEN status = 'completed' THEN 1 END) AS completed_trips,
+       COUNT(CASE WHEN status = 'pending' THEN 1 END) AS pending_requests
+FROM matches WHERE client_id = %s
+"""
+OLD_CAPTAIN_SQL = """
+SELECT COUNT(*) AS total_requests, COUNT(CASE WHEN status = 'completed' THEN 1 END) AS completed_trips,
+       COUNT(CASE WHEN status = 'in_progress' THEN 1 END) AS active_trips, COALESCE(AVG(r.rating), 0) AS avg_rating
+FROM matches m LEFT JOIN ratings r ON m.id = r.match_id WHERE m.captain_id = %s
+"""
+
+def _delete_bench_users(cur, count):
+    bounds = (BENCH_USER_BASE, BENCH_USER_BASE + 2 * count)
+    cur.execute("DELETE FROM ratings WHERE client_id >= %s AND client_id < %s", bounds)
+    cur.execute("DELETE FROM matches WHERE client_id >= %s AND client_id < %s", bounds)
+    cur.execute("DELETE FROM users WHERE user_id >= %s AND user_id < %s", bounds)
+
+def _timed(cur, sql, user_id, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        cur.execute(sql, (user_id,))
+        cur.fetchall()
+    return (time.perf_counter() - started) / iterations * 1000
+
+def benchmark(sizes, iterations):
+    try:
+        with db_cursor(commit=True) as cur:
+            _delete_bench_users(cur, len(sizes))
+            for i, size in enumerate(sizes):
+                started = time.perf_counter()
+                cur.execute(BENCH_SEED_SQL, {"client": BENCH_USER_BASE + 2 * i, "captain": BENCH_USER_BASE + 2 * i + 1, "matches": size})
+                print(f"🌱 {size} رحلة مع تحديث user_stats بالمحفزات: {time.perf_counter() - started:.2f} ث")
+        with db_cursor() as cur:
+            cur.execute("ANALYZE matches")
+            cur.execute("ANALYZE ratings")
+            print(f"\n{'matches':>9}{'old client ms':>15}{'old captain ms':>16}{'user_stats ms':>15}")
+            for i, size in enumerate(sizes):
+                client, captain = BENCH_USER_BASE + 2 * i, BENCH_USER_BASE + 2 * i + 1
+                old_client = _timed(cur, OLD_CLIENT_SQL, client, iterations)
+                old_captain = _timed(cur, OLD_CAPTAIN_SQL, captain, iterations)
+                new = _timed(cur, "SELECT * FROM user_stats WHERE user_id = %s", captain, iterations)
+                print(f"{size:>9}{old_client:>15.3f}{old_captain:>16.3f}{new:>15.3f}")
+        # المطابقة تمسح الجداول كاملة، وعدد الصفوف المصححة يجب أن يكون صفراً إن كانت المحفزات دقيقة
+        started = time.perf_counter()
+        corrected = reconcile_user_stats()
+        print(f"\n🔁 RECONCILE_SQL: {time.perf_counter() - started:.2f} ث، صفوف مصححة {corrected}")
+    finally:
+        with db_cursor(commit=True) as cur:
+            _delete_bench_users(cur, len(sizes))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="قياس صفحة الإحصائيات: التجميع القديم مقابل user_stats، وكلفة المطابقة الدورية")
+    parser.add_argument("--sizes", default="10,1000,10000", help="عدد رحلات كل مستخدم قياس، مفصولة بفواصل")
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    try:
+        benchmark([int(size) for size in args.sizes.split(",")], args.iterations)
+    finally:
+        close_pool()
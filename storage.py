@@ -0,0 +1,113 @@
+import asyncio
+import contextvars
+import json
+import time
+import psycopg2
+import psycopg2.extras
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from config import FSM_STATE_TTL, FSM_FLUSH_INTERVAL, FSM_CLEANUP_INTERVAL
+from db import db_cursor, run_db
+
+_UNSET = object()
+
+def init_storage(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS fsm_storage (
+        key TEXT PRIMARY KEY, state TEXT, data JSONB NOT NULL DEFAULT '{}',
+        expires_at TIMESTAMP NOT NULL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_fsm_storage_expires ON fsm_storage (expires_at)")
+
+class PostgresStorage(BaseStorage):
+    # تخزين حالات المحادثة في PostgreSQL مع مخزن كتابة مؤجلة يُفرَّغ كل FSM_FLUSH_INTERVAL ثانية
+    def __init__(self, ttl=FSM_STATE_TTL, flush_interval=FSM_FLUSH_INTERVAL, key_builder=None):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._pending = {}
+        self._flush_task = None
+        self._cleanup_at = 0
+
+    def _buffer(self, key, **parts):
+        entry = self._pending.setdefault(self.key_builder.build(key), {})
+        entry.update(parts)
+        if self._flush_task is None or self._flush_task.done():
+            # سياق فارغ حتى لا تُنسب استعلامات الحفظ الدوري للتحديث الذي أنشأ المهمة
+            self._flush_task = asyncio.create_task(self._flush_loop(), context=contextvars.Context())
+
+    async def set_state(self, key, state=None):
+        self._buffer(key, state=state.state if isinstance(state, State) else state)
+
+    async def set_data(self, key, data):
+        self._buffer(key, data=dict(data))
+
+    async def _read(self, key, part):
+        key = self.key_builder.build(key)
+        value = self._pending.get(key, {}).get(part, _UNSET)
+        if value is _UNSET:
+            row = await run_db(self._fetch, key)
+            value = row[part] if row else (None if part == "state" else {})
+        return value
+
+    async def get_state(self, key):
+        return await self._read(key, "state")
+
+    async def get_data(self, key):
+        return dict(await self._read(key, "data"))
+
+    def _fetch(self, key):
+        with db_cursor() as cur:
+            cur.execute("SELECT state, data FROM fsm_storage WHERE key=%s AND expires_at > CURRENT_TIMESTAMP", (key,))
+            return cur.fetchone()
+
+    def _write(self, batch):
+        states = [(k, e["state"], self.ttl) for k, e in batch.items() if "state" in e]
+        data = [(k, json.dumps(e["data"], ensure_ascii=False), self.ttl) for k, e in batch.items() if "data" in e]
+        with db_cursor(commit=True) as cur:
+            if states:
+                psycopg2.extras.execute_values(cur, """
+                    INSERT INTO fsm_storage (key, state, expires_at)
+                    SELECT v.key, v.state, CURRENT_TIMESTAMP + make_interval(secs => v.ttl)
+                    FROM (VALUES %s) AS v(key, state, ttl)
+                    ON CONFLICT (key) DO UPDATE SET state = EXCLUDED.state, expires_at = EXCLUDED.expires_at
+                """, states)
+            if data:
+                psycopg2.extras.execute_values(cur, """
+                    INSERT INTO fsm_storage (key, data, expires_at)
+                    SELECT v.key, v.data::jsonb, CURRENT_TIMESTAMP + make_interval(secs => v.ttl)
+                    FROM (VALUES %s) AS v(key, data, ttl)
+                    ON CONFLICT (key) DO UPDATE SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+                """, data)
+
+    def _cleanup(self):
+        with db_cursor(commit=True) as cur:
+            cur.execute("DELETE FROM fsm_storage WHERE expires_at <= CURRENT_TIMESTAMP OR (state IS NULL AND data = '{}'::jsonb)")
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch = {key: dict(entry) for key, entry in self._pending.items()}
+        await run_db(self._write, batch)
+        # لا نحذف من المخزن إلا ما لم يتغير أثناء الكتابة
+        for key, entry in batch.items():
+            if self._pending.get(key) == entry:
+                del self._pending[key]
+        if time.monotonic() >= self._cleanup_at:
+            self._cleanup_at = time.monotonic() + FSM_CLEANUP_INTERVAL
+            await run_db(self._cleanup)
+
+    async def _flush_loop(self):
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except psycopg2.Error as e:
+                print(f"⚠️ تعذر حفظ حالات المحادثة: {e}")
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.flush()
@@ -0,0 +1,85 @@
+import asyncio
+import time
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import CallbackQuery, Message
+from broadcast import TokenBucket
+from config import USER_RATE_LIMIT, USER_RATE_BURST, DUPLICATE_UPDATE_WINDOW
+
+class ThrottlingMiddleware(BaseMiddleware):
+    # يسبق المعالجات: يدمج الطلبات المتطابقة الجارية، ويسقط المكرر خلال نافذة قصيرة،
+    # ويحد معدل كل مستخدم بدلو رموز قبل أن تصل أي ضغطة لقاعدة البيانات
+    def __init__(self, rate=USER_RATE_LIMIT, burst=USER_RATE_BURST, window=DUPLICATE_UPDATE_WINDOW):
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self.buckets = {}
+        self.recent = {}
+        self.inflight = {}
+        self.duplicates = 0
+        self.coalesced = 0
+        self.limited = 0
+
+    @staticmethod
+    def _key(event, user):
+        # الضغطات المتكررة على نفس الزر تُدمج بمحتواها، أما الرسائل فلا يُسقط منها إلا إعادة إرسال نفس الرسالة؛
+        # رسالتان متطابقتان النص (نفس الحي أو "نعم" مرتين) خطوتان مختلفتان
+        if isinstance(event, CallbackQuery):
+            message_id = event.message.message_id if event.message else None
+            return ("callback", user.id, event.data, message_id)
+        if isinstance(event, Message):
+            return ("message", event.chat.id, event.message_id)
+        return None
+
+    def _bucket(self, user_id):
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            if len(self.buckets) >= 10000:
+                self.buckets = {k: b for k, b in self.buckets.items() if not b.idle()}
+            bucket = self.buckets[user_id] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _remember(self, key):
+        now = time.monotonic()
+        if len(self.recent) >= 10000:
+            self.recent = {k: expires for k, expires in self.recent.items() if expires > now}
+        self.recent[key] = now + self.window
+
+    @staticmethod
+    async def _acknowledge(event, text=None):
+        # نرد على الضغطة المُسقطة حتى لا يبقى مؤشر التحميل ظاهراً للمستخدم
+        if isinstance(event, CallbackQuery):
+            try:
+                await event.answer(text)
+            except TelegramAPIError:
+                pass
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        key = self._key(event, user) if user is not None else None
+        if key is None:
+            return await handler(event, data)
+        pending = self.inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            await self._acknowledge(event)
+            return await pending
+        if self.recent.get(key, 0) > time.monotonic():
+            self.duplicates += 1
+            await self._acknowledge(event)
+            return None
+        if not self._bucket(user.id).try_acquire():
+            self.limited += 1
+            await self._acknowledge(event, "⏳ طلبات كثيرة، يرجى الانتظار قليلاً")
+            return None
+        done = asyncio.get_running_loop().create_future()
+        self.inflight[key] = done
+        result = None
+        try:
+            result = await handler(event, data)
+            return result
+        finally:
+            # المكررات المنتظرة تحصل على نفس النتيجة، أو None إذا فشل المعالج الأصلي
+            done.set_result(result)
+            del self.inflight[key]
+            self._remember(key)
@@ -0,0 +1,127 @@
+import argparse
+import asyncio
+import random
+import time
+
+class TimingWheel:
+    # عجلة توقيت هرمية: كل مستوى يحمل slots خانة، وخانة المستوى l تغطي slots**l نبضة.
+    # الجدولة والإلغاء O(1)، وكل مؤقت ينزل مستوى واحداً في كل مرة يقترب فيها موعده
+    def __init__(self, tick=1.0, slots=64, levels=4, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.slots = slots
+        self.levels = levels
+        self.started = clock()
+        self.fired = 0
+        self._spans = [slots ** level for level in range(levels + 1)]
+        self._wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._where = {}
+        self._current = 0
+
+    def _place(self, key, expires, value):
+        # ما يتجاوز مدى العجلة يوضع في آخر خانة فيها ويُعاد توزيعه عند تفريغها بموعده الحقيقي
+        diff = min(expires - self._current, self._spans[-1] - 1)
+        level = 0
+        while diff >= self._spans[level + 1]:
+            level += 1
+        slot = ((self._current + diff) // self._spans[level]) % self.slots
+        self._wheels[level][slot][key] = (expires, value)
+        self._where[key] = (level, slot)
+
+    def schedule(self, key, delay, value=None):
+        # إعادة جدولة المفتاح تستبدل موعده السابق، والموعد يُحسب من الساعة لا من آخر نبضة منفذة
+        self.cancel(key)
+        expires = -int(-(self.clock() - self.started + max(delay, 0)) // self.tick)
+        self._place(key, max(expires, self._current + 1), value)
+
+    def cancel(self, key):
+        where = self._where.pop(key, None)
+        if where is None:
+            return False
+        del self._wheels[where[0]][where[1]][key]
+        return True
+
+    def clear(self):
+        for wheel in self._wheels:
+            for slot in wheel:
+                slot.clear()
+        self._where.clear()
+
+    def _step(self):
+        self._current += 1
+        # المستويات العليا تُفرغ في الأدنى قبل تنفيذ خانة النبضة الحالية
+        for level in range(self.levels - 1, 0, -1):
+            if self._current % self._spans[level]:
+                continue
+            slot = self._wheels[level][(self._current // self._spans[level]) % self.slots]
+            entries = list(slot.items())
+            slot.clear()
+            for key, (expires, value) in entries:
+                self._place(key, expires, value)
+        slot = self._wheels[0][self._current % self.slots]
+        expired = list(slot.items())
+        slot.clear()
+        for key, _ in expired:
+            del self._where[key]
+        self.fired += len(expired)
+        return [(key, value) for key, (_, value) in expired]
+
+    def advance(self, now=None):
+        now = self.clock() if now is None else now
+        target = int((now - self.started) / self.tick)
+        expired = []
+        while self._current < target:
+            expired.extend(self._step())
+        return expired
+
+    async def run(self, on_expire):
+        while True:
+            await asyncio.sleep(self.tick)
+            for key, value in self.advance():
+                try:
+                    on_expire(key, value)
+                except Exception as e:
+                    print(f"⚠️ خطأ في معالجة انتهاء المؤقت {key}: {e}")
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+def benchmark(count, horizon, seed):
+    # يجدول count مؤقتاً بمواعيد عشوائية ثم يدير العجلة بزمن افتراضي ويتحقق أن كل مؤقت انتهى في نبضته بالضبط مرة واحدة
+    rng = random.Random(seed)
+    wheel = TimingWheel(clock=lambda: 0.0)
+    deadlines = [rng.randint(1, horizon) for _ in range(count)]
+    started = time.perf_counter()
+    for key, ticks in enumerate(deadlines):
+        wheel.schedule(key, ticks, ticks)
+    scheduled = time.perf_counter() - started
+    cancelled = set(rng.sample(range(count), count // 10))
+    started = time.perf_counter()
+    for key in cancelled:
+        wheel.cancel(key)
+    cancel_time = time.perf_counter() - started
+    seen = set()
+    errors = 0
+    started = time.perf_counter()
+    for tick in range(1, horizon + 1):
+        for key, expected in wheel.advance(tick * wheel.tick):
+            if expected != tick or key in seen or key in cancelled:
+                errors += 1
+            seen.add(key)
+    advanced = time.perf_counter() - started
+    missing = count - len(cancelled) - len(seen)
+    print(f"⏱️ جدولة {count} مؤقت: {scheduled / count * 1e9:.0f} ns/مؤقت، إلغاء {len(cancelled)}: {cancel_time / max(len(cancelled), 1) * 1e9:.0f} ns/مؤقت")
+    print(f"🔄 {horizon} نبضة في {advanced:.2f} ث: {advanced / max(len(seen), 1) * 1e9:.0f} ns لكل مؤقت منتهٍ")
+    print(f"{'✅' if not errors and not missing and not len(wheel) else '❌'} منتهية {len(seen)}، أخطاء توقيت {errors}، مفقودة {missing}، متبقية {len(wheel)}")
+    return not errors and not missing and not len(wheel)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="قياس وتحقق عجلة التوقيت بعدد كبير من المؤقتات")
+    parser.add_argument("--timeouts", type=int, default=1_000_000)
+    parser.add_argument("--horizon", type=int, default=100_000, help="أبعد موعد بالنبضات")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    raise SystemExit(0 if benchmark(args.timeouts, args.horizon, args.seed) else 1)
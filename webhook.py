@@ -0,0 +1,132 @@
+import asyncio
+from collections import deque
+from aiohttp import web
+from pydantic import ValidationError
+from aiogram.types import Update
+from aiogram.types.update import UpdateTypeLookupError
+from metrics import metrics
+from config import (WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET,
+                    WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_ENQUEUE_TIMEOUT, WEBHOOK_CHAT_CONCURRENCY)
+
+class UpdateWorkers:
+    # كل مستخدم يُوجَّه دائماً لنفس الطابور فتُعالج تحديثاته بالترتيب، وداخل الطابور تعمل حتى
+    # chat_concurrency محادثة بالتوازي، فلا يوقف معالج بطيء بقية المحادثات التي وقعت في نفس الطابور
+    def __init__(self, dp, bot, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE, chat_concurrency=WEBHOOK_CHAT_CONCURRENCY):
+        self.dp = dp
+        self.bot = bot
+        self.chat_concurrency = chat_concurrency
+        self.queues = [asyncio.Queue() for _ in range(workers)]
+        # السعة تُحجز عند الاستلام وتُحرر بعد المعالجة، فتشمل ما ينتظر خلف تحديث سابق من نفس المحادثة
+        self.capacity = [asyncio.Semaphore(max(1, queue_size // workers)) for _ in range(workers)]
+        self.tasks = []
+        self.pending = 0
+        self.processed = 0
+        self.rejected = 0
+        self._chats = {}
+        self._running = set()
+
+    @staticmethod
+    def ordering_key(update):
+        try:
+            event = update.event
+        except UpdateTypeLookupError:
+            return update.update_id
+        user = getattr(event, "from_user", None)
+        if user is not None:
+            return user.id
+        chat = getattr(event, "chat", None)
+        return chat.id if chat is not None else update.update_id
+
+    async def submit(self, update, timeout=WEBHOOK_ENQUEUE_TIMEOUT):
+        shard = hash(self.ordering_key(update)) % len(self.queues)
+        try:
+            await asyncio.wait_for(self.capacity[shard].acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        self.pending += 1
+        self.queues[shard].put_nowait(update)
+        return True
+
+    async def _work(self, shard):
+        queue = self.queues[shard]
+        slots = asyncio.Semaphore(self.chat_concurrency)
+        while True:
+            update = await queue.get()
+            key = self.ordering_key(update)
+            backlog = self._chats.get(key)
+            if backlog is not None:
+                # المحادثة قيد المعالجة: يُنفذ التحديث بعد ما سبقه منها
+                backlog.append(update)
+                continue
+            await slots.acquire()
+            backlog = self._chats[key] = deque([update])
+            task = asyncio.create_task(self._drain(shard, key, backlog, slots))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _drain(self, shard, key, backlog, slots):
+        try:
+            while backlog:
+                update = backlog[0]
+                try:
+                    await self.dp.feed_update(self.bot, update)
+                except Exception as e:
+                    print(f"❌ خطأ في معالجة التحديث {update.update_id}: {e}")
+                finally:
+                    backlog.popleft()
+                    self.pending -= 1
+                    self.processed += 1
+                    self.capacity[shard].release()
+                    self.queues[shard].task_done()
+        finally:
+            del self._chats[key]
+            slots.release()
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._work(shard)) for shard in range(len(self.queues))]
+
+    async def stop(self):
+        await asyncio.gather(*(queue.join() for queue in self.queues))
+        for task in (*self.tasks, *self._running):
+            task.cancel()
+        await asyncio.gather(*self.tasks, *self._running, return_exceptions=True)
+        self.tasks = []
+
+def create_webhook_app(workers, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+    async def handle_update(request):
+        if secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": workers.bot})
+        except (ValueError, ValidationError):
+            # جسم غير صالح لن يصلح بإعادة الإرسال، فنرد 400 بدلاً من 500 الذي يعيده تيليجرام
+            return web.Response(status=400)
+        if not await workers.submit(update):
+            # الطوابير ممتلئة: نرد بخطأ ليعيد تيليجرام الإرسال لاحقاً بدلاً من تكديس التحديثات في الذاكرة
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    return app
+
+async def run_webhook(dp, bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+    workers = UpdateWorkers(dp, bot)
+    metrics.gauge("webhook_queue_depth", lambda: workers.pending)
+    metrics.gauge("webhook_updates_processed", lambda: workers.processed)
+    metrics.gauge("webhook_updates_rejected", lambda: workers.rejected)
+    runner = web.AppRunner(create_webhook_app(workers))
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    workers.start()
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                          allowed_updates=dp.resolve_used_update_types())
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await workers.stop()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
@@ -0,0 +1,129 @@
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import WRITE_BATCH_INTERVAL, WRITE_BATCH_MAX
+from db import db_cursor
+from metrics import metrics, record_query, charge_update, current_update
+
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+# ما تطلب دوال الكتابة تنفيذه بعد حفظ معاملة الدفعة الجارية في خيط الكتابة
+_transaction = threading.local()
+
+def after_commit(callback, *args):
+    # يُستدعى من دالة كتابة داخل الدفعة: callback يعمل في حلقة الأحداث بعد الحفظ، ويُهمل إذا تراجعت الكتابة
+    # يعيد False خارج معاملة الدفعة ليقرر المستدعي ما يفعل
+    callbacks = getattr(_transaction, "callbacks", None)
+    if callbacks is None:
+        return False
+    callbacks.append((callback, args))
+    return True
+
+class WritePipeline:
+    # تجميع الكتابات (group commit): كتابات المعالجات المتزامنة تُنفذ في معاملة واحدة ويُنتظر حفظها معاً
+    def __init__(self, interval=WRITE_BATCH_INTERVAL, max_batch=WRITE_BATCH_MAX):
+        self.interval = interval
+        self.max_batch = max_batch
+        self.writes = 0
+        self.commits = 0
+        self._queue = []
+        self._task = None
+        # خيط واحد مخصص حتى لا تنتظر الدفعة خلف استعلامات القراءة في منفذ run_db
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer")
+
+    async def submit(self, func, *args):
+        # func(cur, *args) تعمل داخل معاملة الدفعة، والنتيجة لا تُعاد إلا بعد نجاح الحفظ
+        future = asyncio.get_running_loop().create_future()
+        # الدفعة تعمل في سياق فارغ، فيُحفظ نطاق التحديث الذي طلب الكتابة ليُحتسب عليه حفظ الدفعة
+        self._queue.append((func, args, future, current_update.get()))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop(), context=contextvars.Context())
+        return await future
+
+    async def _flush_loop(self):
+        await asyncio.sleep(self.interval)
+        # ما يصل أثناء حفظ دفعة ينتظر الدفعة التالية مباشرة دون مهلة إضافية
+        while self._queue:
+            batch = self._queue[:self.max_batch]
+            del self._queue[:len(batch)]
+            await self._commit(batch)
+
+    async def _commit(self, batch):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            results, callbacks = await loop.run_in_executor(self._executor, self._write, batch)
+        except Exception as e:
+            self._record(batch, time.perf_counter() - started, True)
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self._record(batch, time.perf_counter() - started)
+        metrics.observe("write_batch_size", len(batch), BATCH_BUCKETS)
+        self.commits += 1
+        self.writes += len(batch)
+        for callback, args in callbacks:
+            callback(*args)
+        for (_, _, future, _), (ok, value) in zip(batch, results):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    @staticmethod
+    def _record(batch, elapsed, failed=False):
+        # كل تحديث في الدفعة انتظر حفظها كاملاً، فيُحتسب عليه استعلام واحد بزمن الدفعة
+        record_query("WritePipeline.commit", 0, elapsed, failed)
+        for update in {id(entry[3]): entry[3] for entry in batch if entry[3] is not None}.values():
+            charge_update(update, elapsed)
+
+    @staticmethod
+    def _write(batch):
+        results = []
+        _transaction.callbacks = callbacks = []
+        try:
+            with db_cursor(commit=True) as cur:
+                if len(batch) == 1:
+                    func, args, _, _ = batch[0]
+                    results.append((True, func(cur, *args)))
+                else:
+                    for func, args, _, _ in batch:
+                        # نقطة حفظ لكل كتابة: فشل إحداها (تعارض مثلاً) لا يُلغي بقية الدفعة ولا ما طلبته بعد الحفظ
+                        mark = len(callbacks)
+                        cur.execute("SAVEPOINT write")
+                        try:
+                            results.append((True, func(cur, *args)))
+                            cur.execute("RELEASE SAVEPOINT write")
+                        except Exception as e:
+                            cur.execute("ROLLBACK TO SAVEPOINT write")
+                            del callbacks[mark:]
+                            results.append((False, e))
+        finally:
+            _transaction.callbacks = None
+        return results, callbacks
+
+    async def close(self):
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+pipeline = None
+
+async def write_db(func, *args):
+    global pipeline
+    if pipeline is None:
+        pipeline = WritePipeline()
+    return await pipeline.submit(func, *args)
+
+def writer_stats():
+    return (pipeline.writes, pipeline.commits) if pipeline is not None else (0, 0)
+
+async def close_writer():
+    global pipeline
+    if pipeline is not None:
+        await pipeline.close()
+        pipeline = None